@@ -4,7 +4,7 @@ from django.contrib import admin
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.utils.translation import gettext as _
-from .models import User, CryptoExchangeApiKey
+from .models import User, CryptoExchangeApiKey, StripeSubscription
 
 
 class CustomUserAdmin(UserAdmin):
@@ -77,3 +77,4 @@ class CustomUserAdmin(UserAdmin):
 
 admin.site.register(User, CustomUserAdmin)
 admin.site.register(CryptoExchangeApiKey)
+admin.site.register(StripeSubscription)
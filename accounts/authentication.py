@@ -0,0 +1,36 @@
+from dj_rest_auth.jwt_auth import JWTCookieAuthentication
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from .subscription import cached_subscription
+
+
+class SubscriptionTokenUser(TokenUser):
+    """ User of a validated access token with the cached subscription end, no user row behind it """
+
+    def __init__(self, token, subscription_end):
+        super().__init__(token)
+        self.subscription_end = subscription_end
+
+
+class SubscriptionJWTAuthentication(JWTCookieAuthentication):
+    """
+    JWT header or cookie authentication for the hot read endpoints. The user is a token user carrying
+    the subscription end from the per user cache instead of a User row loaded on every request.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        subscription = cached_subscription(user_id)
+        if subscription is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        active, subscription_end = subscription
+        if not active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        return SubscriptionTokenUser(validated_token, subscription_end)
@@ -44,6 +44,7 @@ STRIPE_SUBSCRIPTION_FAILURE_MESSAGE = "We're sorry, your payment has failed and
                                      "could not be activated. Please check your payment information and try again."
 STRIPE_CANCEL_SUBSCRIPTION_MESSAGE = "{} Subscription canceled successfully."
 STRIPE_NO_SUBSCRIPTION_MESSAGE = "No active subscription found."
+STRIPE_WEBHOOK_NOT_CONFIGURED_ERROR = "Stripe webhook secret is not configured."
 
 # notification
 NOTIFICATION_ALL_READ = 'All notifications marked as read.'
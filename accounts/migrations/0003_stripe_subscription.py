@@ -0,0 +1,39 @@
+# Generated by Django 4.2 on 2026-10-17 15:40
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_rename_free_trail_user_free_trial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StripeEvent',
+            fields=[
+                ('id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('type', models.CharField(max_length=100)),
+                ('processed_time', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StripeSubscription',
+            fields=[
+                ('id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('customer_id', models.CharField(db_index=True, max_length=50)),
+                ('checkout_session_id', models.CharField(blank=True, max_length=255, null=True, unique=True)),
+                ('status', models.CharField(blank=True, max_length=30)),
+                ('plan_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('current_period_start', models.DateTimeField(blank=True, null=True)),
+                ('current_period_end', models.DateTimeField(blank=True, null=True)),
+                ('cancel_at_period_end', models.BooleanField(default=False)),
+                ('state_time', models.DateTimeField(blank=True, null=True)),
+                ('update_time', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stripe_subscriptions', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -101,6 +101,36 @@ class User(AbstractUser):
         return self.name
 
 
+class StripeSubscription(models.Model):
+    """ Local mirror of a Stripe subscription, kept up to date by the Stripe webhook """
+    id = models.CharField(primary_key=True, max_length=255)
+    customer_id = models.CharField(max_length=50, db_index=True)
+    user = models.ForeignKey(User, blank=True, null=True, on_delete=models.SET_NULL,
+                             related_name='stripe_subscriptions')
+    checkout_session_id = models.CharField(max_length=255, blank=True, null=True, unique=True)
+    status = models.CharField(max_length=30, blank=True)
+    plan_id = models.CharField(max_length=255, blank=True, null=True)
+    current_period_start = models.DateTimeField(blank=True, null=True)
+    current_period_end = models.DateTimeField(blank=True, null=True)
+    cancel_at_period_end = models.BooleanField(default=False)
+    # time of the subscription state applied last, events delivered out of order with an older state are ignored
+    state_time = models.DateTimeField(blank=True, null=True)
+    update_time = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.id} | {self.status}'
+
+
+class StripeEvent(models.Model):
+    """ Id of a processed Stripe webhook event, redeliveries of it are skipped """
+    id = models.CharField(primary_key=True, max_length=255)
+    type = models.CharField(max_length=100)
+    processed_time = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.id} | {self.type}'
+
+
 class Notification(models.Model):
     id = models.UUIDField(primary_key=True, unique=True, default=uuid.uuid4, editable=False)
     title = models.CharField(max_length=255)
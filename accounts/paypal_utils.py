@@ -1,14 +1,41 @@
+import time
+from threading import Lock
+
 import requests
 from django.conf import settings
+from django.core.cache import cache
+
+SUBSCRIPTION_KEY = 'paypal_subscription:{}'
 
 
 class PayPalAPI:
+    """
+    PayPal REST client shared by the whole process: one keep-alive session, and one access token
+    reused until shortly before it expires and refreshed under a lock.
+    """
     PAYPAL_BASE_URL = settings.PAYPAL_BASE_URL
     PAYPAL_CLIENT_ID = settings.PAYPAL_CLIENT_ID
     PAYPAL_CLIENT_SECRET = settings.PAYPAL_CLIENT_SECRET
 
     def __init__(self):
-        self.access_token = self._get_access_token()
+        self.session = requests.Session()
+        self._token_lock = Lock()
+        self._access_token = None
+        self._token_expiry = 0
+
+    @property
+    def access_token(self):
+        with self._token_lock:
+            if self._access_token is None or time.monotonic() >= self._token_expiry:
+                token = self._get_access_token()
+                self._access_token = token['access_token']
+                self._token_expiry = time.monotonic() + token['expires_in'] - settings.PAYPAL_TOKEN_EXPIRY_MARGIN
+            return self._access_token
+
+    def drop_access_token(self, access_token):
+        with self._token_lock:
+            if self._access_token == access_token:
+                self._access_token = None
 
     def _get_access_token(self):
         url = f'{self.PAYPAL_BASE_URL}/v1/oauth2/token'
@@ -16,16 +43,25 @@ class PayPalAPI:
         data = {'grant_type': 'client_credentials'}
         auth = (self.PAYPAL_CLIENT_ID, self.PAYPAL_CLIENT_SECRET)
 
-        response = requests.post(url, headers=headers, data=data, auth=auth)
+        response = self.session.post(url, headers=headers, data=data, auth=auth)
         response.raise_for_status()
 
-        return response.json()['access_token']
+        return response.json()
+
+    def _request(self, method, url, headers=None, **kwargs):
+        """ Authorized request, retried once with a new token when PayPal no longer accepts the cached one """
+        for attempt in range(2):
+            access_token = self.access_token
+            response = self.session.request(
+                method, url, headers={**(headers or {}), 'Authorization': f'Bearer {access_token}'}, **kwargs)
+            if response.status_code != 401 or attempt:
+                return response
+            self.drop_access_token(access_token)
 
     def get_billing_plans(self):
         url = f'{self.PAYPAL_BASE_URL}/v1/billing/plans'
-        headers = {'Authorization': f'Bearer {self.access_token}'}
 
-        response = requests.get(url, headers=headers)
+        response = self._request('GET', url)
         response.raise_for_status()
 
         return response.json()
@@ -33,41 +69,51 @@ class PayPalAPI:
     def get_detail_billing_plan(self, plan_id):
         url = f'{self.PAYPAL_BASE_URL}/v1/billing/plans/{plan_id}'
         headers = {
-            'Authorization': f'Bearer {self.access_token}',
             'Content-Type': 'application/json',
             'Accept': 'application/json'
         }
 
-        response = requests.get(url, headers=headers)
+        response = self._request('GET', url, headers=headers)
 
         if response.status_code == 200:
             return response.json()
         else:
             raise Exception(f'Error retrieving plan {plan_id}: {response.json()}')
 
-    def get_subscription(self, subscription_id: str):
+    def get_subscription(self, subscription_id: str, use_cache=True):
+        """ Subscription details, reused for PAYPAL_SUBSCRIPTION_CACHE_TIMEOUT seconds unless use_cache is False """
+        key = SUBSCRIPTION_KEY.format(subscription_id)
+        if use_cache:
+            subscription = cache.get(key)
+            if subscription is not None:
+                return subscription
+
         url = f'{self.PAYPAL_BASE_URL}/v1/billing/subscriptions/{subscription_id}'
         headers = {
-            'Authorization': f'Bearer {self.access_token}',
             'Content-Type': 'application/json',
             'X-PAYPAL-SECURITY-CONTEXT': f'{{"clientId": "{self.PAYPAL_CLIENT_SECRET}"}}',
         }
 
-        response = requests.get(url, headers=headers)
+        response = self._request('GET', url, headers=headers)
         response.raise_for_status()
 
-        return response.json()
+        subscription = response.json()
+        cache.set(key, subscription, timeout=settings.PAYPAL_SUBSCRIPTION_CACHE_TIMEOUT)
+        return subscription
 
     def cancel_subscription(self, subscription_id: str, reason: str):
         url = f'{self.PAYPAL_BASE_URL}/v1/billing/subscriptions/{subscription_id}/cancel'
         headers = {
-            'Authorization': f'Bearer {self.access_token}',
             'Content-Type': 'application/json',
             'X-PAYPAL-SECURITY-CONTEXT': f'{{"clientId": "{self.PAYPAL_CLIENT_SECRET}"}}',
         }
         data = {'reason': reason}
 
-        response = requests.post(url, headers=headers, json=data)
+        response = self._request('POST', url, headers=headers, json=data)
         response.raise_for_status()
+        cache.delete(SUBSCRIPTION_KEY.format(subscription_id))
 
         return {'message': 'Subscription cancelled successfully'}
+
+
+paypal_api = PayPalAPI()
@@ -0,0 +1,153 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+import requests
+import stripe
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .constants import SubscriptionSourceChoices
+from .models import StripeSubscription, User
+from .paypal_utils import paypal_api
+from .stripe_utils import (
+    ACTIVE_STATUSES, TERMINAL_STATUSES, access_end, cut_subscription, from_timestamp, subscription_values,
+)
+from .subscription import invalidate_subscriptions
+
+SUBSCRIPTION_FIELDS = ('subscription_start', 'subscription_end', 'free_trial')
+MIRROR_FIELDS = ('customer_id', 'status', 'plan_id', 'current_period_start', 'current_period_end',
+                 'cancel_at_period_end', 'state_time')
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def apply_subscription_states(users, states):
+    """ Bulk updates the users whose (start, end, free trial) differs from their state, None keeps a user """
+    changed = []
+    for user, state in zip(users, states):
+        if state is None or tuple(getattr(user, field) for field in SUBSCRIPTION_FIELDS) == state:
+            continue
+        for field, value in zip(SUBSCRIPTION_FIELDS, state):
+            setattr(user, field, value)
+        changed.append(user)
+    if changed:
+        User.objects.bulk_update(changed, SUBSCRIPTION_FIELDS)
+        # bulk_update sends no post_save, the cached subscriptions are dropped here
+        invalidate_subscriptions([user.pk for user in changed])
+    return len(changed)
+
+
+def stripe_subscriptions_by_customer():
+    """ Every subscription on Stripe grouped by customer, paged through 100 at a time """
+    subscriptions = defaultdict(list)
+    for subscription in stripe.Subscription.list(status='all', limit=100).auto_paging_iter():
+        subscriptions[subscription['customer']].append(subscription)
+    return subscriptions
+
+
+def mirror_stripe_subscriptions(subscriptions, state_time):
+    """
+    Mirrors the listed subscriptions as their state at `state_time`, taken before the listing. Rows a
+    webhook stored a newer state of meanwhile are kept, like mirror_subscription does.
+    """
+    rows = [
+        StripeSubscription(id=subscription['id'], **subscription_values(subscription, state_time))
+        for customer_subscriptions in subscriptions.values() for subscription in customer_subscriptions
+    ]
+    for chunk in chunked(rows, settings.SUBSCRIPTION_RECONCILE_BATCH_SIZE):
+        with transaction.atomic():
+            stored = dict(StripeSubscription.objects.select_for_update().filter(
+                id__in=[row.id for row in chunk]).values_list('id', 'state_time'))
+            # a row a webhook inserts meanwhile holds a newer state
+            StripeSubscription.objects.bulk_create(
+                [row for row in chunk if row.id not in stored], ignore_conflicts=True)
+            StripeSubscription.objects.bulk_update([
+                row for row in chunk
+                if row.id in stored and (stored[row.id] is None or stored[row.id] <= state_time)
+            ], MIRROR_FIELDS)
+
+
+def stripe_subscription_state(user, subscriptions):
+    """
+    Period of the active or trialing subscription ending last. Without one, an access reaching past
+    the last end of the subscriptions in a terminal status is cut to that end, like the webhook does.
+    """
+    active = [subscription for subscription in subscriptions if subscription['status'] in ACTIVE_STATUSES]
+    if active:
+        current = max(active, key=lambda subscription: subscription['current_period_end'])
+        return from_timestamp(current['current_period_start']), from_timestamp(current['current_period_end']), False
+    ended = [access_end(subscription) for subscription in subscriptions if subscription['status'] in TERMINAL_STATUSES]
+    ended = [end for end in ended if end is not None]
+    return cut_subscription(user, max(ended)) if ended else None
+
+
+def reconcile_stripe_subscriptions():
+    """
+    Mirrors every Stripe subscription and applies it to the Stripe users, returns the users updated.
+    Customers a webhook changed since the listing started keep the state the webhook applied.
+    """
+    started = timezone.now()
+    subscriptions = stripe_subscriptions_by_customer()
+    mirror_stripe_subscriptions(subscriptions, started)
+    changed_customers = set(
+        StripeSubscription.objects.filter(state_time__gt=started).values_list('customer_id', flat=True))
+
+    # users without a subscription on Stripe have nothing to reconcile, only the listed customers are read
+    updated = 0
+    for customer_ids in chunked(subscriptions, settings.SUBSCRIPTION_RECONCILE_BATCH_SIZE):
+        chunk = list(User.objects.filter(
+            subscription_source=SubscriptionSourceChoices.STRIPE.value, stripe_customer_id__in=customer_ids,
+        ).only('id', 'stripe_customer_id', *SUBSCRIPTION_FIELDS))
+        states = [
+            None if user.stripe_customer_id in changed_customers
+            else stripe_subscription_state(user, subscriptions[user.stripe_customer_id])
+            for user in chunk
+        ]
+        updated += apply_subscription_states(chunk, states)
+    return updated
+
+
+def fetch_paypal_subscription(subscription_id):
+    try:
+        return paypal_api.get_subscription(subscription_id, use_cache=False)
+    except requests.exceptions.RequestException as e:
+        print(e)
+        return None
+
+
+def paypal_subscription_state(subscription):
+    """ Billing period of an active PayPal subscription, other states keep the paid period """
+    if subscription is None or subscription.get('status') != 'ACTIVE':
+        return None
+    next_billing_time = subscription.get('billing_info', {}).get('next_billing_time')
+    if not next_billing_time:
+        return None
+    return (
+        datetime.strptime(subscription.get('start_time'), '%Y-%m-%dT%H:%M:%S%z'),
+        datetime.strptime(next_billing_time, '%Y-%m-%dT%H:%M:%S%z'),
+        False,
+    )
+
+
+def reconcile_paypal_subscriptions():
+    """
+    Applies the PayPal subscriptions of the PayPal users, returns the users updated. PayPal has no list
+    endpoint, a chunk of subscriptions is fetched in parallel over the shared keep-alive client.
+    """
+    users = User.objects.filter(
+        subscription_source=SubscriptionSourceChoices.PAYPAL.value, paypal_subscription_id__isnull=False,
+    ).only('id', 'paypal_subscription_id', *SUBSCRIPTION_FIELDS).order_by('pk')
+    updated = 0
+    with ThreadPoolExecutor(max_workers=settings.PAYPAL_RECONCILE_WORKERS) as executor:
+        for chunk in chunked(users.iterator(chunk_size=settings.SUBSCRIPTION_RECONCILE_BATCH_SIZE),
+                             settings.SUBSCRIPTION_RECONCILE_BATCH_SIZE):
+            subscriptions = executor.map(fetch_paypal_subscription, [user.paypal_subscription_id for user in chunk])
+            updated += apply_subscription_states(chunk, [paypal_subscription_state(item) for item in subscriptions])
+    return updated
@@ -7,6 +7,7 @@ import cloudinary
 import cloudinary.uploader
 import cloudinary.api
 from django.core.cache import cache
+from django.db import transaction
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
 from django.core.validators import EmailValidator
@@ -22,7 +23,7 @@ from django.contrib.auth import get_user_model
 from dj_rest_auth.registration.serializers import RegisterSerializer
 from rest_framework import serializers
 
-from .stripe_utils import create_stripe_customer
+from .tasks import provision_stripe_customer
 
 User = get_user_model()
 
@@ -141,9 +142,8 @@ class CustomRegisterSerializer(RegisterSerializer):
         )
 
     def custom_signup(self, serializer, user):
-        customer = create_stripe_customer(user.first_name + ' ' + user.last_name, user.email)
-        user.stripe_customer_id = customer.id
-        user.save()
+        user_id = str(user.pk)
+        transaction.on_commit(lambda: provision_stripe_customer.delay(user_id))
 
         return user
 
@@ -1,5 +1,7 @@
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from .models import Notification
+from .models import Notification, User
+from .subscription import invalidate_subscription
 from .views import subscription_notification
 
 
@@ -9,3 +11,10 @@ def handle_subscription(sender, **kwargs):
     message = kwargs.get('message')
     user = kwargs.get('user')
     Notification.objects.create(message=message, title=title, user=user)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def drop_cached_subscription(sender, instance, **kwargs):
+    """ Payment status, cancel and admin changes of a user reach the cached subscription at once """
+    invalidate_subscription(instance.pk)
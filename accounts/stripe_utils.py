@@ -1,36 +1,216 @@
 import stripe
 import logging
+from datetime import datetime
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.timezone import make_aware
+
+from .constants import SubscriptionSourceChoices
+from .models import StripeEvent, StripeSubscription, User
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 logger = logging.getLogger(__name__)
 
+ACTIVE_STATUSES = ('active', 'trialing')
+# statuses after which a subscription no longer grants access past its end, Stripe still retries past_due payments
+TERMINAL_STATUSES = ('canceled', 'unpaid', 'incomplete_expired')
+# trial checkouts complete without a payment
+COMPLETED_PAYMENT_STATUSES = ('paid', 'no_payment_required')
+NO_STRIPE_CUSTOMER = Q(stripe_customer_id__isnull=True) | Q(stripe_customer_id='')
+
+
+def find_stripe_customer(user_id):
+    """ Customer created earlier for a user, found by its metadata. Search lags new customers by about a minute """
+    result = stripe.Customer.search(query=f"metadata['user_id']:'{user_id}'", limit=1)
+    return result.data[0] if result.data else None
+
 
-def create_stripe_customer(name, email):
+def ensure_stripe_customer(user_id):
+    """
+    Stripe customer id of a user, created on first use. A customer already created for the user is
+    looked up first, idempotency keys expire after 24 hours. Within them the key keyed on the user id
+    makes concurrent or retried creations return the same customer instead of a duplicate.
+    """
+    user = User.objects.get(pk=user_id)
+    if user.stripe_customer_id:
+        return user.stripe_customer_id
     try:
-        customer = stripe.Customer.create(
-            email=email
-        )
-        return customer
+        customer = find_stripe_customer(user.pk)
+        if customer is None:
+            customer = stripe.Customer.create(
+                email=user.email,
+                name=f'{user.first_name} {user.last_name}',
+                metadata={'user_id': str(user.pk)},
+                idempotency_key=f'customer-{user.pk}',
+            )
+    except stripe.error.IdempotencyError:
+        # the key was first sent with the values the user had then, that request created the customer
+        customer = find_stripe_customer(user.pk)
+        if customer is None:
+            raise
     except stripe.error.StripeError as e:
-        # Log the error using the logging module
         logger.exception(f"Stripe error: {e}")
-        # Handle the error appropriately
-        if isinstance(e, stripe.error.CardError):
-            # The card has been declined
-            pass
-        elif isinstance(e, stripe.error.RateLimitError):
-            # Too many requests made to the API too quickly
-            pass
-        elif isinstance(e, stripe.error.InvalidRequestError):
-            # Invalid parameters were supplied to Stripe's API
-            pass
-        elif isinstance(e, stripe.error.AuthenticationError):
-            # Authentication with Stripe's API failed
-            pass
-        elif isinstance(e, stripe.error.APIConnectionError):
-            # Network communication with Stripe failed
-            pass
-        elif isinstance(e, stripe.error.StripeError):
-            # Something else happened, such as a problem with Stripe's servers
-            pass
+        raise
+    User.objects.filter(NO_STRIPE_CUSTOMER, pk=user.pk).update(stripe_customer_id=customer.id)
+    return User.objects.values_list('stripe_customer_id', flat=True).get(pk=user.pk)
+
+
+def from_timestamp(value):
+    return make_aware(datetime.utcfromtimestamp(value)) if value else None
+
+
+def subscription_values(subscription, state_time):
+    """ Mirror columns of a Stripe subscription object """
+    plan = subscription.get('plan')
+    return {
+        'customer_id': subscription['customer'],
+        'status': subscription['status'],
+        'plan_id': plan['id'] if plan else None,
+        'current_period_start': from_timestamp(subscription.get('current_period_start')),
+        'current_period_end': from_timestamp(subscription.get('current_period_end')),
+        'cancel_at_period_end': bool(subscription.get('cancel_at_period_end')),
+        'state_time': state_time,
+    }
+
+
+def mirror_subscription(subscription, state_time):
+    """
+    Upserts the mirror row of a Stripe subscription object holding its state at `state_time`,
+    unless a newer state was already applied.
+    """
+    values = subscription_values(subscription, state_time)
+    with transaction.atomic():
+        mirrored, created = StripeSubscription.objects.select_for_update().get_or_create(
+            id=subscription['id'], defaults=values)
+        if created or mirrored.state_time is None or mirrored.state_time <= state_time:
+            for name, value in values.items():
+                setattr(mirrored, name, value)
+            if mirrored.user_id is None:
+                mirrored.user = User.objects.filter(stripe_customer_id=mirrored.customer_id).first()
+            mirrored.save()
+    return mirrored
+
+
+def link_checkout_session(session):
+    """
+    Records which subscription a completed checkout session created. A subscription none of whose
+    events arrived yet is mirrored from Stripe first, so the linked row always carries its status.
+    """
+    if not StripeSubscription.objects.filter(id=session['subscription']).exclude(status='').exists():
+        mirror_subscription(stripe.Subscription.retrieve(session['subscription']), timezone.now())
+    mirrored = StripeSubscription.objects.get(id=session['subscription'])
+    mirrored.checkout_session_id = session['id']
+    mirrored.user = User.objects.filter(stripe_customer_id=session['customer']).first() or mirrored.user
+    mirrored.save()
+    return mirrored
+
+
+def grants_access(user, mirrored):
+    """
+    Whether an active Stripe subscription sets the access of its user: the user is on Stripe already or
+    checked the subscription out. Otherwise it would take over the access of a PayPal subscriber.
+    """
+    return user.subscription_source == SubscriptionSourceChoices.STRIPE.value or bool(mirrored.checkout_session_id)
+
+
+def apply_subscription(user, mirrored):
+    user.subscription_source = SubscriptionSourceChoices.STRIPE.value
+    user.subscription_start = mirrored.current_period_start
+    user.subscription_end = mirrored.current_period_end
+    user.free_trial = False
+    user.save()
+
+
+def access_end(subscription):
+    """ End of the access of a Stripe subscription object in a terminal status: ended_at, else its period end """
+    return from_timestamp(subscription.get('ended_at') or subscription.get('current_period_end'))
+
+
+def cut_subscription(user, ended):
+    """ (start, end, free trial) of a user whose access reaches past `ended` cut to it, None when it does not """
+    if ended and user.subscription_end and user.subscription_end > ended:
+        return user.subscription_start, ended, user.free_trial
+    return None
+
+
+def revoke_subscription(user, subscription):
+    """
+    Cuts the access of a Stripe user to the end of a subscription that reached a terminal status,
+    unless another mirrored subscription of the customer is still active or trialing.
+    """
+    if user.subscription_source != SubscriptionSourceChoices.STRIPE.value:
+        return
+    if StripeSubscription.objects.filter(
+            customer_id=subscription['customer'], status__in=ACTIVE_STATUSES).exclude(id=subscription['id']).exists():
+        return
+    state = cut_subscription(user, access_end(subscription))
+    if state is not None:
+        user.subscription_start, user.subscription_end, user.free_trial = state
+        user.save()
+
+
+def process_stripe_event(event):
+    """
+    Applies a verified webhook event to the subscription mirror, once per event id. A failing event
+    is not recorded, so the redelivery by Stripe processes it again. False for an already processed event.
+    """
+    with transaction.atomic():
+        _, created = StripeEvent.objects.get_or_create(id=event['id'], defaults={'type': event['type']})
+        if not created:
+            return False
+        data = event['data']['object']
+        if event['type'].startswith('customer.subscription.'):
+            mirrored = mirror_subscription(data, from_timestamp(event['created']))
+            if mirrored.user_id is not None and mirrored.status in ACTIVE_STATUSES:
+                if grants_access(mirrored.user, mirrored):
+                    apply_subscription(mirrored.user, mirrored)
+            elif mirrored.user_id is not None and mirrored.status in TERMINAL_STATUSES:
+                revoke_subscription(mirrored.user, data)
+        elif event['type'] == 'checkout.session.completed' and data.get('subscription'):
+            mirrored = link_checkout_session(data)
+            if mirrored.user_id is not None and mirrored.status in ACTIVE_STATUSES:
+                apply_subscription(mirrored.user, mirrored)
+    return True
+
+
+def current_subscription(customer_id):
+    """
+    Active or trialing mirrored subscription of a customer ending last. Customers without mirrored
+    subscriptions, from before the webhook, are mirrored from Stripe on first use.
+    """
+    if not customer_id:
+        return None
+    mirrored = list(StripeSubscription.objects.filter(customer_id=customer_id))
+    if not mirrored:
+        mirrored = [
+            mirror_subscription(subscription, timezone.now())
+            for subscription in stripe.Subscription.list(customer=customer_id).auto_paging_iter()
+        ]
+    active = [subscription for subscription in mirrored if subscription.status in ACTIVE_STATUSES]
+    if not active:
+        return None
+    # a row mirrored without a period sorts first
+    return max(active, key=lambda subscription: (subscription.current_period_end is not None,
+                                                 subscription.current_period_end or 0))
+
+
+def checkout_subscription(session_id, customer_id):
+    """
+    Active or trialing subscription created by a completed checkout session of the customer. Read from
+    the mirror, Stripe is only asked when the webhook events of the session have not arrived yet.
+    None for a session of another customer.
+    """
+    mirrored = StripeSubscription.objects.filter(
+        checkout_session_id=session_id, customer_id=customer_id, status__in=ACTIVE_STATUSES).first()
+    if mirrored is not None:
+        return mirrored
+    checkout_session = stripe.checkout.Session.retrieve(session_id)
+    if not customer_id or checkout_session.customer != customer_id:
+        return None
+    if checkout_session.payment_status not in COMPLETED_PAYMENT_STATUSES or not checkout_session.subscription:
+        return None
+    mirrored = mirror_subscription(stripe.Subscription.retrieve(checkout_session.subscription), timezone.now())
+    link_checkout_session(checkout_session)
+    return mirrored if mirrored.status in ACTIVE_STATUSES else None
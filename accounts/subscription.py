@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils import timezone
+
+SUBSCRIPTION_KEY = 'user_subscription:{}'
+
+
+def is_active(subscription_end):
+    return bool(subscription_end) and subscription_end >= timezone.now()
+
+
+def cached_subscription(user_id):
+    """
+    (is_active, subscription_end) of a user, shared between requests for SUBSCRIPTION_CACHE_TIMEOUT
+    seconds and dropped whenever the user is saved. None when the user does not exist.
+    """
+    key = SUBSCRIPTION_KEY.format(user_id)
+    subscription = cache.get(key)
+    if subscription is None:
+        row = get_user_model().objects.filter(id=user_id).values_list('is_active', 'subscription_end').first()
+        if row is None:
+            return None
+        subscription = row
+        cache.set(key, subscription, timeout=settings.SUBSCRIPTION_CACHE_TIMEOUT)
+    return subscription
+
+
+def invalidate_subscription(user_id):
+    cache.delete(SUBSCRIPTION_KEY.format(user_id))
+
+
+def invalidate_subscriptions(user_ids):
+    """ Drops the cached subscriptions of users changed without save(), like by bulk_update """
+    cache.delete_many([SUBSCRIPTION_KEY.format(user_id) for user_id in user_ids])
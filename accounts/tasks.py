@@ -0,0 +1,39 @@
+import stripe
+from celery import shared_task
+from django.conf import settings
+
+from .models import User
+from .reconciliation import reconcile_paypal_subscriptions, reconcile_stripe_subscriptions
+from .stripe_utils import NO_STRIPE_CUSTOMER, ensure_stripe_customer
+
+
+@shared_task
+def reconcile_subscriptions():
+    """ Brings the subscription periods of all users in line with Stripe and PayPal """
+    for provider, reconcile in (('stripe', reconcile_stripe_subscriptions), ('paypal', reconcile_paypal_subscriptions)):
+        try:
+            print(f'{provider} subscriptions reconciled, {reconcile()} users updated')
+        except Exception as e:
+            print(e)
+
+
+@shared_task(bind=True, max_retries=5, default_retry_delay=60)
+def provision_stripe_customer(self, user_id):
+    """ Creates the Stripe customer of a user outside the signup and login requests, safe to run twice """
+    try:
+        ensure_stripe_customer(user_id)
+    except User.DoesNotExist:
+        pass
+    except stripe.error.IdempotencyError as e:
+        # the same request fails the same way until the search finds the customer, the backfill retries it
+        print(e)
+    except stripe.error.StripeError as e:
+        raise self.retry(exc=e)
+
+
+@shared_task
+def backfill_stripe_customers():
+    """ Queues the customer creation of every user still without a Stripe customer """
+    user_ids = User.objects.filter(NO_STRIPE_CUSTOMER).values_list('id', flat=True)
+    for user_id in user_ids.iterator(chunk_size=settings.SUBSCRIPTION_RECONCILE_BATCH_SIZE):
+        provision_stripe_customer.delay(str(user_id))
@@ -1,6 +1,25 @@
+import hashlib
+import hmac
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
 import pytest
+import requests
+import stripe
 from django.contrib.auth import get_user_model
-from .models import User
+from rest_framework.test import APIRequestFactory, force_authenticate
+from .constants import STRIPE_SUBSCRIPTION_SUCCESS_MESSAGE
+from .models import StripeEvent, StripeSubscription, User
+from . import reconciliation
+from .paypal_utils import PayPalAPI, paypal_api
+from .reconciliation import reconcile_paypal_subscriptions, reconcile_stripe_subscriptions
+from .stripe_utils import checkout_subscription
+from .subscription import cached_subscription
+from .tasks import backfill_stripe_customers, provision_stripe_customer
+from .views import GetSubscriptionView, StripePaymentStatusView, StripeWebhookView
 import json
 from django.test import Client
 
@@ -39,3 +58,347 @@ def test_user_string_representation():
 
     # Check that the string representation of the user is the name
     assert str(user) == "Test User"
+
+
+WEBHOOK_SECRET = 'whsec_test'
+CHECKOUT_SESSION_COMPLETED = {
+    "id": "evt_1NCheckout", "object": "event", "type": "checkout.session.completed", "created": 1696154400,
+    "data": {"object": {
+        "id": "cs_test_a1", "object": "checkout.session", "customer": "cus_Test", "mode": "subscription",
+        "payment_status": "no_payment_required", "status": "complete", "subscription": "sub_Test",
+    }},
+}
+SUBSCRIPTION_CREATED = {
+    "id": "evt_1NCreated", "object": "event", "type": "customer.subscription.created", "created": 1696154401,
+    "data": {"object": {
+        "id": "sub_Test", "object": "subscription", "customer": "cus_Test", "status": "trialing",
+        "cancel_at_period_end": False, "current_period_start": 1696154400, "current_period_end": 4102444800,
+        "plan": {"id": "price_Monthly", "object": "plan", "interval": "month"},
+    }},
+}
+SUBSCRIPTION_UPDATED_EARLIER = {
+    "id": "evt_1NUpdated", "object": "event", "type": "customer.subscription.updated", "created": 1696154300,
+    "data": {"object": dict(SUBSCRIPTION_CREATED["data"]["object"], status="incomplete")},
+}
+SUBSCRIPTION_DELETED = {
+    "id": "evt_1NDeleted", "object": "event", "type": "customer.subscription.deleted", "created": 1696240800,
+    "data": {"object": dict(SUBSCRIPTION_CREATED["data"]["object"], status="canceled", ended_at=1696240800)},
+}
+
+
+def post_stripe_event(event, secret=WEBHOOK_SECRET):
+    body = json.dumps(event)
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f'{timestamp}.{body}'.encode(), hashlib.sha256).hexdigest()
+    request = APIRequestFactory().post('/stripe/webhook/', body, content_type='application/json',
+                                       HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}')
+    return StripeWebhookView.as_view()(request)
+
+
+def stripe_subscription(event):
+    return stripe.Subscription.construct_from(event["data"]["object"], 'sk_test')
+
+
+def test_stripe_webhook_mirrors_subscriptions_once(settings, monkeypatch):
+    settings.STRIPE_WEBHOOK_SECRET = WEBHOOK_SECRET
+    # the session arrives first, its subscription is mirrored from Stripe
+    monkeypatch.setattr(stripe.Subscription, 'retrieve', lambda _: stripe_subscription(SUBSCRIPTION_CREATED))
+    user = User.objects.create_user(email="test@example.com", name="Test User", password="password",
+                                    stripe_customer_id="cus_Test")
+
+    responses = [post_stripe_event(event) for event in (
+        CHECKOUT_SESSION_COMPLETED, SUBSCRIPTION_CREATED, SUBSCRIPTION_CREATED, SUBSCRIPTION_UPDATED_EARLIER)]
+
+    subscription = StripeSubscription.objects.get()
+    user.refresh_from_db()
+    assert [response.data['duplicate'] for response in responses] == [False, False, True, False]
+    assert (subscription.id, subscription.status, subscription.plan_id) == ("sub_Test", "trialing", "price_Monthly")
+    assert subscription.user == user and subscription.checkout_session_id == "cs_test_a1"
+    assert user.subscription_end == subscription.current_period_end and not user.free_trial
+    assert StripeEvent.objects.count() == 3
+    assert post_stripe_event(SUBSCRIPTION_CREATED, secret='whsec_other').status_code == 400
+
+
+def test_stripe_webhook_cuts_the_access_of_an_ended_subscription(settings):
+    settings.STRIPE_WEBHOOK_SECRET = WEBHOOK_SECRET
+    user = User.objects.create_user(email="test@example.com", name="Test User", password="password",
+                                    stripe_customer_id="cus_Test")
+    post_stripe_event(SUBSCRIPTION_CREATED)
+
+    post_stripe_event(SUBSCRIPTION_DELETED)
+
+    user.refresh_from_db()
+    assert StripeSubscription.objects.get().status == "canceled"
+    assert user.subscription_end == datetime.fromtimestamp(1696240800, timezone.utc)
+    assert cached_subscription(user.pk) == (True, user.subscription_end)
+
+
+def test_stripe_events_keep_the_access_of_paypal_subscribers_until_checkout(settings):
+    settings.STRIPE_WEBHOOK_SECRET = WEBHOOK_SECRET
+    paypal_end = datetime(2030, 1, 1, tzinfo=timezone.utc)
+    user = User.objects.create_user(email="test@example.com", name="Test User", password="password",
+                                    stripe_customer_id="cus_Test", subscription_source="Paypal",
+                                    subscription_end=paypal_end)
+
+    post_stripe_event(SUBSCRIPTION_CREATED)
+    user.refresh_from_db()
+    assert (user.subscription_source, user.subscription_end) == ("Paypal", paypal_end)
+
+    post_stripe_event(CHECKOUT_SESSION_COMPLETED)
+    user.refresh_from_db()
+    assert user.subscription_source == "Stripe"
+    assert user.subscription_end == datetime.fromtimestamp(4102444800, timezone.utc)
+
+
+def test_checkout_sessions_of_other_customers_are_not_applied(monkeypatch):
+    def no_subscription_calls(*args, **kwargs):
+        raise AssertionError('the subscription of a foreign session was fetched')
+
+    session = stripe.checkout.Session.construct_from(CHECKOUT_SESSION_COMPLETED["data"]["object"], 'sk_test')
+    monkeypatch.setattr(stripe.checkout.Session, 'retrieve', lambda session_id: session)
+    monkeypatch.setattr(stripe.Subscription, 'retrieve', no_subscription_calls)
+
+    assert checkout_subscription("cs_test_a1", "cus_Other") is None
+    assert checkout_subscription("cs_test_a1", None) is None
+    assert not StripeSubscription.objects.exists()
+
+
+def test_subscription_reads_are_served_from_the_mirror(settings, monkeypatch):
+    def no_stripe_calls(*args, **kwargs):
+        raise AssertionError('Stripe was called')
+
+    settings.STRIPE_WEBHOOK_SECRET = WEBHOOK_SECRET
+    user = User.objects.create_user(email="test@example.com", name="Test User", password="password",
+                                    stripe_customer_id="cus_Test")
+    monkeypatch.setattr(stripe.Subscription, 'list', no_stripe_calls)
+    monkeypatch.setattr(stripe.Subscription, 'retrieve', no_stripe_calls)
+    monkeypatch.setattr(stripe.checkout.Session, 'retrieve', no_stripe_calls)
+    post_stripe_event(SUBSCRIPTION_CREATED)
+    post_stripe_event(CHECKOUT_SESSION_COMPLETED)
+
+    request = APIRequestFactory().get('/current-subscription/')
+    force_authenticate(request, user=user)
+    current = GetSubscriptionView.as_view()(request)
+    request = APIRequestFactory().post('/stripe/payment/status/', {'session_id': 'cs_test_a1', 'product_name': 'Pro'})
+    force_authenticate(request, user=user)
+    payment_status = StripePaymentStatusView.as_view()(request)
+
+    assert current.data['subscription_id'] == "sub_Test" and current.data['status'] == "trialing"
+    assert current.data['current_subscription_end'] == 4102444800 and current.data['plan_id'] == "price_Monthly"
+    assert payment_status.data['message'] == STRIPE_SUBSCRIPTION_SUCCESS_MESSAGE.format('Pro')
+
+
+def test_a_mirrored_subscription_without_a_period_is_answered():
+    user = User.objects.create_user(email="test@example.com", name="Test User", password="password",
+                                    stripe_customer_id="cus_Test")
+    StripeSubscription.objects.create(id="sub_Test", customer_id="cus_Test", status="active")
+
+    request = APIRequestFactory().get('/current-subscription/')
+    force_authenticate(request, user=user)
+    current = GetSubscriptionView.as_view()(request)
+
+    assert current.status_code == 200 and current.data['current_subscription_end'] is None
+
+
+def test_paypal_subscriptions_are_answered_with_their_status_and_plan(monkeypatch):
+    subscriptions = {
+        "I-TRIAL": {"status": "ACTIVE", "plan_id": "P-MONTHLY", "start_time": "2023-10-01T00:00:00Z",
+                    "billing_info": {"outstanding_balance": {"value": "0.0"},
+                                     "next_billing_time": "2023-10-08T00:00:00Z"}},
+        "I-PAID": {"status": "CANCELLED", "plan_id": "P-YEARLY", "start_time": "2023-01-01T00:00:00Z",
+                   "billing_info": {"outstanding_balance": {"value": "9.99"}, "next_billing_time": None}},
+    }
+    monkeypatch.setattr(paypal_api, 'get_subscription', lambda subscription_id: subscriptions[subscription_id])
+
+    responses = []
+    for index, subscription_id in enumerate(("I-TRIAL", "I-PAID", None)):
+        user = User.objects.create_user(email=f"paypal{index}@example.com", name="PayPal", password="password",
+                                        subscription_source="Paypal", paypal_subscription_id=subscription_id)
+        request = APIRequestFactory().get('/current-subscription/')
+        force_authenticate(request, user=user)
+        responses.append(GetSubscriptionView.as_view()(request))
+
+    assert (responses[0].data['status'], responses[0].data['plan_id']) == ("trialing", "P-MONTHLY")
+    assert (responses[1].data['status'], responses[1].data['plan_id']) == ("CANCELLED", "P-YEARLY")
+    assert responses[2].status_code == 204
+
+
+class FakePayPalResponse:
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(response=self)
+
+
+def test_paypal_client_reuses_its_token_and_subscriptions(monkeypatch):
+    api = PayPalAPI()
+    calls = []
+    tokens = []
+
+    def post(url, **kwargs):
+        calls.append('token')
+        tokens.append(f'token-{len(tokens) + 1}')
+        return FakePayPalResponse(200, {'access_token': tokens[-1], 'expires_in': 32400})
+
+    def request(method, url, headers=None, **kwargs):
+        calls.append(f'{method} {url.rsplit("/", 1)[-1]} {headers["Authorization"]}')
+        if headers['Authorization'] == 'Bearer token-1' and method == 'POST':
+            return FakePayPalResponse(401, {})
+        return FakePayPalResponse(200, {'id': 'I-SUB', 'status': 'ACTIVE'})
+
+    monkeypatch.setattr(api.session, 'post', post)
+    monkeypatch.setattr(api.session, 'request', request)
+
+    subscriptions = [api.get_subscription('I-SUB'), api.get_subscription('I-SUB')]
+    api.cancel_subscription('I-SUB', 'cancel subscription')
+    api.get_subscription('I-SUB')
+
+    assert subscriptions == [{'id': 'I-SUB', 'status': 'ACTIVE'}] * 2
+    assert calls == [
+        'token', 'GET I-SUB Bearer token-1', 'POST cancel Bearer token-1', 'token', 'POST cancel Bearer token-2',
+        'GET I-SUB Bearer token-2',
+    ]
+
+
+class ProviderStubHandler(BaseHTTPRequestHandler):
+    """ Local stand in for the Stripe and PayPal endpoints the reconciliation pages through """
+    stripe_pages = {
+        None: {"object": "list", "url": "/v1/subscriptions", "has_more": True, "data": [
+            {"id": "sub_A", "object": "subscription", "customer": "cus_A", "status": "active",
+             "current_period_start": 1696154400, "current_period_end": 4102444800, "plan": None},
+        ]},
+        "sub_A": {"object": "list", "url": "/v1/subscriptions", "has_more": False, "data": [
+            {"id": "sub_B", "object": "subscription", "customer": "cus_B", "status": "canceled",
+             "current_period_start": 1696154400, "current_period_end": 1698832800, "ended_at": 1697000000,
+             "plan": None},
+            {"id": "sub_C", "object": "subscription", "customer": "cus_C", "status": "active",
+             "current_period_start": 1696154400, "current_period_end": 4102444800, "plan": None},
+        ]},
+    }
+    paypal_subscriptions = {
+        "I-ACTIVE": {"id": "I-ACTIVE", "status": "ACTIVE", "start_time": "2023-10-01T10:00:00Z",
+                     "billing_info": {"next_billing_time": "2100-01-01T00:00:00Z"}},
+    }
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/v1/subscriptions':
+            return self.reply(200, self.stripe_pages[parse_qs(url.query).get('starting_after', [None])[0]])
+        subscription = self.paypal_subscriptions.get(url.path.rsplit('/', 1)[-1])
+        self.reply(200 if subscription else 404, subscription or {'message': 'not found'})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply(200, {'access_token': 'stub-token', 'expires_in': 32400})
+
+    def reply(self, status_code, data):
+        body = json.dumps(data).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_reconciliation_applies_provider_subscriptions_in_bulk(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ProviderStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub_url = f'http://127.0.0.1:{server.server_port}'
+    monkeypatch.setattr(stripe, 'api_base', stub_url)
+    # a client of its own, the stub token must not stay cached on the shared one
+    api = PayPalAPI()
+    api.PAYPAL_BASE_URL = stub_url
+    monkeypatch.setattr(reconciliation, 'paypal_api', api)
+    now = datetime.now(timezone.utc)
+
+    def create_user(email, **fields):
+        return User.objects.create_user(email=email, name=email, password="password", **fields)
+
+    renewed = create_user("renewed@example.com", stripe_customer_id="cus_A", subscription_end=now)
+    canceled = create_user("canceled@example.com", stripe_customer_id="cus_B",
+                           subscription_end=now + timedelta(days=20), free_trial=False)
+    paypal = create_user("paypal@example.com", subscription_source="Paypal", paypal_subscription_id="I-ACTIVE")
+    unknown = create_user("unknown@example.com", subscription_source="Paypal", paypal_subscription_id="I-GONE")
+    # a webhook applied a newer state of sub_C while the listing was paged through
+    webhooked = create_user("webhooked@example.com", stripe_customer_id="cus_C",
+                            subscription_end=now + timedelta(days=3))
+    StripeSubscription.objects.create(id="sub_C", customer_id="cus_C", status="past_due",
+                                      state_time=now + timedelta(hours=1))
+    cached_subscription(renewed.pk)
+    try:
+        updated = reconcile_stripe_subscriptions(), reconcile_paypal_subscriptions()
+    finally:
+        server.shutdown()
+
+    for user in (renewed, canceled, paypal, unknown, webhooked):
+        user.refresh_from_db()
+    assert updated == (2, 1)
+    assert renewed.subscription_end == datetime(2100, 1, 1, tzinfo=timezone.utc) and not renewed.free_trial
+    assert canceled.subscription_end == datetime.fromtimestamp(1697000000, timezone.utc)
+    assert paypal.subscription_end == datetime(2100, 1, 1, tzinfo=timezone.utc)
+    assert unknown.subscription_end is None and unknown.free_trial
+    assert cached_subscription(renewed.pk)[1] == renewed.subscription_end
+    assert webhooked.subscription_end == now + timedelta(days=3)
+    assert set(StripeSubscription.objects.values_list('id', 'status')) == {
+        ('sub_A', 'active'), ('sub_B', 'canceled'), ('sub_C', 'past_due'),
+    }
+    assert paypal_api._access_token != 'stub-token'
+
+
+def test_stripe_customers_are_provisioned_once_off_the_request(monkeypatch):
+    created = []
+    queued = []
+
+    stripe_customers = {}
+
+    def create_customer(**kwargs):
+        created.append(kwargs)
+        if kwargs['email'] == 'renamed@example.com':
+            raise stripe.error.IdempotencyError('Keys can only be used with the same parameters')
+        return stripe.Customer.construct_from({'id': f'cus_{len(created)}'}, 'sk_test')
+
+    def search_customers(query, limit):
+        customers = [customer for user_id, customer in stripe_customers.items() if f"'{user_id}'" in query]
+        return stripe.SearchResultObject.construct_from({'object': 'search_result', 'data': customers}, 'sk_test')
+
+    monkeypatch.setattr(stripe.Customer, 'create', create_customer)
+    monkeypatch.setattr(stripe.Customer, 'search', search_customers)
+    monkeypatch.setattr(provision_stripe_customer, 'delay', queued.append)
+    user = User.objects.create_user(email="test@example.com", first_name="Test", last_name="User", password="password")
+    User.objects.create_user(email="existing@example.com", name="Existing", password="password",
+                             stripe_customer_id="cus_existing")
+
+    backfill_stripe_customers()
+    for user_id in queued:
+        provision_stripe_customer(user_id)
+    provision_stripe_customer(str(user.pk))
+
+    user.refresh_from_db()
+    assert queued == [str(user.pk)] and user.stripe_customer_id == 'cus_1'
+    assert created == [{
+        'email': 'test@example.com', 'name': 'Test User', 'metadata': {'user_id': str(user.pk)},
+        'idempotency_key': f'customer-{user.pk}',
+    }]
+
+    # created by a run whose idempotency key expired since, or sent with the values before a rename
+    recreated = User.objects.create_user(email="recreated@example.com", name="Recreated", password="password")
+    renamed = User.objects.create_user(email="renamed@example.com", name="Renamed", password="password")
+    stripe_customers[str(recreated.pk)] = {'id': 'cus_recreated'}
+    provision_stripe_customer(str(recreated.pk))
+    provision_stripe_customer(str(renamed.pk))
+    stripe_customers[str(renamed.pk)] = {'id': 'cus_renamed'}
+    provision_stripe_customer(str(renamed.pk))
+
+    recreated.refresh_from_db()
+    renamed.refresh_from_db()
+    assert (recreated.stripe_customer_id, renamed.stripe_customer_id) == ('cus_recreated', 'cus_renamed')
+    assert [customer['email'] for customer in created] == ['test@example.com', 'renamed@example.com']
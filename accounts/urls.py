@@ -11,7 +11,8 @@ from .views import (UserProfileView,
                     CheckoutSessionView, CancelSubscriptionView,
                     NotificationListView, StripePaymentStatusView,
                     NotificationAllReadUpdateView, NotificationReadUpdateView,
-                    PaypalPaymentStatusView, GetSubscriptionView, SubscriptionPlansEnvView)
+                    PaypalPaymentStatusView, GetSubscriptionView, SubscriptionPlansEnvView,
+                    StripeWebhookView)
 
 
 urlpatterns = [
@@ -38,6 +39,7 @@ urlpatterns = [
     # path('stripe/cards/', StripeCardsView.as_view(), name='stripe_cards'),
     # path('stripe/primary-card/', SetPrimaryCardView.as_view(), name='stripe_primary_card'),
     path('stripe/payment/status/', StripePaymentStatusView.as_view(), name='stripe_payment_status'),
+    path('stripe/webhook/', StripeWebhookView.as_view(), name='stripe_webhook'),
     path('notifications_1/', NotificationListView.as_view(), name='notification-list'),
     path('notifications_2/<str:filter_value>/', NotificationListView.as_view(), name='filtered-notification-list'),
     path('notifications/read/<uuid:notification_id>/',
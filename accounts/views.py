@@ -6,9 +6,11 @@ import stripe as stripe
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.mail import send_mail
+from django.db import transaction
 import random
 from datetime import datetime
-from django.utils.timezone import make_aware, utc
+from django.utils import timezone
+from django.utils.timezone import utc
 from drf_spectacular.utils import extend_schema
 from rest_framework.pagination import LimitOffsetPagination
 from rest_framework_simplejwt.authentication import JWTAuthentication
@@ -21,14 +23,16 @@ from .constants import SourceChoices, INVALID_PASSWORD_ERROR, PASSWORD_UPDATE_SU
     STRIPE_TRAIL_PERIOD, STRIPE_CANCEL_SUBSCRIPTION_MESSAGE, STRIPE_NO_SUBSCRIPTION_MESSAGE, \
     STRIPE_SUBSCRIPTION_SUCCESS_MESSAGE, STRIPE_SUBSCRIPTION_FAILURE_MESSAGE, STRIPE_SUBSCRIPTION_FAILURE_TITLE, \
     STRIPE_SUBSCRIPTION_SUCCESS_TITLE, NOTIFICATION_NOT_EXIST, NOTIFICATION_SINGLE_READ, \
-    NO_UNREAD_NOTIFICATIONS, ALL_NOTIFICATIONS_MARKED_READ, SubscriptionSourceChoices
+    NO_UNREAD_NOTIFICATIONS, ALL_NOTIFICATIONS_MARKED_READ, SubscriptionSourceChoices, \
+    STRIPE_WEBHOOK_NOT_CONFIGURED_ERROR
 from .errors import InvalidAccessTokenOrInvalidIDToken, InvalidAccessToken, InvalidIDToken, DuplicateEmail
 from .models import CryptoExchangeApiKey, Notification
 from rest_framework import generics, serializers
 from rest_framework import permissions
 from rest_framework.response import Response
 
-from .paypal_utils import PayPalAPI
+from .paypal_utils import paypal_api
+from .tasks import provision_stripe_customer
 from .serializers import UserProfileSerializer, ApiKeySerializer, ResetPasswordSerializer, ForgotPasswordSerializer, \
     ChangePasswordSerializer, CustomRegisterSerializer, CheckoutSessionSerializer, CancelSubscriptionSerializer, \
     CardIdSerializer, NotificationSerializer, NotificationReadSerializer, StripePaymentStatusSerializer, \
@@ -42,7 +46,8 @@ from allauth.socialaccount.providers.oauth2.client import OAuth2Client
 from dj_rest_auth.registration.views import SocialLoginView, RegisterView
 from rest_framework.views import APIView
 
-from .stripe_utils import create_stripe_customer
+from .stripe_utils import ensure_stripe_customer, current_subscription, checkout_subscription, apply_subscription, \
+    mirror_subscription, process_stripe_event
 
 User = get_user_model()
 
@@ -110,9 +115,10 @@ class GoogleLogin(SocialLoginView):
             user = User.objects.get(email=response.data.get('user').get('email'))
             user.name = f"{response.data.get('user').get('first_name')} {response.data.get('user').get('last_name')}"
             user.source = SourceChoices.GOOGLE.value
-            customer = create_stripe_customer(user.first_name + ' ' + user.last_name, user.email)
-            user.stripe_customer_id = customer.id
             user.save()
+            if not user.stripe_customer_id:
+                user_id = str(user.pk)
+                transaction.on_commit(lambda: provision_stripe_customer.delay(user_id))
             return response
         except Exception as e:
             if "Invalid id_token" in str(e):
@@ -146,9 +152,10 @@ class FacebookLogin(SocialLoginView):
             user = User.objects.get(email=response.data.get('user').get('email'))
             user.name = f"{response.data.get('user').get('first_name')} {response.data.get('user').get('last_name')}"
             user.source = SourceChoices.FACEBOOK.value
-            customer = create_stripe_customer(user.first_name + ' ' + user.last_name, user.email)
-            user.stripe_customer_id = customer.id
             user.save()
+            if not user.stripe_customer_id:
+                user_id = str(user.pk)
+                transaction.on_commit(lambda: provision_stripe_customer.delay(user_id))
             return response
         except Exception as e:
             if "Invalid access token" in str(e):
@@ -306,7 +313,8 @@ class CheckoutSessionView(APIView):
 
         try:
             user = request.user
-            customer_id = user.stripe_customer_id
+            # the customer is normally provisioned after signup, at the latest it is created here
+            customer_id = user.stripe_customer_id or ensure_stripe_customer(user.pk)
             price_id = request.data.get('price_id')
             success_url = request.data.get('success_url')
             failure_url = request.data.get('failure_url')
@@ -363,7 +371,7 @@ class CancelSubscriptionView(APIView):
         if user.subscription_source == SubscriptionSourceChoices.STRIPE.value:
             try:
                 subscription = stripe.Subscription.retrieve(subscription_id)
-                subscription.delete()
+                mirror_subscription(subscription.delete(), timezone.now())
                 subscription_notification.send(sender=self.__class__, title='subscription',
                                                message=STRIPE_CANCEL_SUBSCRIPTION_MESSAGE.format(product_name),
                                                user=request.user)
@@ -373,7 +381,6 @@ class CancelSubscriptionView(APIView):
                 return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         elif user.subscription_source == SubscriptionSourceChoices.PAYPAL.value:
-            paypal_api = PayPalAPI()
             try:
                 response_data = paypal_api.cancel_subscription(subscription_id, 'cancel subscription')
                 subscription_notification.send(sender=self.__class__, title='subscription',
@@ -389,6 +396,10 @@ class CancelSubscriptionView(APIView):
             return Response({"error": "Invalid subscription source."}, status=status.HTTP_400_BAD_REQUEST)
 
 
+def epoch_seconds(value):
+    return int(value.timestamp()) if value else None
+
+
 class GetSubscriptionView(APIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
@@ -399,32 +410,30 @@ class GetSubscriptionView(APIView):
 
         if user.subscription_source == SubscriptionSourceChoices.STRIPE.value:
             try:
-                customer_id = user.stripe_customer_id
-                subscriptions = stripe.Subscription.list(customer=customer_id)
-                current_subscription = next(subscription for subscription in subscriptions if
-                                            subscription.status == 'active' or subscription.status == 'trialing')
+                subscription = current_subscription(user.stripe_customer_id)
+                if subscription is None:
+                    return Response({"message": STRIPE_NO_SUBSCRIPTION_MESSAGE}, status=status.HTTP_204_NO_CONTENT)
                 return Response({
-                    "subscription_id": current_subscription.id,
-                    "status": current_subscription.status,
-                    "current_subscription_start": current_subscription.current_period_start,
-                    "current_subscription_end": current_subscription.current_period_end,
-                    "plan_id": current_subscription.get('plan').stripe_id if current_subscription.get(
-                        'plan') else None,
+                    "subscription_id": subscription.id,
+                    "status": subscription.status,
+                    "current_subscription_start": epoch_seconds(subscription.current_period_start),
+                    "current_subscription_end": epoch_seconds(subscription.current_period_end),
+                    "plan_id": subscription.plan_id,
                     "subscription_source": user.subscription_source,
                 })
-            except StopIteration:
-                return Response({"message": STRIPE_NO_SUBSCRIPTION_MESSAGE}, status=status.HTTP_204_NO_CONTENT)
             except Exception as e:
                 return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
         elif user.subscription_source == SubscriptionSourceChoices.PAYPAL.value:
             subscription_id = user.paypal_subscription_id
-            paypal_api = PayPalAPI()
+            if not subscription_id:
+                return Response({"message": STRIPE_NO_SUBSCRIPTION_MESSAGE}, status=status.HTTP_204_NO_CONTENT)
             try:
+                # served by the shared client's subscription cache, PayPal is asked at most once per timeout
                 response_data = paypal_api.get_subscription(subscription_id)
                 price = float(response_data.get('billing_info').get('outstanding_balance').get('value'))
                 return Response({
-                    "subscription_id": user.paypal_subscription_id,
+                    "subscription_id": subscription_id,
                     "status": response_data.get('status') if price > 0 else 'trialing',
                     "current_subscription_start": response_data.get('start_time'),
                     "current_subscription_end": response_data.get('billing_info').get('next_billing_time'),
@@ -446,23 +455,13 @@ class StripePaymentStatusView(APIView):
 
         session_id = request.data.get('session_id')
         product_name = request.data.get('product_name')
-        checkout_session = stripe.checkout.Session.retrieve(session_id)
         user = request.user
-        if checkout_session.payment_status == 'paid':
+        subscription = checkout_subscription(session_id, user.stripe_customer_id)
+        if subscription is not None:
             subscription_notification.send(sender=self.__class__, title=STRIPE_SUBSCRIPTION_SUCCESS_TITLE,
                                            message=STRIPE_SUBSCRIPTION_SUCCESS_MESSAGE.format(product_name),
                                            user=request.user)
-
-            customer_id = user.stripe_customer_id
-            subscriptions = stripe.Subscription.list(customer=customer_id)
-            current_subscription = next(subscription for subscription in subscriptions if
-                                        subscription.status == 'active' or subscription.status == 'trialing')
-
-            user.subscription_source = SubscriptionSourceChoices.STRIPE.value
-            user.subscription_start = make_aware(datetime.utcfromtimestamp(current_subscription.current_period_start))
-            user.subscription_end = make_aware(datetime.utcfromtimestamp(current_subscription.current_period_end))
-            user.free_trial = False
-            user.save()
+            apply_subscription(user, subscription)
             return Response({'message': STRIPE_SUBSCRIPTION_SUCCESS_MESSAGE.format(product_name)},
                             status=status.HTTP_200_OK)
         else:
@@ -473,6 +472,24 @@ class StripePaymentStatusView(APIView):
                             status=status.HTTP_200_OK)
 
 
+class StripeWebhookView(APIView):
+    """ Verifies the signature of Stripe webhook events and applies them to the subscription mirror """
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+    throttle_classes = []
+
+    def post(self, request):
+        if not settings.STRIPE_WEBHOOK_SECRET:
+            return Response({'error': STRIPE_WEBHOOK_NOT_CONFIGURED_ERROR}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        try:
+            event = stripe.Webhook.construct_event(
+                request.body, request.META.get('HTTP_STRIPE_SIGNATURE', ''), settings.STRIPE_WEBHOOK_SECRET)
+        except (ValueError, stripe.error.SignatureVerificationError) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        processed = process_stripe_event(event)
+        return Response({'received': True, 'duplicate': not processed})
+
+
 class DescendingOffsetPagination(LimitOffsetPagination):
     default_limit = 10
     max_limit = 100
@@ -555,9 +572,8 @@ class PaypalPaymentStatusView(APIView):
     def post(self, request):
         subscription_id = request.data.get('subscription_id')
         product_name = request.data.get('product_name')
-        paypal_api = PayPalAPI()
         try:
-            response_data = paypal_api.get_subscription(subscription_id)
+            response_data = paypal_api.get_subscription(subscription_id, use_cache=False)
             if response_data.get('status') == 'ACTIVE':
                 user = request.user
                 user.paypal_payer_id = response_data.get('subscriber').get('payer_id')
@@ -1,3 +1,4 @@
+from django.core.cache import cache
 from rest_framework.test import APIClient
 import pytest
 import django
@@ -11,6 +12,13 @@ def enable_db_access_for_all_tests(db):
     pass
 
 
+@pytest.fixture(autouse=True)
+def local_cache(settings):
+    """ Tests read and clear a per process cache, never the configured shared one """
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+
+
 @pytest.fixture
 def client():
     django.setup()
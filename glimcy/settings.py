@@ -298,6 +298,43 @@ CLOUDINARY_URL = env('CLOUDINARY_URL')
 # opensea
 API_KEY = env('OPENSEA_api_key')
 API_KEY_HISTORICAL = env('OPENSEA_API_KEY_HISTORICAL')
+# number of nft links fetched in parallel and handed to the parser per batch
+OPENSEA_FETCH_CONCURRENCY = env.int('OPENSEA_FETCH_CONCURRENCY', default=16)
+OPENSEA_FETCH_BATCH_SIZE = env.int('OPENSEA_FETCH_BATCH_SIZE', default=100)
+NFT_SALE_EVENTS_BATCH_SIZE = env.int('NFT_SALE_EVENTS_BATCH_SIZE', default=1000)
+NFT_WRITE_BATCH_SIZE = env.int('NFT_WRITE_BATCH_SIZE', default=100)
+
+# refresh cycle: one shard per worker process, a shard lease is renewed after every fetch batch
+NFT_REFRESH_WORKERS = env.int('NFT_REFRESH_WORKERS', default=3)
+NFT_REFRESH_SHARD_LEASE = env.int('NFT_REFRESH_SHARD_LEASE', default=900)
+# priority refresh: nfts refreshed per update_old run, and the minimum seconds between two refreshes
+NFT_REFRESH_BUDGET = env.int('NFT_REFRESH_BUDGET', default=500)
+NFT_REFRESH_MIN_AGE = env.int('NFT_REFRESH_MIN_AGE', default=900)
+# seconds after which the update_old lock of a killed run expires
+NFT_REFRESH_OLD_LOCK_TIMEOUT = env.int('NFT_REFRESH_OLD_LOCK_TIMEOUT', default=1800)
+
+# seconds a filtered nft list count is reused by cursor pagination
+NFT_LIST_COUNT_CACHE_TIMEOUT = env.int('NFT_LIST_COUNT_CACHE_TIMEOUT', default=60)
+# nft list responses are also dropped by any parser write, this only bounds their lifetime
+NFT_LIST_CACHE_TIMEOUT = env.int('NFT_LIST_CACHE_TIMEOUT', default=600)
+NFT_FREE_TIER_SNAPSHOT_TIMEOUT = env.int('NFT_FREE_TIER_SNAPSHOT_TIMEOUT', default=86400)
+# minimum seconds between two free tier snapshot rebuilds of parse runs
+NFT_FREE_TIER_REBUILD_INTERVAL = env.int('NFT_FREE_TIER_REBUILD_INTERVAL', default=60)
+# rows fetched per server side cursor round trip by the nft export
+NFT_EXPORT_CHUNK_SIZE = env.int('NFT_EXPORT_CHUNK_SIZE', default=2000)
+# seconds the subscription end of a user is reused by the token authentication, saving the user drops it
+SUBSCRIPTION_CACHE_TIMEOUT = env.int('SUBSCRIPTION_CACHE_TIMEOUT', default=300)
+# the paypal access token is refreshed this many seconds before it expires
+PAYPAL_TOKEN_EXPIRY_MARGIN = env.int('PAYPAL_TOKEN_EXPIRY_MARGIN', default=300)
+PAYPAL_SUBSCRIPTION_CACHE_TIMEOUT = env.int('PAYPAL_SUBSCRIPTION_CACHE_TIMEOUT', default=60)
+# users per bulk_update of the subscription reconciliation, and paypal subscriptions fetched in parallel
+SUBSCRIPTION_RECONCILE_BATCH_SIZE = env.int('SUBSCRIPTION_RECONCILE_BATCH_SIZE', default=500)
+PAYPAL_RECONCILE_WORKERS = env.int('PAYPAL_RECONCILE_WORKERS', default=4)
+
+# historical ticker prices
+HISTORY_PRICE_LRU_SIZE = env.int('HISTORY_PRICE_LRU_SIZE', default=4096)
+# prices of days that are not over yet are refreshed after this many seconds
+HISTORY_PRICE_TODAY_TIMEOUT = env.int('HISTORY_PRICE_TODAY_TIMEOUT', default=3600)
 
 # block_daemon
 BLOCK_DAEMON_API_KEY = env('BLOCK_DAEMON_API_KEY')
@@ -314,6 +351,7 @@ if DEBUG:
     # stripe
     STRIPE_SECRET_KEY = env('STRIPE_SECRET_KEY')
     STRIPE_API_VERSION = env('STRIPE_API_VERSION')
+    STRIPE_WEBHOOK_SECRET = env('STRIPE_WEBHOOK_SECRET', default='')
 
     # paypal
     PAYPAL_CLIENT_ID = env('PAYPAL_CLIENT_ID')
@@ -330,10 +368,13 @@ if DEBUG:
     CELERY_BROKER_URL = env('REDIS_URL')
     CELERY_RESULT_BACKEND = env('REDIS_URL')
 
+    REDIS_CACHE_URL = env('REDIS_URL')
+
 else:
     # stripe
     STRIPE_SECRET_KEY = env('LIVE_STRIPE_SECRET_KEY')
     STRIPE_API_VERSION = env('STRIPE_API_VERSION')
+    STRIPE_WEBHOOK_SECRET = env('LIVE_STRIPE_WEBHOOK_SECRET', default='')
 
     # paypal
     PAYPAL_CLIENT_ID = env('LIVE_PAYPAL_CLIENT_ID')
@@ -350,3 +391,14 @@ else:
     CELERY_BROKER_URL = env('LIVE_REDIS_URL')
     CELERY_RESULT_BACKEND = env('LIVE_REDIS_URL')
 
+    REDIS_CACHE_URL = env('LIVE_REDIS_URL')
+
+# cache shared by web and worker processes, heroku redis uses self-signed certificates like for celery
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_CACHE_URL,
+        'OPTIONS': {'ssl_cert_reqs': None} if REDIS_CACHE_URL.startswith('rediss://') else {},
+    }
+}
+
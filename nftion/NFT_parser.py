@@ -1,35 +1,31 @@
-import json
-
-import requests
 from bs4 import BeautifulSoup
 import datetime
 
 from lxml import etree
 
-from collections import OrderedDict
 import os
 import django
 
 from django.conf import settings
 
-from .models import HistoryPrice
+from .event_columns import SaleAggregates, SaleEventColumns, cut_decimals, to_timestamp
+from .models import OFFER_AVAILABLE
+from .opensea_fetcher import fetch_events, fetch_page, split_nft_link
+from .price_cache import history_prices
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "nftion.settings")
 django.setup()
 
-headers = {
-    "accept": "application/json",
-    "X-API-KEY": settings.API_KEY
-}
-
 
 class NftParser:
 
-    def __init__(self, api_key, nft_link, session):
+    def __init__(self, api_key, nft_link, session, page=None, events=None, aggregates=None):
         self.API_HISTORICAL = settings.API_KEY_HISTORICAL
         self.api_key = api_key
         self.nft_link = nft_link
-        self.contract_address, self.token_id = self.__set_address_token()
+        self.contract_address, self.token_id = split_nft_link(nft_link)
+        self.page = page
+        self.events = events
         self.first_sale_date = None
         self.first_price = None
         self.mint_hash = None
@@ -49,21 +45,17 @@ class NftParser:
         self.royalties = None
         self.scam = False
         self.session = session
-        self.events_dict = OrderedDict()
-
-    def __set_address_token(self):
-        cropped = self.nft_link.split('/')
-        return cropped[-2], cropped[-1]
-
-    def __get_payment_token(self, event):
-        return event['payment_token']['symbol']
+        # aggregates of the events synced before, only newer events get fetched when present
+        self.aggregates = aggregates
+        self.new_events = None
 
     def scrap_opensea(self):
         """ СТатус категория роялти, цена """
 
-        result = BeautifulSoup(requests.get(f'{self.nft_link}', verify=False, headers={
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/109.0'
-        }).content, 'lxml')
+        if self.page is None:
+            self.page = fetch_page(self.session, self.nft_link)
+        result = BeautifulSoup(self.page, 'lxml')
+        self.page = None
         try:
             price = result.find('div', class_='Price--fiat-amount-secondary').text
             price = price.replace('$', '').replace(' ', '').replace(',', '')
@@ -86,7 +78,7 @@ class NftParser:
         trade_station_block = result.find('form', class_='TradeStation--main')
         if not trade_station_block:
             trade_station_block = result.find('div', class_='TradeStation--main')
-            self.type = 'Offer available'
+            self.type = OFFER_AVAILABLE
 
         self.name = result.find('section', {'class': 'item--header'}).find_all('div', recursive=False)[1].find(
             'h1').text
@@ -114,155 +106,77 @@ class NftParser:
             self.type = buy_type
 
         else:
-            self.type = 'Offer available'
+            self.type = OFFER_AVAILABLE
 
         trade_station_block = None
 
-    def __expand_dict_events(self, json_data):
-
-        expand_json_data = self.session.get(
-            f'https://api.opensea.io/api/v1/events?only_opensea=true&token_id={self.token_id}'
-            f'&asset_contract_address={self.contract_address}&limit=200'
-            f'&event_type=successful&cursor={json_data["next"]}', verify=False,
-            headers=headers, stream=True)
-
-        for raw_rs in expand_json_data.iter_lines():
-            if raw_rs:
-                expand_json_data = json.loads(raw_rs)
+    def synced_until(self):
+        return self.aggregates.newest_timestamp if self.aggregates else None
 
-        starting_point = list(self.events_dict.keys())[-1] + 1
-
-        for event in range(len(expand_json_data['asset_events'])):
-            self.events_dict.update({starting_point: expand_json_data['asset_events'][event]})
-            starting_point += 1
-
-        if expand_json_data['next']:
-            self.__expand_dict_events(expand_json_data)
+    def is_unsynced(self, event, synced_until):
+        timestamp = to_timestamp(event['event_timestamp'])
+        if timestamp != synced_until:
+            return timestamp > synced_until
+        # sales sharing the watermark second are new unless they are stored already
+        return (event['seller']['address'], event['winner_account']['address']) not in self.aggregates.synced_sales
 
     def write_all_events(self):
-        json_data = self.session.get(f'https://api.opensea.io/api/v1/events?only_opensea=true&token_id={self.token_id}'
-                                     f'&asset_contract_address={self.contract_address}&limit=200&event_type=successful',
-                                     headers=headers, verify=False, stream=True)
-
-        for raw_rs in json_data.iter_lines():
-            if raw_rs:
-                json_data = json.loads(raw_rs)
-
-        has_next = json_data['next']
-        for event in range(len(json_data['asset_events'])):
-            self.events_dict.update({event: json_data['asset_events'][event]})
-
-        if has_next:
-            self.__expand_dict_events(json_data)
+        synced_until = self.synced_until()
+        if self.events is None:
+            self.events = fetch_events(self.session, self.contract_address, self.token_id,
+                                       occurred_after=synced_until)
+        if synced_until is not None:
+            self.events = [event for event in self.events if self.is_unsynced(event, synced_until)]
+
+        if self.events:
+            self.new_events = SaleEventColumns.from_events(self.events)
+            if self.aggregates is None:
+                self.aggregates = SaleAggregates.from_columns(self.new_events)
+            else:
+                self.aggregates.merge(self.new_events)
+        self.events = None
 
     def set_basic_info(self):
-        self.img_url = self.events_dict.get(0)['asset']['image_url']
-        self.deals_number = self.events_dict.get(0)['asset']['num_sales']
+        self.img_url = self.aggregates.image_url
+        self.deals_number = self.aggregates.num_sales
 
     def set_first_price(self):
-        self.royalties = self.__cut_decimals(
-            self.events_dict.get(0)['asset']['asset_contract']['dev_seller_fee_basis_points'], 2)
-        first_event = self.events_dict.get(list(self.events_dict.keys())[-1])
-
-        if float(first_event['total_price']) == 0:
-            first_event = self.events_dict.get(list(self.events_dict.keys())[-2])
-
-        total_price = self.__cut_decimals(first_event['total_price'], first_event['payment_token']['decimals'])
-        self.first_price = total_price
-
-        self.first_sale_date = self._get_datetime_from_str(first_event['event_timestamp'])
+        self.royalties = cut_decimals(self.aggregates.royalty_bps, 2)
+        self.first_price = self.aggregates.first_price
+        self.first_sale_date = datetime.datetime.utcfromtimestamp(self.aggregates.first_sale_timestamp)
 
     def set_last_sale_date(self) -> None:
-        self.last_sale_date = self.events_dict.get(0)['event_timestamp']
+        self.last_sale_date = self.aggregates.last_sale_date
         return self.last_sale_date
 
-    def __cut_decimals(self, number, decimals):
-        number = list(str(number))
-        while len(number) < decimals:
-            number.insert(-decimals, '0')
-        number.insert(-decimals, '.')
-        str_num = ''.join(number[0:5])
-        if str_num[0] == '.':
-            str_num = '0' + str_num
-
-        return str_num
-
-    def __convert_price_to_usd(self, total_price, payment_token, date):
-        cut = self.__cut_decimals(total_price, payment_token['decimals'])
-        historical = self.__get_historical_price(date.timestamp(), payment_token['symbol'], date)
-        return float(cut) * historical
+    def __convert_price_to_usd(self, price, symbol, date):
+        historical = self.__get_historical_price(symbol, date)
+        if historical is None:
+            return None
+        return price * historical
 
     def _get_datetime_from_str(self, date_to_convert):
         return datetime.datetime.fromisoformat(date_to_convert)
 
     def set_avg_sale_duration(self):
-
-        temp_data = 0
-
-        temp_list_timestamps = []
-
-        for key in self.events_dict.keys():
-            try:
-                temp_list_timestamps.append(self._get_datetime_from_str(self.events_dict.get(key)
-                                                                        ['event_timestamp']).timestamp() -
-                                            self._get_datetime_from_str(
-                                                self.events_dict.get(key + 1)['event_timestamp'])
-                                            .timestamp())
-            except TypeError:
-                pass
-            if self.events_dict.get(key)['listing_time']:
-                temp_data += self._get_datetime_from_str(self.events_dict.get(key)['event_timestamp']).timestamp() \
-                             - self._get_datetime_from_str(self.events_dict.get(key)['listing_time']).timestamp()
-
-        finals = temp_data / len(self.events_dict.keys())
-
-        self.average_hold_duration = self.__humanize_date(sum(temp_list_timestamps) / len(temp_list_timestamps))
-
-        self.average_sale_duration = self.__humanize_date(finals)
+        self.average_hold_duration = self.__humanize_date(self.aggregates.average_hold_duration())
+        self.average_sale_duration = self.__humanize_date(self.aggregates.average_sale_duration())
 
     def set_max_min_profit(self):
-        participants = []
-        for receiver in self.events_dict.keys():
-            receiver_usd = float(self.__cut_decimals(self.events_dict.get(receiver)['total_price'],
-                                                     self.events_dict.get(receiver)['payment_token']['decimals']))
-
-            for sender in self.events_dict.keys():
-                if (self.events_dict.get(receiver)['winner_account']['address'] ==
-                        self.events_dict.get(sender)['seller']['address'] and datetime.datetime.strptime(
-                            self.events_dict.get(sender)['event_timestamp'], '%Y-%m-%dT%H:%M:%S'
-                        ) > datetime.datetime.strptime(self.events_dict.get(receiver)['event_timestamp'],
-                                                       '%Y-%m-%dT%H:%M:%S')):
-                    sender_usd = self.__cut_decimals(self.events_dict.get(sender)['total_price'],
-                                                     self.events_dict.get(sender)['payment_token']['decimals'], )
-                    try:
-                        if receiver_usd > 0:
-                            participants.append(
-                                round((float(sender_usd) - receiver_usd) / receiver_usd * 100, 2)
-                            )
-                    except Exception as e:
-                        print(e)
-        if len(participants) == 0:
+        if self.aggregates.min_profit is None:
             self.max_profit = 'no sales'
             self.min_profit = 'no sales'
-        elif len(participants) == 1:
-            self.max_profit = participants[0]
-            self.min_profit = participants[0]
         else:
-            participants.sort()
-            self.max_profit = participants[-1]
-            self.min_profit = participants[0]
+            self.min_profit = self.aggregates.min_profit
+            self.max_profit = self.aggregates.max_profit
 
     def get_last_sale_price(self):
-        nft_price = self.events_dict.get(0)
-        nft_price = self.__cut_decimals(nft_price['total_price'], nft_price['payment_token']['decimals'])
-        return nft_price
+        return self.aggregates.last_price
 
     def set_total_monthly_profit(self):
         if self.price is None:
-            self.price = self.__convert_price_to_usd(self.events_dict.get(0)['total_price'],
-                                                     self.events_dict.get(0)['payment_token'],
-                                                     self._get_datetime_from_str(
-                                                         self.events_dict.get(0)['event_timestamp']))
+            self.price = self.__convert_price_to_usd(self.aggregates.last_price, self.aggregates.last_symbol,
+                                                     self._get_datetime_from_str(self.aggregates.last_sale_date))
         # print(self.get_last_sale_price(), self.first_price)
         self.total_profit = round((float(self.get_last_sale_price()) / float(self.first_price)) * 100 - 100, 5)
         now = datetime.datetime.now()
@@ -272,29 +186,8 @@ class NftParser:
             months_difference = 1
         self.monthly_roi = self.total_profit / months_difference
 
-    def __get_historical_price(self, date_to_get, network, check_date):
-        check_date = check_date.date()
-        created = False
-        if network == 'WETH':
-            network = 'ETH'
-        try:
-            price = HistoryPrice.objects.get(
-                ticker=network, date=check_date
-            )
-        except:
-            price = HistoryPrice.objects.create(
-                ticker=network, date=check_date, price=0
-            )
-            created = True
-        if created:
-            url = f'https://min-api.cryptocompare.com/data/pricehistorical?fsym={network}&tsyms=USD&ts={date_to_get}'
-            request = requests.get(url, verify=False).json()
-            price_usd = request.get(list(request.keys())[0])['USD']
-            price.price = price_usd
-            price.save()
-            return price_usd
-        else:
-            return price.price
+    def __get_historical_price(self, network, check_date):
+        return history_prices.get(network, check_date.date())
 
     def __humanize_date(self, seconds):
         humanized = datetime.timedelta(seconds=seconds)
@@ -305,7 +198,10 @@ class NftParser:
     def set_none(self):
         self.price = None
         self.deals_number = None
-        self.events_dict = None
+        self.aggregates = None
+        self.new_events = None
+        self.events = None
+        self.page = None
         self.max_profit = None
         self.nft_link = None
         self.min_profit = None
@@ -324,11 +220,12 @@ class NftParser:
         self.average_hold_duration = None
         self.mint_hash = None
 
-    def get_info(self):
-        self.scrap_opensea()
-        if self.scam:
-            return False
+    def get_metrics(self):
+        """ Values derived from the sale events, without scraping the item page. None before a paid sale """
         self.write_all_events()
+        if self.aggregates.first_price is None:
+            # only the free mint was sold, no first price to measure the profit from
+            return None
         self.set_basic_info()
         self.set_first_price()
         self.set_last_sale_date()
@@ -336,12 +233,9 @@ class NftParser:
         self.set_avg_sale_duration()
         self.set_max_min_profit()
 
-        full_dict = {
+        return {
             'price': self.price,
             'img_link': self.img_url,
-            'name': self.name,
-            'type': self.type,
-            'category': self.status,
             'total_profit': self.total_profit,
             'monthly_roi': self.monthly_roi,
             'deals_number': self.deals_number,
@@ -351,9 +245,36 @@ class NftParser:
             'average_sale_duration': self.average_sale_duration,
             'average_hold_duration': self.average_hold_duration,
             'royalty': self.royalties,
+            'first_price': self.first_price,
+            'first_sale_date': self.first_sale_date,
+            'aggregates': self.aggregates,
+            'sale_events': self.new_events,
+        }
+
+    def get_info(self):
+        self.scrap_opensea()
+        if self.scam:
+            return False
+
+        metrics = self.get_metrics()
+        if metrics is None:
+            print(f'no paid sale of {self.nft_link} yet')
+            self.set_none()
+            return False
+
+        full_dict = {
+            'name': self.name,
+            'type': self.type,
+            'category': self.status,
             'buy_link': self.nft_link,
-            'opensea_link': self.nft_link
+            'opensea_link': self.nft_link,
+            **metrics,
         }
+        if full_dict['price'] is None:
+            # not listed and no usd price of the last sale day yet, the nft is parsed again next time
+            print(f'no usd price for {self.nft_link}')
+            self.set_none()
+            return False
 
         self.set_none()
         return full_dict
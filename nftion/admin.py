@@ -1,3 +1,8 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import RefreshShard
+
+
+@admin.register(RefreshShard)
+class RefreshShardAdmin(admin.ModelAdmin):
+    list_display = ('id', 'first_id', 'last_id', 'processed', 'total', 'leased_until', 'finished_time')
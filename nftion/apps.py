@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class NftionConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "nftion"
+
+    def ready(self):
+        import nftion.signals
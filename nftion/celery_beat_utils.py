@@ -48,6 +48,21 @@ def populate_intervals_and_periodic_tasks():
         {
             'name': 'update_old',
             'task': 'nftion.tasks.update_old',
+            'interval': IntervalSchedule.objects.get(every=5, period=IntervalSchedule.MINUTES),
+        },
+        {
+            'name': 'refresh_time_metrics',
+            'task': 'nftion.tasks.refresh_time_metrics',
+            'interval': IntervalSchedule.objects.get(every=1, period=IntervalSchedule.HOURS),
+        },
+        {
+            'name': 'reconcile_subscriptions',
+            'task': 'accounts.tasks.reconcile_subscriptions',
+            'interval': IntervalSchedule.objects.get(every=1, period=IntervalSchedule.HOURS),
+        },
+        {
+            'name': 'backfill_stripe_customers',
+            'task': 'accounts.tasks.backfill_stripe_customers',
             'interval': IntervalSchedule.objects.get(every=1, period=IntervalSchedule.DAYS),
         },
         {
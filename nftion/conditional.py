@@ -0,0 +1,39 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from .list_cache import data_version
+
+# responses depend on the authenticated user's tier, shared caches must neither store nor mix them
+VARY_HEADERS = ('Authorization', 'Cookie')
+
+
+class ConditionalGetMixin:
+    """
+    Answers GET requests with 304 Not Modified when the client's If-None-Match / If-Modified-Since
+    still match, before the list is computed. Views provide the validators from cached versions.
+    """
+
+    def get_etag_source(self, request):
+        """ Data version and url by default, views whose response also depends on the user override this """
+        return f'{data_version()}:{request.get_full_path()}'
+
+    def get_last_modified(self, request):
+        return None
+
+    def get(self, request, *args, **kwargs):
+        etag = quote_etag(hashlib.md5(self.get_etag_source(request).encode()).hexdigest())
+        last_modified = self.get_last_modified(request)
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response.headers['ETag'] = etag
+            if timestamp is not None:
+                response.headers['Last-Modified'] = http_date(timestamp)
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, VARY_HEADERS)
+        return response
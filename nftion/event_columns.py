@@ -0,0 +1,291 @@
+import calendar
+import datetime
+from array import array
+from bisect import bisect_right
+from heapq import nlargest
+
+# addresses whose purchases are kept to match later resales, only the newest buyers still hold the token
+MAX_TRACKED_PURCHASES = 100
+
+
+def cut_decimals(number, decimals):
+    """ Places the decimal point into a raw token amount and keeps the first five characters """
+    number = list(str(number))
+    while len(number) < decimals:
+        number.insert(-decimals, '0')
+    number.insert(-decimals, '.')
+    str_num = ''.join(number[0:5])
+    if str_num[0] == '.':
+        str_num = '0' + str_num
+
+    return str_num
+
+
+def to_timestamp(value):
+    """ Seconds since epoch for an opensea timestamp string, naive values are UTC """
+    return calendar.timegm(datetime.datetime.fromisoformat(value).utctimetuple())
+
+
+def first_sale_index(last, oldest_amount):
+    """
+    Index of the first paid sale in a newest first history ending at `last`: the oldest sale unless it
+    was a free mint. None when the free mint is the only sale.
+    """
+    if oldest_amount != 0:
+        return last
+    return last - 1 if last > 0 else None
+
+
+def flip_profit_range(sales):
+    """
+    Percent profit of every purchase that was later resold by the buyer.
+
+    `sales` is an iterable of (timestamp, price, seller, buyer) tuples. Resales are indexed by seller
+    with suffix max/min prices, so each purchase is matched with one bisect instead of a scan.
+    Returns (min_profit, max_profit) or None when no purchase was resold.
+    """
+    sales = list(sales)
+    resales = {}
+    for timestamp, price, seller, _ in sales:
+        resales.setdefault(seller, []).append((timestamp, price))
+
+    index = {}
+    for seller, seller_sales in resales.items():
+        seller_sales.sort(key=lambda sale: sale[0])
+        suffix_max = [price for _, price in seller_sales]
+        suffix_min = list(suffix_max)
+        for position in range(len(seller_sales) - 2, -1, -1):
+            suffix_max[position] = max(suffix_max[position], suffix_max[position + 1])
+            suffix_min[position] = min(suffix_min[position], suffix_min[position + 1])
+        index[seller] = ([timestamp for timestamp, _ in seller_sales], suffix_min, suffix_max)
+
+    min_profit = max_profit = None
+    for timestamp, price, _, buyer in sales:
+        if price <= 0 or buyer not in index:
+            continue
+        timestamps, suffix_min, suffix_max = index[buyer]
+        position = bisect_right(timestamps, timestamp)
+        if position == len(timestamps):
+            continue
+        # profit grows with the resale price, so the extremes come from the suffix extremes
+        low = round((suffix_min[position] - price) / price * 100, 2)
+        high = round((suffix_max[position] - price) / price * 100, 2)
+        if min_profit is None or low < min_profit:
+            min_profit = low
+        if max_profit is None or high > max_profit:
+            max_profit = high
+
+    if min_profit is None:
+        return None
+    return min_profit, max_profit
+
+
+class SaleEventColumns:
+    """
+    Successful sale events of a single token decoded once into columns.
+
+    Rows keep the opensea order (newest first). Timestamps are int64 seconds, prices are floats in
+    payment token units, amounts the exact integer price in token base units and seller/buyer/payment
+    token are interned to small ints.
+    """
+    __slots__ = (
+        'timestamps', 'listing_times', 'prices', 'amounts', 'decimals', 'sellers', 'buyers', 'symbols',
+        'addresses', 'symbol_names', 'first_index', 'image_url', 'num_sales', 'royalty_bps', 'last_sale_date',
+    )
+
+    def __init__(self):
+        self.timestamps = array('q')
+        self.listing_times = array('q')
+        self.prices = array('d')
+        self.amounts = []
+        self.decimals = array('b')
+        self.sellers = array('l')
+        self.buyers = array('l')
+        self.symbols = array('l')
+        self.addresses = []
+        self.symbol_names = []
+        self.first_index = None
+        self.image_url = None
+        self.num_sales = None
+        self.royalty_bps = None
+        self.last_sale_date = None
+
+    @classmethod
+    def from_events(cls, events):
+        columns = cls()
+        address_ids = {}
+        symbol_ids = {}
+        for event in events:
+            timestamp = to_timestamp(event['event_timestamp'])
+            columns.timestamps.append(timestamp)
+            # a missing listing time contributes no sale duration
+            columns.listing_times.append(
+                to_timestamp(event['listing_time']) if event['listing_time'] else timestamp
+            )
+            columns.prices.append(float(cut_decimals(event['total_price'], event['payment_token']['decimals'])))
+            columns.amounts.append(int(event['total_price']))
+            columns.decimals.append(event['payment_token']['decimals'])
+            columns.sellers.append(cls._intern(event['seller']['address'], address_ids, columns.addresses))
+            columns.buyers.append(cls._intern(event['winner_account']['address'], address_ids, columns.addresses))
+            columns.symbols.append(cls._intern(event['payment_token']['symbol'], symbol_ids, columns.symbol_names))
+
+        newest = events[0]
+        columns.image_url = newest['asset']['image_url']
+        columns.num_sales = newest['asset']['num_sales']
+        columns.royalty_bps = newest['asset']['asset_contract']['dev_seller_fee_basis_points']
+        columns.last_sale_date = newest['event_timestamp']
+        # the oldest sale is the mint, skip it when it was free
+        columns.first_index = first_sale_index(len(events) - 1, float(events[-1]['total_price']))
+        return columns
+
+    @classmethod
+    def from_sale_events(cls, rows):
+        """
+        Columns of stored sales, `rows` are (timestamp, listing_time, total_price, payment_decimals,
+        payment_token, seller, buyer) tuples newest first. Asset fields are left for the caller.
+        """
+        columns = cls()
+        address_ids = {}
+        symbol_ids = {}
+        for timestamp, listing_time, total_price, decimals, symbol, seller, buyer in rows:
+            timestamp = calendar.timegm(timestamp.utctimetuple())
+            columns.timestamps.append(timestamp)
+            columns.listing_times.append(
+                calendar.timegm(listing_time.utctimetuple()) if listing_time else timestamp
+            )
+            columns.prices.append(float(cut_decimals(int(total_price), decimals)))
+            columns.amounts.append(int(total_price))
+            columns.decimals.append(decimals)
+            columns.sellers.append(cls._intern(seller, address_ids, columns.addresses))
+            columns.buyers.append(cls._intern(buyer, address_ids, columns.addresses))
+            columns.symbols.append(cls._intern(symbol, symbol_ids, columns.symbol_names))
+
+        columns.last_sale_date = datetime.datetime.utcfromtimestamp(columns.timestamps[0]).isoformat()
+        last = len(columns) - 1
+        columns.first_index = first_sale_index(last, columns.amounts[last])
+        return columns
+
+    def rows(self):
+        """ (timestamp, listing_time, total_price, payment_decimals, payment_token, seller, buyer) tuples """
+        for index in range(len(self)):
+            listing_time = self.listing_times[index]
+            yield (
+                self.timestamps[index],
+                listing_time if listing_time != self.timestamps[index] else None,
+                self.amounts[index],
+                self.decimals[index],
+                self.symbol(index),
+                self.addresses[self.sellers[index]],
+                self.addresses[self.buyers[index]],
+            )
+
+    @staticmethod
+    def _intern(value, ids, values):
+        if value not in ids:
+            ids[value] = len(values)
+            values.append(value)
+        return ids[value]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def symbol(self, index):
+        return self.symbol_names[self.symbols[index]]
+
+    def sales(self):
+        """ (timestamp, price, seller, buyer) rows """
+        return zip(self.timestamps, self.prices, self.sellers, self.buyers)
+
+
+class SaleAggregates:
+    """
+    Running aggregates of a token's sale history, enough to derive every parser metric and to fold in
+    newer events without the older ones. Stored as json on NftSyncState.
+    """
+    fields = (
+        'event_count', 'oldest_timestamp', 'newest_timestamp', 'first_price', 'first_sale_timestamp',
+        'last_price', 'last_symbol', 'last_sale_date', 'image_url', 'num_sales', 'royalty_bps',
+        'listing_duration_sum', 'min_profit', 'max_profit', 'purchases',
+    )
+
+    def __init__(self, **values):
+        for field in self.fields:
+            setattr(self, field, values.get(field))
+        # (seller, buyer) of the sales stored at newest_timestamp, filled when loaded, not persisted
+        self.synced_sales = set()
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    @classmethod
+    def from_columns(cls, columns):
+        """ Aggregates of a complete sale history, without a first sale when only a free mint was sold """
+        first = columns.first_index
+        aggregates = cls(
+            event_count=0,
+            oldest_timestamp=columns.timestamps[-1],
+            first_price=columns.prices[first] if first is not None else None,
+            first_sale_timestamp=columns.timestamps[first] if first is not None else None,
+            listing_duration_sum=0,
+            purchases={},
+        )
+        aggregates.merge(columns)
+        return aggregates
+
+    def merge(self, columns):
+        """ Folds in events that are not older than the ones aggregated so far and not aggregated yet """
+        profit_range = flip_profit_range(columns.sales())
+        if profit_range is not None:
+            self._add_profit(*profit_range)
+
+        # new resales of tokens bought before: the cheapest purchase gives the best flip
+        for price, seller in zip(columns.prices, columns.sellers):
+            bought = self.purchases.get(columns.addresses[seller])
+            if bought is None:
+                continue
+            cheapest, dearest = bought[:2]
+            self._add_profit(round((price - dearest) / dearest * 100, 2), round((price - cheapest) / cheapest * 100, 2))
+
+        for timestamp, price, buyer in zip(columns.timestamps, columns.prices, columns.buyers):
+            if price <= 0:
+                continue
+            address = columns.addresses[buyer]
+            bought = self.purchases.get(address)
+            self.purchases[address] = [price, price, timestamp] if bought is None else [
+                min(bought[0], price), max(bought[1], price), max(self._purchase_time(bought), timestamp)
+            ]
+        if len(self.purchases) > MAX_TRACKED_PURCHASES:
+            # an address can only resell the token after buying it again, which tracks it anew
+            self.purchases = dict(nlargest(MAX_TRACKED_PURCHASES, self.purchases.items(),
+                                           key=lambda item: self._purchase_time(item[1])))
+
+        self.event_count += len(columns)
+        self.listing_duration_sum += sum(map(int.__sub__, columns.timestamps, columns.listing_times))
+        self.newest_timestamp = columns.timestamps[0]
+        self.last_price = columns.prices[0]
+        self.last_symbol = columns.symbol(0)
+        self.last_sale_date = columns.last_sale_date
+        self.image_url = columns.image_url
+        self.num_sales = columns.num_sales
+        self.royalty_bps = columns.royalty_bps
+
+    @staticmethod
+    def _purchase_time(bought):
+        # purchases stored before the purchase time was kept sort as the oldest
+        return bought[2] if len(bought) > 2 else 0
+
+    def _add_profit(self, low, high):
+        if self.min_profit is None or low < self.min_profit:
+            self.min_profit = low
+        if self.max_profit is None or high > self.max_profit:
+            self.max_profit = high
+
+    def average_sale_duration(self):
+        return self.listing_duration_sum / self.event_count
+
+    def average_hold_duration(self):
+        return (self.newest_timestamp - self.oldest_timestamp) / (self.event_count - 1)
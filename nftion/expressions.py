@@ -0,0 +1,21 @@
+from django.db.models import DecimalField, DurationField, ExpressionWrapper, F, FloatField, Func, IntegerField, Value
+from django.db.models.functions import Cast, Floor, Greatest, Now, Round
+
+
+class EpochSeconds(Func):
+    template = 'EXTRACT(EPOCH FROM %(expressions)s)'
+    output_field = FloatField()
+
+
+def months_since(field):
+    """ 30 day months started since the datetime column, at least one, counted like NftParser does """
+    days = EpochSeconds(ExpressionWrapper(Now() - F(field), output_field=DurationField())) / Value(86400.0)
+    return Greatest(Cast(Floor(days / Value(30.0)), IntegerField()) + Value(1), Value(1))
+
+
+def monthly_roi():
+    """ total_profit spread over the months since the first sale, rounded like the column """
+    return Round(
+        ExpressionWrapper(F('total_profit') / months_since('first_sale_date'), output_field=DecimalField()), 2,
+        output_field=DecimalField(max_digits=14, decimal_places=2),
+    )
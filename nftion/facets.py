@@ -0,0 +1,54 @@
+from django.db.models import Count, Q
+
+from .models import OFFER_AVAILABLE
+
+# lower bounds of the histogram buckets, the last bucket is open ended
+PRICE_BUCKETS = (0, 10, 50, 100, 500, 1000, 5000)
+DEALS_NUMBER_BUCKETS = (0, 5, 10, 25, 50, 100)
+
+
+def bucket_filters(field, bounds):
+    filters = []
+    for index, low in enumerate(bounds):
+        high = bounds[index + 1] if index + 1 < len(bounds) else None
+        condition = Q(**{f'{field}__gte': low})
+        if high is not None:
+            condition &= Q(**{f'{field}__lt': high})
+        filters.append((low, high, condition))
+    return filters
+
+
+def nft_facets(queryset):
+    """
+    Facet counts of a filtered nft queryset: per nft type, price and deals number buckets and offers.
+    One grouped query by nft type with a conditional count per bucket, summed up per facet here.
+    """
+    price_buckets = bucket_filters('price', PRICE_BUCKETS)
+    deals_buckets = bucket_filters('deals_number', DEALS_NUMBER_BUCKETS)
+    aggregates = {'count': Count('id'), 'offers': Count('id', filter=Q(offer=OFFER_AVAILABLE))}
+    for index, (_, _, condition) in enumerate(price_buckets):
+        aggregates[f'price_{index}'] = Count('id', filter=condition)
+    for index, (_, _, condition) in enumerate(deals_buckets):
+        aggregates[f'deals_{index}'] = Count('id', filter=condition)
+
+    groups = list(
+        queryset.order_by().values('nft_type_id', 'nft_type__name').annotate(**aggregates).order_by('nft_type__name')
+    )
+
+    def histogram(buckets, prefix):
+        return [
+            {'min': low, 'max': high, 'count': sum(group[f'{prefix}_{index}'] for group in groups)}
+            for index, (low, high, _) in enumerate(buckets)
+        ]
+
+    total = sum(group['count'] for group in groups)
+    offers = sum(group['offers'] for group in groups)
+    return {
+        'total': total,
+        'nft_types': [
+            {'id': group['nft_type_id'], 'name': group['nft_type__name'], 'count': group['count']} for group in groups
+        ],
+        'price': histogram(price_buckets, 'price'),
+        'deals_number': histogram(deals_buckets, 'deals'),
+        'offer': {'true': offers, 'false': total - offers},
+    }
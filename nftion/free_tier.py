@@ -0,0 +1,86 @@
+from threading import Lock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Q, Window
+from django.db.models.functions import RowNumber
+
+from .list_cache import data_version
+from .models import OFFER_AVAILABLE, Nft
+from .pagination import FREE_TIER_LIMIT
+from .serializers import nft_list_serializer
+
+SNAPSHOT_KEY = 'nft_free_tier_snapshot:{}'
+# params that only change the paging of a list the free tier never pages through
+PAGING_PARAMS = ('limit', 'offset', 'cursor', 'pagination')
+
+_local = {'version': None, 'snapshot': None}
+_local_lock = Lock()
+
+
+def snapshot_params(query_params):
+    """ Snapshot key of a free tier request: '' or a single offer or nft type filter, else None """
+    params = {name: query_params.getlist(name) for name in query_params if name not in PAGING_PARAMS}
+    if not params:
+        return ''
+    if len(params) != 1:
+        return None
+    (name, values), = params.items()
+    if len(values) != 1:
+        return None
+    if name == 'offer' and values[0] in ('true', 'false'):
+        return f'offer={values[0]}'
+    if name == 'nft_type_ids' and values[0].isdigit():
+        return f'nft_type_ids={int(values[0])}'
+    return None
+
+
+def build_free_tier_snapshot():
+    """
+    Precomputes the free tier page (count and first rows by -id) of the unfiltered list, of both offer
+    filters and of every single nft type, for the current data version. Stored in the shared cache.
+    """
+    version = data_version()
+    rows = nft_list_serializer.queryset(Nft.objects.order_by('-id'))
+    totals = Nft.objects.aggregate(total=Count('id'), offers=Count('id', filter=Q(offer=OFFER_AVAILABLE)))
+
+    snapshot = {
+        '': (totals['total'], rows[:FREE_TIER_LIMIT]),
+        'offer=true': (totals['offers'], rows.filter(offer=OFFER_AVAILABLE)[:FREE_TIER_LIMIT]),
+        'offer=false': (totals['total'] - totals['offers'], rows.exclude(offer=OFFER_AVAILABLE)[:FREE_TIER_LIMIT]),
+    }
+    type_counts = Nft.objects.order_by().values_list('nft_type_id').annotate(count=Count('id'))
+    type_rows = {type_id: [] for type_id, _ in type_counts}
+    ranked = rows.annotate(
+        type_rank=Window(RowNumber(), partition_by=F('nft_type_id'), order_by=F('id').desc())
+    ).filter(type_rank__lte=FREE_TIER_LIMIT)
+    for row in ranked:
+        type_rows[row['nft_type_id']].append(row)
+    for type_id, count in type_counts:
+        snapshot[f'nft_type_ids={type_id}'] = (count, type_rows[type_id])
+
+    snapshot = {key: (count, nft_list_serializer.serialize(page)) for key, (count, page) in snapshot.items()}
+    cache.set(SNAPSHOT_KEY.format(version), snapshot, timeout=settings.NFT_FREE_TIER_SNAPSHOT_TIMEOUT)
+    cache.delete(SNAPSHOT_KEY.format(version - 1))
+    return snapshot
+
+
+def free_tier_page(query_params):
+    """
+    (count, serialized rows) of a free tier request from the snapshot of the current data version,
+    held in process until the version changes. None when the request is not covered.
+    """
+    key = snapshot_params(query_params)
+    if key is None:
+        return None
+    version = data_version()
+    with _local_lock:
+        if _local['version'] != version:
+            snapshot = cache.get(SNAPSHOT_KEY.format(version))
+            if snapshot is None:
+                return None
+            _local['version'], _local['snapshot'] = version, snapshot
+        snapshot = _local['snapshot']
+    if key.startswith('nft_type_ids='):
+        return snapshot.get(key, (0, []))
+    return snapshot[key]
@@ -0,0 +1,146 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import Nft
+
+DATA_VERSION_KEY = 'nft_data_version'
+TYPES_VERSION_KEY = 'nft_types_version'
+LAST_MODIFIED_KEY = 'nft_last_modified'
+HITS_KEY = 'nft_list_cache_hits'
+MISSES_KEY = 'nft_list_cache_misses'
+FACETS_HITS_KEY = 'nft_facets_cache_hits'
+FACETS_MISSES_KEY = 'nft_facets_cache_misses'
+# the free tier always gets the first rows, paging params do not change its response
+FREE_TIER_IGNORED_PARAMS = ('limit', 'offset', 'cursor')
+FACETS_IGNORED_PARAMS = FREE_TIER_IGNORED_PARAMS + ('pagination', 'ordering', 'fields', 'compact')
+
+
+def initial_version():
+    # versions restart from the clock after a cache flush, so they never repeat one held in a process
+    return time.time_ns() // 1000
+
+
+def current_version(key):
+    cache.add(key, initial_version(), timeout=None)
+    return cache.get(key) or initial_version()
+
+
+def bump_version(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, initial_version(), timeout=None)
+
+
+def data_version():
+    return current_version(DATA_VERSION_KEY)
+
+
+def bump_data_version():
+    """ Invalidates every cached nft list response, called whenever nfts were written or deleted """
+    bump_version(DATA_VERSION_KEY)
+    cache.set(LAST_MODIFIED_KEY, timezone.now(), timeout=None)
+
+
+def types_version():
+    return current_version(TYPES_VERSION_KEY)
+
+
+def bump_types_version():
+    bump_version(TYPES_VERSION_KEY)
+
+
+def last_modified():
+    """ Time of the last nft change, the newest update time until the first change is recorded """
+    modified = cache.get(LAST_MODIFIED_KEY)
+    if modified is None:
+        modified = Nft.objects.aggregate(modified=Max('update_time'))['modified']
+        if modified is not None:
+            cache.add(LAST_MODIFIED_KEY, modified, timeout=None)
+    return modified
+
+
+def canonical_params(query_params, ignored=()):
+    """ Query params sorted by name and value as one string, nft type ids sorted and deduplicated """
+    params = []
+    for name in sorted(query_params):
+        if name in ignored:
+            continue
+        values = sorted(query_params.getlist(name))
+        if name == 'nft_type_ids':
+            values = [canonical_type_ids(values)]
+        params.extend(f'{name}={value}' for value in values)
+    return '&'.join(params)
+
+
+def canonical_type_ids(values):
+    parts = [part for value in values for part in value.split(',')]
+    if not all(part.isdigit() for part in parts):
+        return ','.join(values)
+    return ','.join(str(type_id) for type_id in sorted({int(part) for part in parts}))
+
+
+def response_key(request, subscribed):
+    tier = 'subscribed' if subscribed else 'free'
+    ignored = () if subscribed else FREE_TIER_IGNORED_PARAMS
+    canonical = f'{request.build_absolute_uri(request.path)}?{canonical_params(request.query_params, ignored)}'
+    return f'nft_list:{data_version()}:{tier}:{hashlib.md5(canonical.encode()).hexdigest()}'
+
+
+def facets_key(request):
+    """ Facets only depend on the filters, every tier shares them """
+    canonical = canonical_params(request.query_params, FACETS_IGNORED_PARAMS)
+    return f'nft_facets:{data_version()}:{hashlib.md5(canonical.encode()).hexdigest()}'
+
+
+def get_response(key, hits_key=HITS_KEY, misses_key=MISSES_KEY):
+    data = cache.get(key)
+    count(hits_key if data is not None else misses_key)
+    return data
+
+
+def get_facets(key):
+    """ Cached facets, counted apart so they do not skew the hit ratio of the list responses """
+    return get_response(key, FACETS_HITS_KEY, FACETS_MISSES_KEY)
+
+
+def set_response(key, data):
+    cache.set(key, data, timeout=settings.NFT_LIST_CACHE_TIMEOUT)
+
+
+def count(key, delta=1):
+    if not delta:
+        return
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        cache.add(key, delta, timeout=None)
+
+
+def hit_ratio(hits, misses):
+    return round(hits / (hits + misses), 4) if hits + misses else None
+
+
+def cache_stats():
+    """ Hits and misses of the nft list and facets response caches since the counters were last reset """
+    counters = cache.get_many([HITS_KEY, MISSES_KEY, FACETS_HITS_KEY, FACETS_MISSES_KEY])
+    hits, misses = counters.get(HITS_KEY, 0), counters.get(MISSES_KEY, 0)
+    facets_hits, facets_misses = counters.get(FACETS_HITS_KEY, 0), counters.get(FACETS_MISSES_KEY, 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': hit_ratio(hits, misses),
+        'facets_hits': facets_hits,
+        'facets_misses': facets_misses,
+        'facets_hit_ratio': hit_ratio(facets_hits, facets_misses),
+        'data_version': data_version(),
+    }
+
+
+def reset_cache_stats():
+    cache.delete_many([HITS_KEY, MISSES_KEY, FACETS_HITS_KEY, FACETS_MISSES_KEY])
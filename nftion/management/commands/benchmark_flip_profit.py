@@ -0,0 +1,64 @@
+import random
+import time
+
+from django.core.management import BaseCommand
+
+from ...event_columns import flip_profit_range
+
+
+def quadratic_flip_profit_range(sales):
+    """ Pairwise matching the parser used before, kept as the reference for the benchmark """
+    participants = []
+    for receiver in sales:
+        for sender in sales:
+            if receiver[3] == sender[2] and sender[0] > receiver[0] and receiver[1] > 0:
+                participants.append(round((sender[1] - receiver[1]) / receiver[1] * 100, 2))
+    if not participants:
+        return None
+    return min(participants), max(participants)
+
+
+def synthetic_sales(events, addresses, seed):
+    rnd = random.Random(seed)
+    wallets = [f'0x{index:040x}' for index in range(addresses)]
+    owner = rnd.choice(wallets)
+    timestamp = 1_600_000_000
+    sales = []
+    for _ in range(events):
+        buyer = rnd.choice(wallets)
+        timestamp += rnd.randint(0, 86400)
+        price = round(rnd.uniform(0, 5), 4) if rnd.random() > 0.02 else 0.0
+        sales.append((timestamp, price, owner, buyer))
+        owner = buyer
+    return sales
+
+
+class Command(BaseCommand):
+    help = 'Compares the indexed flip profit matching with the pairwise one on a synthetic sale history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=10000)
+        parser.add_argument('--addresses', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--skip-quadratic', action='store_true')
+
+    def handle(self, *args, **options):
+        sales = synthetic_sales(options['events'], options['addresses'], options['seed'])
+
+        started = time.perf_counter()
+        indexed = flip_profit_range(sales)
+        indexed_time = time.perf_counter() - started
+        self.stdout.write(f'indexed:   {indexed_time:.4f}s -> {indexed}')
+
+        if options['skip_quadratic']:
+            return
+
+        started = time.perf_counter()
+        quadratic = quadratic_flip_profit_range(sales)
+        quadratic_time = time.perf_counter() - started
+        self.stdout.write(f'quadratic: {quadratic_time:.4f}s -> {quadratic}')
+
+        if indexed != quadratic:
+            self.stdout.write(self.style.ERROR('Results differ.'))
+            return
+        self.stdout.write(self.style.SUCCESS(f'Results match, speedup x{quadratic_time / indexed_time:.1f}'))
@@ -0,0 +1,110 @@
+import random
+import re
+from datetime import datetime, timedelta, timezone
+
+from django.core.management import BaseCommand, CommandError
+from django.db import connection
+
+from ...models import OFFER_AVAILABLE, Nft, NftType
+
+BENCHMARK_LINK_PREFIX = 'https://opensea.io/assets/ethereum/0xbenchmark/'
+OFFERS = ('Buy now', OFFER_AVAILABLE, 'No offers')
+ORDERINGS = ('-update_time', '-id', 'price', '-price', '-deals_number', '-monthly_roi')
+
+
+def seed_nfts(rows, types, seed, batch_size=5000):
+    """ Tops the synthetic nfts up to `rows`, spread over `types` types and a year of update and sale dates """
+    rnd = random.Random(seed)
+    nft_types = [NftType.objects.get_or_create(name=f'Benchmark type {index}')[0] for index in range(types)]
+    now = datetime.now(timezone.utc)
+    start = Nft.objects.filter(opensea_link__startswith=BENCHMARK_LINK_PREFIX).count()
+    for first in range(start, rows, batch_size):
+        batch = []
+        for index in range(first, min(first + batch_size, rows)):
+            link = f'{BENCHMARK_LINK_PREFIX}{index}'
+            batch.append(Nft(
+                name=f'benchmark {index}', img_link=link, price=round(rnd.lognormvariate(3, 1.5), 2),
+                nft_type=rnd.choice(nft_types), offer=rnd.choice(OFFERS), total_profit=rnd.uniform(-100, 100),
+                opensea_link=link, deals_number=int(rnd.expovariate(0.1)), monthly_roi=rnd.uniform(-50, 50),
+                last_sale_date=now - timedelta(minutes=rnd.randint(0, 525600)), max_profit_per_sale=0,
+                min_profit_sale=0, royalty=rnd.choice((0, 2.5, 5, 7.5)), buy_link=link,
+            ))
+        Nft.objects.bulk_create(batch)
+    # auto_now does not apply to bulk_create values, spread update times over the year in sql
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "UPDATE nftion_nft SET update_time = now() - (random() * interval '365 days') "
+            "WHERE opensea_link LIKE %s",
+            [BENCHMARK_LINK_PREFIX + '%'],
+        )
+        cursor.execute('ANALYZE nftion_nft')
+    return nft_types
+
+
+def list_filters(nft_types):
+    """ Filter combinations NFTList builds from its query params """
+    type_ids = [nft_type.id for nft_type in nft_types[:2]]
+    return {
+        'no filter': {},
+        'types': {'nft_type_id__in': type_ids},
+        'offer': {'offer': OFFER_AVAILABLE},
+        'price range': {'price__range': [10, 50]},
+        'deals range': {'deals_number__range': [5, 20]},
+        'types+offer+price+deals': {
+            'nft_type_id__in': type_ids, 'offer': OFFER_AVAILABLE,
+            'price__range': [10, 50], 'deals_number__range': [5, 20],
+        },
+    }
+
+
+def explain_analyze(sql, params):
+    """ (execution milliseconds, scan nodes, full plan) of a query """
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN ANALYZE {sql}', params)
+        plan = '\n'.join(row[0] for row in cursor.fetchall())
+    milliseconds = float(re.search(r'Execution Time: ([\d.]+) ms', plan).group(1))
+    scans = re.findall(r'((?:Parallel )?(?:Seq|Index Only|Index|Bitmap Index) Scan(?: Backward)?(?: using| on) \w+)', plan)
+    return milliseconds, ', '.join(dict.fromkeys(scans)), plan
+
+
+class Command(BaseCommand):
+    help = 'Seeds a synthetic nft table and records EXPLAIN ANALYZE timings of the nft list queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=200000)
+        parser.add_argument('--types', type=int, default=20)
+        parser.add_argument('--limit', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded rows for the next run')
+        parser.add_argument('--plans', action='store_true', help='Print the full query plans')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('EXPLAIN ANALYZE timings need the PostgreSQL database')
+
+        nft_types = seed_nfts(options['rows'], options['types'], options['seed'])
+        try:
+            self.stdout.write(f'{"filter":<26}{"ordering":<16}{"ms":>10}  scans')
+            for name, filters in list_filters(nft_types).items():
+                queryset = Nft.objects.filter(**filters)
+                for ordering in ORDERINGS:
+                    tie_break = '-id' if ordering.startswith('-') else 'id'
+                    page = queryset.order_by(ordering, tie_break)[:options['limit']]
+                    self.write_timing(name, ordering, page, options['plans'])
+                self.write_timing(name, 'count', queryset.order_by().values('id'), options['plans'], count=True)
+
+            stale = Nft.objects.filter(update_time__lt=datetime.now(timezone.utc) - timedelta(days=1))
+            self.write_timing('update_time__lt', '-', stale.values('id'), options['plans'])
+        finally:
+            if not options['keep']:
+                Nft.objects.filter(opensea_link__startswith=BENCHMARK_LINK_PREFIX).delete()
+                NftType.objects.filter(name__startswith='Benchmark type ').delete()
+
+    def write_timing(self, name, ordering, queryset, plans, count=False):
+        sql, params = queryset.query.sql_with_params()
+        if count:
+            sql = f'SELECT COUNT(*) FROM ({sql}) counted'
+        milliseconds, scans, plan = explain_analyze(sql, params)
+        self.stdout.write(f'{name:<26}{ordering:<16}{milliseconds:>10.2f}  {scans}')
+        if plans:
+            self.stdout.write(plan)
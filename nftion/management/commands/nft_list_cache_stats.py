@@ -0,0 +1,16 @@
+from django.core.management import BaseCommand
+
+from ...list_cache import cache_stats, reset_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Prints the hits, misses and hit ratio of the nft list response cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        for name, value in cache_stats().items():
+            self.stdout.write(f'{name}: {value}')
+        if options['reset']:
+            reset_cache_stats()
@@ -0,0 +1,16 @@
+from django.core.management import BaseCommand
+
+from ...parser_utils import reset_write_stats, write_stats
+
+
+class Command(BaseCommand):
+    help = 'Prints how many parsed nfts were written and how many were skipped as unchanged'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them')
+
+    def handle(self, *args, **options):
+        for name, value in write_stats().items():
+            self.stdout.write(f'{name}: {value}')
+        if options['reset']:
+            reset_write_stats()
@@ -0,0 +1,14 @@
+from django.core.management import BaseCommand
+
+from ...parser_utils import recompute_from_sale_events
+
+
+class Command(BaseCommand):
+    help = 'Recomputes nft metrics from the stored sale events without fetching opensea'
+
+    def add_arguments(self, parser):
+        parser.add_argument('nft_ids', nargs='*', type=int)
+
+    def handle(self, *args, **options):
+        recompute_from_sale_events(options['nft_ids'] or None)
+        self.stdout.write(self.style.SUCCESS('Successfully recomputed nft metrics.'))
@@ -0,0 +1,42 @@
+# Generated by Django 4.2 on 2026-10-17 15:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nftion", "0003_alter_nft_average_hold_duration_and_more"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="NftSyncState",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "last_event_time",
+                    models.DateTimeField(verbose_name="Newest synced sale event"),
+                ),
+                ("aggregates", models.JSONField()),
+                ("update_time", models.DateTimeField(auto_now=True)),
+                (
+                    "nft",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="sync_state",
+                        to="nftion.nft",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 4.2 on 2026-10-17 15:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nftion", "0004_nftsyncstate"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="NftSaleEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("seller", models.CharField(max_length=64)),
+                ("buyer", models.CharField(max_length=64)),
+                (
+                    "total_price",
+                    models.DecimalField(
+                        decimal_places=0,
+                        max_digits=78,
+                        verbose_name="Price in payment token base units",
+                    ),
+                ),
+                ("payment_token", models.CharField(max_length=20)),
+                ("payment_decimals", models.PositiveSmallIntegerField()),
+                ("timestamp", models.DateTimeField()),
+                ("listing_time", models.DateTimeField(null=True)),
+                (
+                    "nft",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="sale_events",
+                        to="nftion.nft",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="nftsaleevent",
+            constraint=models.UniqueConstraint(
+                fields=("nft", "timestamp", "seller", "buyer"),
+                name="unique_nft_sale_event",
+            ),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2 on 2026-10-17 15:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nftion", "0005_nftsaleevent"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RefreshShard",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("first_id", models.BigIntegerField()),
+                ("last_id", models.BigIntegerField(blank=True, null=True)),
+                (
+                    "total",
+                    models.IntegerField(verbose_name="Nfts in the range when planned"),
+                ),
+                ("processed", models.IntegerField(default=0)),
+                ("last_processed_id", models.BigIntegerField(blank=True, null=True)),
+                ("leased_until", models.DateTimeField(blank=True, null=True)),
+                ("created_time", models.DateTimeField(auto_now_add=True)),
+                ("finished_time", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "ordering": ("first_id",),
+            },
+        ),
+    ]
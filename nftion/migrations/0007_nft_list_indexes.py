@@ -0,0 +1,49 @@
+# Generated by Django 4.2 on 2026-10-17 15:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nftion", "0006_refreshshard"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="nft",
+            index=models.Index(
+                fields=["-update_time", "-id"], name="nft_update_time_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="nft",
+            index=models.Index(
+                fields=["nft_type", "-update_time"], name="nft_type_update_time_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="nft",
+            index=models.Index(
+                condition=models.Q(("offer", "Offer Available")),
+                fields=["-update_time"],
+                name="nft_offer_update_time_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="nft",
+            index=models.Index(fields=["price", "id"], name="nft_price_id_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="nft",
+            index=models.Index(
+                fields=["deals_number", "id"], name="nft_deals_number_id_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="nft",
+            index=models.Index(
+                fields=["monthly_roi", "id"], name="nft_monthly_roi_id_idx"
+            ),
+        ),
+    ]
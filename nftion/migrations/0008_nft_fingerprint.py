@@ -0,0 +1,29 @@
+# Generated by Django 4.2 on 2026-10-17 15:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nftion", "0007_nft_list_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="nft",
+            name="checked_time",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="nft",
+            name="fingerprint",
+            field=models.CharField(
+                blank=True,
+                default="",
+                editable=False,
+                max_length=32,
+                verbose_name="Hash of the parsed values",
+            ),
+        ),
+    ]
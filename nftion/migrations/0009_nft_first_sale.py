@@ -0,0 +1,45 @@
+# Generated by Django 4.2 on 2026-10-17 15:36
+
+import datetime
+
+from django.db import migrations, models
+
+
+def backfill_first_sale(apps, schema_editor):
+    """ Takes the first sale of already synced nfts from their stored aggregates """
+    Nft = apps.get_model("nftion", "Nft")
+    NftSyncState = apps.get_model("nftion", "NftSyncState")
+    nfts = []
+    for nft_id, aggregates in NftSyncState.objects.values_list("nft_id", "aggregates").iterator(chunk_size=1000):
+        if aggregates.get("first_sale_timestamp") is None:
+            continue
+        nfts.append(Nft(
+            id=nft_id,
+            first_price=aggregates["first_price"],
+            first_sale_date=datetime.datetime.fromtimestamp(aggregates["first_sale_timestamp"], datetime.timezone.utc),
+        ))
+        if len(nfts) >= 1000:
+            Nft.objects.bulk_update(nfts, ["first_price", "first_sale_date"])
+            nfts = []
+    Nft.objects.bulk_update(nfts, ["first_price", "first_sale_date"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nftion", "0008_nft_fingerprint"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="nft",
+            name="first_price",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="nft",
+            name="first_sale_date",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_first_sale, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-17 15:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nftion", "0009_nft_first_sale"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="nftsyncstate",
+            name="full_history",
+            field=models.BooleanField(default=False),
+        ),
+    ]
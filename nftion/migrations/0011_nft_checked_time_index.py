@@ -0,0 +1,31 @@
+# Generated by Django 4.2 on 2026-10-17 16:00
+
+from django.db import migrations, models
+from django.db.models import F
+import django.utils.timezone
+
+
+def backfill_checked_time(apps, schema_editor):
+    """ Nfts not refreshed since checked_time was added were last checked when last updated """
+    Nft = apps.get_model("nftion", "Nft")
+    Nft.objects.filter(checked_time__isnull=True).update(checked_time=F("update_time"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nftion", "0010_nftsyncstate_full_history"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_checked_time, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="nft",
+            name="checked_time",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name="nft",
+            index=models.Index(fields=["checked_time"], name="nft_checked_time_idx"),
+        ),
+    ]
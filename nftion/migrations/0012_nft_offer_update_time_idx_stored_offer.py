@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2026-10-17 17:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("nftion", "0011_nft_checked_time_index"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="nft",
+            name="nft_offer_update_time_idx",
+        ),
+        migrations.AddIndex(
+            model_name="nft",
+            index=models.Index(
+                condition=models.Q(("offer", "Offer available")),
+                fields=["-update_time"],
+                name="nft_offer_update_time_idx",
+            ),
+        ),
+    ]
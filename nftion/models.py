@@ -1,4 +1,8 @@
 from django.db import models
+from django.utils import timezone
+
+# offer the parser stores for a token listed with offers only, the list's offer=true filter
+OFFER_AVAILABLE = 'Offer available'
 
 
 class Nft(models.Model):
@@ -25,6 +29,27 @@ class Nft(models.Model):
     buy_link = models.CharField(max_length=255, verbose_name='Link to buy nft')
 
     update_time = models.DateTimeField(auto_now=True)
+    # first sale in the payment token, monthly_roi is refreshed from it in sql as time passes
+    first_sale_date = models.DateTimeField(null=True, blank=True)
+    first_price = models.FloatField(null=True, blank=True)
+
+    # update_time only moves when the parsed values change, checked_time on every refresh
+    checked_time = models.DateTimeField(default=timezone.now)
+    fingerprint = models.CharField(max_length=32, blank=True, default='', editable=False,
+                                   verbose_name='Hash of the parsed values')
+
+    class Meta:
+        # access paths of NFTList (filters with the default or a keyset ordering) and the refresh tasks
+        indexes = [
+            models.Index(fields=['-update_time', '-id'], name='nft_update_time_id_idx'),
+            models.Index(fields=['nft_type', '-update_time'], name='nft_type_update_time_idx'),
+            models.Index(fields=['-update_time'], condition=models.Q(offer=OFFER_AVAILABLE),
+                         name='nft_offer_update_time_idx'),
+            models.Index(fields=['price', 'id'], name='nft_price_id_idx'),
+            models.Index(fields=['deals_number', 'id'], name='nft_deals_number_id_idx'),
+            models.Index(fields=['monthly_roi', 'id'], name='nft_monthly_roi_id_idx'),
+            models.Index(fields=['checked_time'], name='nft_checked_time_idx'),
+        ]
 
     def __str__(self):
         return self.name
@@ -33,6 +58,60 @@ class Nft(models.Model):
         return self.opensea_link
 
 
+class NftSyncState(models.Model):
+    """ Sale events watermark of an nft and the aggregates of the events synced so far """
+    nft = models.OneToOneField('Nft', on_delete=models.CASCADE, related_name='sync_state')
+    last_event_time = models.DateTimeField(verbose_name='Newest synced sale event')
+    aggregates = models.JSONField()
+    # the stored sale events hold the whole history, states synced incrementally before are refetched once
+    full_history = models.BooleanField(default=False)
+    update_time = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.nft_id} synced until {self.last_event_time.isoformat()}'
+
+
+class NftSaleEvent(models.Model):
+    """ Successful opensea sale of an nft """
+    nft = models.ForeignKey('Nft', on_delete=models.CASCADE, related_name='sale_events')
+    seller = models.CharField(max_length=64)
+    buyer = models.CharField(max_length=64)
+    total_price = models.DecimalField(max_digits=78, decimal_places=0,
+                                      verbose_name='Price in payment token base units')
+    payment_token = models.CharField(max_length=20)
+    payment_decimals = models.PositiveSmallIntegerField()
+    timestamp = models.DateTimeField()
+    listing_time = models.DateTimeField(null=True)
+
+    class Meta:
+        # also serves as the (nft, timestamp) index
+        constraints = [
+            models.UniqueConstraint(fields=['nft', 'timestamp', 'seller', 'buyer'], name='unique_nft_sale_event'),
+        ]
+
+    def __str__(self):
+        return f'{self.nft_id} sold {self.timestamp.isoformat()}'
+
+
+class RefreshShard(models.Model):
+    """ Id range of nfts refreshed by one worker task within a refresh cycle """
+    first_id = models.BigIntegerField()
+    # open ended for the last shard so nfts added during the cycle are included
+    last_id = models.BigIntegerField(null=True, blank=True)
+    total = models.IntegerField(verbose_name='Nfts in the range when planned')
+    processed = models.IntegerField(default=0)
+    last_processed_id = models.BigIntegerField(null=True, blank=True)
+    leased_until = models.DateTimeField(null=True, blank=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+    finished_time = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ('first_id',)
+
+    def __str__(self):
+        return f'{self.first_id}-{self.last_id or ""}: {self.processed}/{self.total}'
+
+
 class NftType(models.Model):
     """ Types of Nft model """
     name = models.CharField(max_length=255, verbose_name='Type name')
@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+OPENSEA_EVENTS_URL = 'https://api.opensea.io/api/v1/events'
+EVENTS_PAGE_LIMIT = 200
+
+api_headers = {
+    "accept": "application/json",
+    "X-API-KEY": settings.API_KEY
+}
+page_headers = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/109.0'
+}
+
+
+def split_nft_link(nft_link):
+    """ Returns (contract_address, token_id) from an opensea asset link """
+    cropped = nft_link.split('/')
+    return cropped[-2], cropped[-1]
+
+
+def create_pooled_session(pool_size):
+    """ Session keeping up to `pool_size` keep-alive connections per host """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def fetch_page(session, nft_link):
+    return session.get(nft_link, verify=False, headers=page_headers).content
+
+
+def fetch_events(session, contract_address, token_id, occurred_after=None):
+    """
+    Fetches the successful sale events of a token, newest first, following the cursor in a loop.
+    With `occurred_after` (unix seconds) only events from that moment on are requested.
+    """
+    params = {
+        'only_opensea': 'true',
+        'token_id': token_id,
+        'asset_contract_address': contract_address,
+        'limit': EVENTS_PAGE_LIMIT,
+        'event_type': 'successful',
+    }
+    if occurred_after is not None:
+        params['occurred_after'] = occurred_after
+    events = []
+    while True:
+        json_data = session.get(OPENSEA_EVENTS_URL, params=params, headers=api_headers, verify=False).json()
+        events.extend(json_data['asset_events'])
+        if not json_data['next']:
+            return events
+        params['cursor'] = json_data['next']
+
+
+class OpenSeaFetcher:
+    """ Fetches item pages and sale events for a batch of nft links concurrently """
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or settings.OPENSEA_FETCH_CONCURRENCY
+        self.session = create_pooled_session(self.concurrency)
+        # one blocking request per thread, as many threads as pooled connections
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def fetch_one(self, nft_link, occurred_after=None):
+        contract_address, token_id = split_nft_link(nft_link)
+        page = fetch_page(self.session, nft_link)
+        events = fetch_events(self.session, contract_address, token_id, occurred_after)
+        return page, events
+
+    def fetch_or_error(self, nft_link, occurred_after):
+        try:
+            return self.fetch_one(nft_link, occurred_after)
+        except Exception as e:
+            return e
+
+    def fetch_many(self, nft_links, occurred_after=None):
+        """
+        Returns {nft_link: (page_content, events)} for every link.
+        `occurred_after` optionally maps links to the unix time their events are already synced until.
+        A link whose fetch failed maps to the raised exception instead.
+        """
+        nft_links = list(nft_links)
+        occurred_after = occurred_after or {}
+        results = self.executor.map(self.fetch_or_error, nft_links, [occurred_after.get(link) for link in nft_links])
+        return dict(zip(nft_links, results))
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
@@ -0,0 +1,151 @@
+import base64
+import datetime
+import hashlib
+import json
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+from .models import Nft
+
+FREE_TIER_LIMIT = 5
+# non null columns a keyset can be built on, id breaks ties
+CURSOR_ORDERING_FIELDS = (
+    'id', 'price', 'deals_number', 'update_time', 'monthly_roi', 'total_profit', 'last_sale_date',
+    'max_profit_per_sale', 'min_profit_sale', 'royalty',
+)
+
+
+def cached_count(queryset):
+    """ Row count of a filtered queryset, shared between requests for NFT_LIST_COUNT_CACHE_TIMEOUT seconds """
+    counted = queryset.order_by()
+    key = 'nft_list_count:' + hashlib.md5(str(counted.query).encode()).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = counted.count()
+        cache.set(key, count, timeout=settings.NFT_LIST_COUNT_CACHE_TIMEOUT)
+    return count
+
+
+class CursorValueEncoder(DjangoJSONEncoder):
+    """ Keeps the microseconds DjangoJSONEncoder cuts from datetimes, the keyset compares the exact value """
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class NFTListCursorPagination(BasePagination):
+    """
+    Keyset pagination of the nft list, opted in with `?pagination=cursor`. The cursor holds the
+    ordering value and id of the row a page ends on, so every page is an index range scan however
+    deep the user goes. The count is cached instead of running COUNT(*) on every page.
+    """
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.next_cursor = self.previous_cursor = None
+        ordering = queryset.query.order_by[0] if queryset.query.order_by else '-id'
+        self.ordering = ordering
+        self.field = ordering.lstrip('-')
+        if self.field not in CURSOR_ORDERING_FIELDS:
+            raise ValidationError(f'Cursor pagination supports ordering by {", ".join(CURSOR_ORDERING_FIELDS)}')
+        self.descending = ordering.startswith('-')
+        self.count = cached_count(queryset)
+
+        if not view.is_subscribed(request):
+            return list(self.ordered(queryset, reverse=False)[:FREE_TIER_LIMIT])
+
+        limit = self.get_limit(request)
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor['reverse']
+        queryset = self.ordered(queryset, reverse)
+        if cursor is not None:
+            queryset = queryset.filter(self.after(cursor['value'], cursor['id'], reverse))
+
+        rows = list(queryset[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if reverse:
+            rows.reverse()
+        if rows and (has_more or reverse):
+            self.next_cursor = self.encode_cursor(rows[-1], reverse=False)
+        if rows and (has_more if reverse else cursor is not None):
+            self.previous_cursor = self.encode_cursor(rows[0], reverse=True)
+        return rows
+
+    def paginate_snapshot(self, count, request):
+        """ Pagination state of a free tier page served from the snapshot """
+        self.request = request
+        self.count = count
+        self.next_cursor = self.previous_cursor = None
+
+    def ordered(self, queryset, reverse):
+        descending = self.descending != reverse
+        prefix = '-' if descending else ''
+        return queryset.order_by(prefix + self.field, prefix + 'id')
+
+    def after(self, value, row_id, reverse):
+        """ Rows past (value, id) in the direction the page is read """
+        lookup = 'lt' if self.descending != reverse else 'gt'
+        if self.field == 'id':
+            return Q(**{f'id__{lookup}': row_id})
+        return Q(**{f'{self.field}__{lookup}': value}) | Q(**{self.field: value, f'id__{lookup}': row_id})
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return api_settings.PAGE_SIZE
+        return limit if limit > 0 else api_settings.PAGE_SIZE
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            if cursor['o'] != self.ordering:
+                raise ValueError('cursor of another ordering')
+            return {
+                'value': Nft._meta.get_field(self.field).to_python(cursor['v']),
+                'id': int(cursor['id']),
+                'reverse': bool(cursor.get('r')),
+            }
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, row, reverse):
+        if not isinstance(row, dict):
+            row = {self.field: getattr(row, self.field), 'id': row.id}
+        cursor = {'o': self.ordering, 'v': row[self.field], 'id': row['id']}
+        if reverse:
+            cursor['r'] = 1
+        encoded = base64.urlsafe_b64encode(json.dumps(cursor, cls=CursorValueEncoder).encode()).decode()
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        return self.next_cursor
+
+    def get_previous_link(self):
+        return self.previous_cursor
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
@@ -1,10 +1,15 @@
 import datetime
 import gc
+import hashlib
 import os
+from itertools import groupby, islice
+from operator import itemgetter
 
 import requests
 
 from .NFT_parser import NftParser
+from .opensea_fetcher import OpenSeaFetcher
+from .price_cache import history_prices
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "nftion.settings")
 
@@ -13,10 +18,18 @@ from django.conf import settings
 import django
 
 from datetime import datetime, timedelta
+from django.utils import timezone
 from django.utils.timezone import make_aware, utc
 
 django.setup()
-from .models import Nft, NftType
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+
+from .event_columns import SaleAggregates, SaleEventColumns
+from .free_tier import build_free_tier_snapshot
+from .list_cache import bump_data_version, bump_types_version, count
+from .models import Nft, NftSaleEvent, NftSyncState, NftType
 
 scraper = cloudscraper.create_scraper()
 headers = {
@@ -35,55 +48,359 @@ def to_timedelta(value):
         return value
 
 
-def start_parser(urls: list):
-    session = requests.Session()
-    for nft in urls:
-        nft_parser = NftParser(settings.API_KEY, nft, session=session)
+def from_timestamp(timestamp):
+    return make_aware(datetime.utcfromtimestamp(timestamp), timezone=utc)
+
+
+def metric_fields(got):
+    """ Nft fields derived from the sale events """
+    return {
+        'price': float(got['price']),
+        'img_link': got['img_link'],
+        'total_profit': got['total_profit'],
+        'monthly_roi': got['monthly_roi'],
+        'deals_number': got['deals_number'],
+        'last_sale_date': make_aware(datetime.strptime(got['last_sale_date'], '%Y-%m-%dT%H:%M:%S'), timezone=utc),
+        'max_profit_per_sale': got['max_profit_per_sale'],
+        'min_profit_sale': got['min_profit_per_sale'],
+        'average_hold_duration': to_timedelta(got['average_hold_duration']),
+        'average_sale_duration': to_timedelta(got['average_sale_duration']),
+        'royalty': got['royalty'],
+        'first_price': got['first_price'],
+        'first_sale_date': make_aware(got['first_sale_date'], timezone=utc),
+    }
+
+
+def load_sync_states(urls):
+    """
+    Stored event aggregates by opensea link, of the nfts whose whole sale history is stored. Each one
+    carries the (seller, buyer) pairs stored at its watermark second, to tell them from unseen sales.
+    """
+    states = NftSyncState.objects.filter(
+        nft__opensea_link__in=urls, full_history=True
+    ).values_list('nft__opensea_link', 'aggregates')
+    states = {link: SaleAggregates.from_dict(aggregates) for link, aggregates in states}
+    watermark_sales = NftSaleEvent.objects.filter(
+        nft__opensea_link__in=list(states), timestamp=F('nft__sync_state__last_event_time')
+    ).values_list('nft__opensea_link', 'seller', 'buyer')
+    for link, seller, buyer in watermark_sales:
+        states[link].synced_sales.add((seller, buyer))
+    return states
+
+
+def sync_state(nft_id, aggregates):
+    return NftSyncState(
+        nft_id=nft_id,
+        last_event_time=from_timestamp(aggregates.newest_timestamp),
+        aggregates=aggregates.to_dict(),
+        full_history=True,
+    )
+
+
+def save_sync_states(sync_states):
+    NftSyncState.objects.bulk_create(
+        sync_states, update_conflicts=True, unique_fields=['nft'],
+        update_fields=['last_event_time', 'aggregates', 'full_history', 'update_time']
+    )
+
+
+def sale_event_objects(nft_id, columns):
+    for timestamp, listing_time, total_price, payment_decimals, payment_token, seller, buyer in columns.rows():
+        yield NftSaleEvent(
+            nft_id=nft_id,
+            timestamp=from_timestamp(timestamp),
+            listing_time=from_timestamp(listing_time) if listing_time is not None else None,
+            total_price=total_price,
+            payment_decimals=payment_decimals,
+            payment_token=payment_token,
+            seller=seller,
+            buyer=buyer,
+        )
+
+
+WRITTEN_KEY = 'nft_writes_written'
+UNCHANGED_KEY = 'nft_writes_unchanged'
+REBUILD_KEY = 'nft_free_tier_rebuilt'
+
+
+def write_stats():
+    """ Nfts written and skipped as unchanged by the batch writers since the counters were reset """
+    return {'written': cache.get(WRITTEN_KEY, 0), 'unchanged': cache.get(UNCHANGED_KEY, 0)}
+
+
+def reset_write_stats():
+    cache.delete_many([WRITTEN_KEY, UNCHANGED_KEY])
+
+
+def rebuild_free_tier_snapshot(force=False):
+    """
+    Precomputes the free tier pages of the current data, at most once per NFT_FREE_TIER_REBUILD_INTERVAL
+    seconds unless forced. Until then free tier requests of a newer data version are queried.
+    """
+    if not force and not cache.add(REBUILD_KEY, True, timeout=settings.NFT_FREE_TIER_REBUILD_INTERVAL):
+        return
+    try:
+        build_free_tier_snapshot()
+    except Exception as e:
+        print(e)
+
+
+def publish_changes():
+    """ Invalidates the cached nft list responses and precomputes the free tier pages of the new data """
+    bump_data_version()
+    rebuild_free_tier_snapshot(force=True)
+
+
+class NftBatchWriter:
+    """
+    Buffers parsed nfts and upserts them in chunks: one query per table for the whole chunk, inside a
+    single transaction. Nft types are resolved from a name -> id map loaded once per chunk.
+    Nfts whose parsed values hash to the stored fingerprint are not rewritten, only their checked_time
+    is set, so update_time keeps the time of the last real change.
+    """
+    nft_update_fields = [
+        'name', 'nft_type', 'offer', 'buy_link', 'price', 'img_link', 'total_profit', 'monthly_roi',
+        'deals_number', 'last_sale_date', 'max_profit_per_sale', 'min_profit_sale', 'average_hold_duration',
+        'average_sale_duration', 'royalty', 'first_price', 'first_sale_date', 'update_time', 'checked_time',
+        'fingerprint',
+    ]
+    # monthly_roi only moves with the clock between sales, refresh_monthly_roi keeps it current
+    fingerprint_fields = [
+        field for field in nft_update_fields
+        if field not in ('nft_type', 'monthly_roi', 'update_time', 'checked_time', 'fingerprint')
+    ]
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size or settings.NFT_WRITE_BATCH_SIZE
+        self.buffer = {}
+        self.written = 0
+        self.unchanged = 0
+
+    def add(self, got):
+        """ Buffers a parsed nft, raises ValidationError for values that do not fit the columns' types """
+        nft = Nft(
+            opensea_link=got['opensea_link'],
+            name=got['name'],
+            offer=got['type'],
+            buy_link=got['buy_link'],
+            **metric_fields(got),
+        )
+        for field in Nft._meta.concrete_fields:
+            if not field.is_relation:
+                setattr(nft, field.attname, field.to_python(getattr(nft, field.attname)))
+        nft.fingerprint = self.fingerprint(nft, got['category'])
+        self.buffer[nft.opensea_link] = (nft, got['category'], got['aggregates'], got['sale_events'])
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def fingerprint(self, nft, category):
+        values = [category] + [getattr(nft, field) for field in self.fingerprint_fields]
+        return hashlib.md5(repr(values).encode()).hexdigest()
+
+    def flush(self):
+        entries = list(self.buffer.values())
+        self.buffer = {}
+        if not entries:
+            return
+        written = unchanged = 0
         try:
-            got = nft_parser.get_info()
-            if not got:
-                continue
-            category, created = NftType.objects.get_or_create(
-                name=got['category']
+            written, unchanged = self._write(entries)
+        except Exception as e:
+            print(e)
+            # write one by one so a single bad row does not drop the whole chunk
+            for entry in entries:
+                try:
+                    entry_written, entry_unchanged = self._write([entry])
+                    written += entry_written
+                    unchanged += entry_unchanged
+                except Exception as e:
+                    print(f'dropped {entry[0].opensea_link}: {e}')
+        self.written += written
+        self.unchanged += unchanged
+        count(WRITTEN_KEY, written)
+        count(UNCHANGED_KEY, unchanged)
+        if written:
+            # the free tier snapshot is rebuilt once per parse run, see start_parser
+            bump_data_version()
+
+    def _write(self, entries):
+        """ Returns the number of nfts written and left unchanged """
+        now = timezone.now()
+        with transaction.atomic():
+            stored = {
+                link: (nft_id, fingerprint) for link, nft_id, fingerprint in Nft.objects.filter(
+                    opensea_link__in=[nft.opensea_link for nft, _, _, _ in entries]
+                ).values_list('opensea_link', 'id', 'fingerprint')
+            }
+            nft_ids = {link: nft_id for link, (nft_id, _) in stored.items()}
+            changed = []
+            unchanged_ids = []
+            for entry in entries:
+                nft_id, fingerprint = stored.get(entry[0].opensea_link, (None, None))
+                if fingerprint == entry[0].fingerprint:
+                    unchanged_ids.append(nft_id)
+                else:
+                    changed.append(entry)
+            if unchanged_ids:
+                Nft.objects.filter(id__in=unchanged_ids).update(checked_time=now)
+
+            if changed:
+                type_ids = self._resolve_types({category for _, category, _, _ in changed})
+                nfts = []
+                for nft, category, _, _ in changed:
+                    nft.nft_type_id = type_ids[category]
+                    nft.checked_time = now
+                    nfts.append(nft)
+                Nft.objects.bulk_create(
+                    nfts, update_conflicts=True, unique_fields=['opensea_link'], update_fields=self.nft_update_fields
+                )
+                created = [nft.opensea_link for nft in nfts if nft.opensea_link not in nft_ids]
+                if created:
+                    nft_ids.update(Nft.objects.filter(opensea_link__in=created).values_list('opensea_link', 'id'))
+
+            sale_events = []
+            sync_states = []
+            for nft, _, aggregates, columns in entries:
+                # without new events the aggregates are the stored ones
+                if columns is None:
+                    continue
+                nft_id = nft_ids[nft.opensea_link]
+                sale_events.extend(sale_event_objects(nft_id, columns))
+                # events are either the whole history or the ones newer than a full history state
+                sync_states.append(sync_state(nft_id, aggregates))
+            NftSaleEvent.objects.bulk_create(
+                sale_events, batch_size=settings.NFT_SALE_EVENTS_BATCH_SIZE, ignore_conflicts=True
             )
+            save_sync_states(sync_states)
+        print(f'saved {len(changed)} nfts, {len(unchanged_ids)} unchanged')
+        return len(changed), len(unchanged_ids)
+
+    def _resolve_types(self, names):
+        type_ids = {}
+        for type_id, name in NftType.objects.filter(name__in=names).order_by('-id').values_list('id', 'name'):
+            type_ids[name] = type_id
+        missing = [NftType(name=name) for name in names if name not in type_ids]
+        for nft_type in NftType.objects.bulk_create(missing):
+            type_ids[nft_type.name] = nft_type.id
+        if missing:
+            bump_types_version()
+        return type_ids
+
 
-            nft_id, _ = Nft.objects.update_or_create(
-                opensea_link=got['opensea_link'],
-                defaults={
-                    'name': got['name'],
-                    'price': float(got['price']),
-                    'img_link': got['img_link'],
-                    'nft_type': category,
-                    'offer': got['type'],
-                    'total_profit': got['total_profit'],
-                    'monthly_roi': got['monthly_roi'],
-                    'deals_number': got['deals_number'],
-                    'last_sale_date': make_aware(datetime.strptime(got['last_sale_date'], '%Y-%m-%dT%H:%M:%S'),
-                                                 timezone=utc),
-                    'max_profit_per_sale': got['max_profit_per_sale'],
-                    'min_profit_sale': got['min_profit_per_sale'],
-                    'average_hold_duration': to_timedelta(got['average_hold_duration']),
-                    'average_sale_duration': to_timedelta(got['average_sale_duration']),
-                    'buy_link': got['buy_link'],
-                    'royalty': got['royalty'],
-                }
+def recompute_from_sale_events(nft_ids=None):
+    """
+    Rebuilds the aggregates and metrics of nfts from their stored sale events, without opensea requests.
+    Only nfts whose whole sale history is stored are rebuilt, the others would lose their older sales.
+    """
+    events = NftSaleEvent.objects.filter(nft__sync_state__full_history=True).order_by('nft_id', '-timestamp')
+    if nft_ids is not None:
+        events = events.filter(nft_id__in=nft_ids)
+    rows = events.values_list(
+        'nft_id', 'timestamp', 'listing_time', 'total_price', 'payment_decimals', 'payment_token', 'seller', 'buyer'
+    ).iterator(chunk_size=settings.NFT_SALE_EVENTS_BATCH_SIZE)
+    nft_events = ((nft_id, [row[1:] for row in group]) for nft_id, group in groupby(rows, key=itemgetter(0)))
+
+    recomputed = 0
+    while chunk := list(islice(nft_events, settings.NFT_WRITE_BATCH_SIZE)):
+        nfts = Nft.objects.in_bulk([nft_id for nft_id, _ in chunk])
+        states = dict(NftSyncState.objects.filter(nft_id__in=nfts).values_list('nft_id', 'aggregates'))
+        updated = []
+        sync_states = []
+        for nft_id, events in chunk:
+            nft = nfts[nft_id]
+            columns = SaleEventColumns.from_sale_events(events)
+            previous = SaleAggregates.from_dict(states[nft_id])
+            columns.image_url, columns.num_sales, columns.royalty_bps = (
+                previous.image_url, previous.num_sales, previous.royalty_bps
             )
-            print(f'saved {nft_id.id}')
+            nft_parser = NftParser(settings.API_KEY, nft.opensea_link, session=None, events=[],
+                                   aggregates=SaleAggregates.from_columns(columns))
+            nft_parser.price = nft.price
+            try:
+                got = nft_parser.get_metrics()
+                if got is None:
+                    continue
+                metrics = metric_fields(got)
+            except Exception as e:
+                print(e)
+                continue
+            for name, value in metrics.items():
+                setattr(nft, name, value)
+            updated.append(nft)
+            sync_states.append(sync_state(nft_id, got['aggregates']))
+        if updated:
+            with transaction.atomic():
+                Nft.objects.bulk_update(updated, list(metrics))
+                save_sync_states(sync_states)
+        recomputed += len(updated)
+    print(f'recomputed {recomputed} nfts')
+    publish_changes()
+
+
+def last_sale_prices(fetched, sync_states):
+    """ (ticker, day) of the newest sale of every fetched nft, the one its usd price falls back to """
+    pairs = set()
+    for link, result in fetched.items():
+        if isinstance(result, Exception):
+            continue
+        events = result[1]
+        if events:
+            pairs.add((events[0]['payment_token']['symbol'],
+                       datetime.fromisoformat(events[0]['event_timestamp']).date()))
+        elif link in sync_states:
+            state = sync_states[link]
+            pairs.add((state.last_symbol, datetime.fromisoformat(state.last_sale_date).date()))
+    return pairs
+
+
+def start_parser(urls: list, full_sync=False):
+    """
+    Parses and saves the given nfts. Unless `full_sync` is set, nfts synced before only fetch the
+    sale events newer than their stored watermark and update the stored aggregates with them.
+    Every attempted nft counts as checked, so one that keeps failing does not stay the stalest.
+    """
+    fetcher = OpenSeaFetcher()
+    writer = NftBatchWriter()
+    batch_size = settings.OPENSEA_FETCH_BATCH_SIZE
+    for offset in range(0, len(urls), batch_size):
+        batch = urls[offset:offset + batch_size]
+        sync_states = {} if full_sync else load_sync_states(batch)
+        fetched = fetcher.fetch_many(
+            batch, occurred_after={link: state.newest_timestamp for link, state in sync_states.items()}
+        )
+        # written rows move checked_time again, the others wait NFT_REFRESH_MIN_AGE like a refreshed one
+        Nft.objects.filter(opensea_link__in=batch).update(checked_time=timezone.now())
+        try:
+            history_prices.prefetch(last_sale_prices(fetched, sync_states))
         except Exception as e:
             print(e)
-        nft_id = None
-        nft = None
-        nft_parser = None
-        got = None
-        category = None
-        created = None
-        gc.collect()
+        for nft in batch:
+            result = fetched[nft]
+            if isinstance(result, Exception):
+                print(result)
+                continue
+            page, events = result
+            nft_parser = NftParser(settings.API_KEY, nft, session=fetcher.session, page=page, events=events,
+                                   aggregates=sync_states.get(nft))
+            try:
+                got = nft_parser.get_info()
+                if not got:
+                    continue
+                writer.add(got)
+            except Exception as e:
+                print(e)
+    writer.flush()
+    fetcher.close()
+    print(f'written {writer.written} nfts, {writer.unchanged} unchanged')
+    if writer.written:
+        rebuild_free_tier_snapshot()
     urls = None
     return True
 
 
 def delete_scam_parser(urls: list):
     session = requests.Session()
+    deleted = False
     for nft in urls:
         nft_parser = NftParser(settings.API_KEY, nft, session=session)
         try:
@@ -91,7 +408,9 @@ def delete_scam_parser(urls: list):
             if got:
                 nft_object = Nft.objects.get(opensea_link=nft)
                 print(f'deleted {nft_object.id}')
+                # the post_delete signal bumps the data version
                 nft_object.delete()
+                deleted = True
 
         except Exception as e:
             print(e)
@@ -99,6 +418,8 @@ def delete_scam_parser(urls: list):
         nft_parser = None
         got = None
         gc.collect()
+    if deleted:
+        rebuild_free_tier_snapshot(force=True)
     urls = None
     return True
 
@@ -0,0 +1,137 @@
+import datetime
+from collections import OrderedDict
+from threading import Lock
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import HistoryPrice
+
+HISTODAY_URL = 'https://min-api.cryptocompare.com/data/v2/histoday'
+HISTODAY_MAX_DAYS = 2000
+
+
+def normalize_ticker(ticker):
+    return 'ETH' if ticker == 'WETH' else ticker
+
+
+def fetch_daily_prices(ticker, first_day, last_day):
+    """ {date: usd close price} for every day of the range, one cryptocompare request per 2000 days """
+    prices = {}
+    to_day = last_day
+    while to_day >= first_day:
+        days = min((to_day - first_day).days, HISTODAY_MAX_DAYS - 1)
+        to_ts = int(datetime.datetime.combine(to_day, datetime.time.max, datetime.timezone.utc).timestamp())
+        response = requests.get(HISTODAY_URL, params={
+            'fsym': ticker, 'tsym': 'USD', 'limit': days, 'toTs': to_ts,
+        }, verify=False).json()
+        for day in response['Data']['Data']:
+            prices[datetime.datetime.utcfromtimestamp(day['time']).date()] = day['close']
+        to_day -= datetime.timedelta(days=days + 1)
+    return prices
+
+
+class HistoryPriceCache:
+    """
+    USD price of a ticker per day, looked up in a process LRU, then the shared cache, then the
+    HistoryPrice table. Misses are filled with one day-range request per ticker.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or settings.HISTORY_PRICE_LRU_SIZE
+        self.local = OrderedDict()
+        self.lock = Lock()
+
+    @staticmethod
+    def cache_key(ticker, date):
+        return f'history_price:{ticker}:{date.isoformat()}'
+
+    def get(self, ticker, date):
+        """ USD price of the ticker on the date, None when cryptocompare has no price for that day """
+        ticker = normalize_ticker(ticker)
+        return self.prefetch([(ticker, date)]).get((ticker, date))
+
+    def prefetch(self, pairs):
+        """ Loads the prices of (ticker, date) pairs into every layer and returns them """
+        pairs = {(normalize_ticker(ticker), date) for ticker, date in pairs}
+        found = {}
+        with self.lock:
+            for pair in pairs:
+                if pair in self.local:
+                    self.local.move_to_end(pair)
+                    found[pair] = self.local[pair]
+        missing = pairs - found.keys()
+        if not missing:
+            return found
+
+        keys = {self.cache_key(*pair): pair for pair in missing}
+        shared = {keys[key]: price for key, price in cache.get_many(list(keys)).items()}
+        missing -= shared.keys()
+
+        stored = {}
+        if missing:
+            stored = self._load_stored(missing)
+            missing -= stored.keys()
+            self._remember_shared(stored)
+
+        fetched = {}
+        if missing:
+            fetched = self._fetch(missing)
+            self._remember_shared(fetched)
+
+        found.update(shared)
+        found.update(stored)
+        found.update(fetched)
+        self._remember_local({pair: found[pair] for pair in pairs if pair in found and pair not in self.local})
+        return found
+
+    def _load_stored(self, pairs):
+        dates_by_ticker = {}
+        for ticker, date in pairs:
+            dates_by_ticker.setdefault(ticker, set()).add(date)
+        stored = {}
+        for ticker, dates in dates_by_ticker.items():
+            rows = HistoryPrice.objects.filter(ticker=ticker, date__in=dates, price__gt=0).values_list('date', 'price')
+            for date, price in rows:
+                stored[(ticker, date)] = price
+        return stored
+
+    def _fetch(self, pairs):
+        today = datetime.datetime.utcnow().date()
+        dates_by_ticker = {}
+        for ticker, date in pairs:
+            dates_by_ticker.setdefault(ticker, set()).add(date)
+        fetched = {}
+        for ticker, dates in dates_by_ticker.items():
+            prices = fetch_daily_prices(ticker, min(dates), max(dates))
+            fetched.update({(ticker, date): prices[date] for date in dates if date in prices})
+            # concurrent workers may store the same days, the unique (ticker, date) keeps one row
+            HistoryPrice.objects.bulk_create(
+                [HistoryPrice(ticker=ticker, date=date, price=price)
+                 for date, price in prices.items() if date < today and price > 0],
+                ignore_conflicts=True,
+            )
+        return fetched
+
+    def _remember_shared(self, prices):
+        today = datetime.datetime.utcnow().date()
+        closed = {self.cache_key(*pair): price for pair, price in prices.items() if pair[1] < today}
+        open_days = {self.cache_key(*pair): price for pair, price in prices.items() if pair[1] >= today}
+        if closed:
+            cache.set_many(closed, timeout=None)
+        if open_days:
+            cache.set_many(open_days, timeout=settings.HISTORY_PRICE_TODAY_TIMEOUT)
+
+    def _remember_local(self, prices):
+        today = datetime.datetime.utcnow().date()
+        with self.lock:
+            for pair, price in prices.items():
+                if pair[1] >= today:
+                    continue
+                self.local[pair] = price
+                if len(self.local) > self.max_size:
+                    self.local.popitem(last=False)
+
+
+history_prices = HistoryPriceCache()
@@ -0,0 +1,52 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Case, DurationField, ExpressionWrapper, F, FloatField, Value, When
+from django.db.models.functions import Least, Now
+from django.utils import timezone
+
+from .expressions import EpochSeconds
+from .models import OFFER_AVAILABLE, Nft
+
+# activity multipliers of the staleness, an idle token only ages by its staleness
+RECENT_SALE_WEIGHTS = ((timedelta(days=7), 4.0), (timedelta(days=30), 2.0))
+DEALS_WEIGHT = 0.1
+DEALS_CAP = 50
+OFFER_WEIGHTS = {'Buy now': 2.0, OFFER_AVAILABLE: 1.0}
+
+
+def activity_expression(now):
+    recency = Case(
+        *(When(last_sale_date__gte=now - age, then=Value(weight)) for age, weight in RECENT_SALE_WEIGHTS),
+        default=Value(0.0), output_field=FloatField(),
+    )
+    deals = ExpressionWrapper(Least(F('deals_number'), Value(DEALS_CAP)) * Value(DEALS_WEIGHT),
+                              output_field=FloatField())
+    offer = Case(
+        *(When(offer=offer, then=Value(weight)) for offer, weight in OFFER_WEIGHTS.items()),
+        default=Value(0.0), output_field=FloatField(),
+    )
+    return Value(1.0) + recency + deals + offer
+
+
+def refresh_priority_queryset():
+    """
+    Nfts annotated with `refresh_priority`: hours since the last refresh weighted by activity (recent
+    last sale, number of deals, listing type), computed in the database. Nfts refreshed less than
+    NFT_REFRESH_MIN_AGE seconds ago are left out. Every refresh moves checked_time, changed or not.
+    """
+    now = timezone.now()
+    staleness_hours = EpochSeconds(
+        ExpressionWrapper(Now() - F('checked_time'), output_field=DurationField())
+    ) / Value(3600.0)
+    return Nft.objects.filter(
+        checked_time__lt=now - timedelta(seconds=settings.NFT_REFRESH_MIN_AGE),
+    ).annotate(
+        refresh_priority=ExpressionWrapper(staleness_hours * activity_expression(now), output_field=FloatField()),
+    ).order_by('-refresh_priority', 'id')
+
+
+def next_refresh_links(budget=None):
+    """ Opensea links of the `budget` nfts most in need of a refresh """
+    budget = budget or settings.NFT_REFRESH_BUDGET
+    return list(refresh_priority_queryset().values_list('opensea_link', flat=True)[:budget])
@@ -0,0 +1,87 @@
+import math
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Nft, RefreshShard
+
+
+def plan_shards(shard_count):
+    """ Splits the nft table into `shard_count` id ranges of equal size, walking the id index by keyset """
+    total = Nft.objects.count()
+    if not total:
+        return []
+    size = math.ceil(total / shard_count)
+    ids = Nft.objects.order_by('id').values_list('id', flat=True)
+    shards = []
+    first_id = ids.first()
+    while first_id is not None:
+        # last id of this shard and first id of the next one
+        window = list(ids.filter(id__gte=first_id)[size - 1:size + 1])
+        last_id, next_id = window if len(window) == 2 else (None, None)
+        shards.append(RefreshShard(
+            first_id=first_id,
+            last_id=last_id,
+            total=size if last_id is not None else total - size * len(shards),
+        ))
+        first_id = next_id
+    return RefreshShard.objects.bulk_create(shards)
+
+
+def unfinished_shards():
+    return RefreshShard.objects.filter(finished_time__isnull=True)
+
+
+def new_lease():
+    return timezone.now() + timedelta(seconds=settings.NFT_REFRESH_SHARD_LEASE)
+
+
+def claim_shard(shard_id):
+    """ Takes the lease of a shard, returns its end or None when the shard is finished or leased by another worker """
+    now = timezone.now()
+    leased_until = new_lease()
+    claimed = (
+        unfinished_shards()
+        .filter(id=shard_id)
+        .filter(Q(leased_until__isnull=True) | Q(leased_until__lt=now))
+        .update(leased_until=leased_until)
+    )
+    return leased_until if claimed else None
+
+
+def next_chunk(shard, size):
+    """ Next (id, opensea_link) rows of a shard after its last processed id """
+    nfts = Nft.objects.filter(id__gte=shard.first_id).order_by('id')
+    if shard.last_id is not None:
+        nfts = nfts.filter(id__lte=shard.last_id)
+    if shard.last_processed_id is not None:
+        nfts = nfts.filter(id__gt=shard.last_processed_id)
+    return list(nfts.values_list('id', 'opensea_link')[:size])
+
+
+def record_progress(shard, chunk, leased_until):
+    """
+    Stores the progress of a shard and renews its lease, only while the lease is still the one taken by
+    this worker. Returns the renewed lease end, None when the lease expired and the shard was claimed again.
+    """
+    renewed_until = new_lease()
+    renewed = unfinished_shards().filter(id=shard.id, leased_until=leased_until).update(
+        processed=F('processed') + len(chunk),
+        last_processed_id=chunk[-1][0],
+        leased_until=renewed_until,
+    )
+    if not renewed:
+        return None
+    shard.processed += len(chunk)
+    shard.last_processed_id = chunk[-1][0]
+    shard.leased_until = renewed_until
+    return renewed_until
+
+
+def finish_shard(shard, leased_until):
+    """ Marks a shard finished and releases its lease, False when the lease is no longer held by this worker """
+    return bool(unfinished_shards().filter(id=shard.id, leased_until=leased_until).update(
+        finished_time=timezone.now(), leased_until=None,
+    ))
@@ -1,3 +1,5 @@
+from functools import cached_property, lru_cache
+
 from rest_framework import serializers
 from .models import Nft, NftType
 
@@ -13,7 +15,108 @@ class NFTSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Nft
-        fields = '__all__'
+        # bookkeeping of the refresh tasks and the first sale monthly_roi is refreshed from, not nft data
+        exclude = ('checked_time', 'fingerprint', 'first_sale_date', 'first_price')
+
+
+class NFTListReadSerializer:
+    """
+    Flat serializer of the nft list read path. Rows are dicts of a values() query joined with the
+    nft type, formatted by the NFTSerializer fields compiled once per process into the same output.
+    `fields` narrows the output and the selected columns, the id is always kept.
+    """
+
+    def __init__(self, fields=None):
+        self.fields = fields
+
+    @cached_property
+    def field_names(self):
+        return list(NFTSerializer().fields)
+
+    @cached_property
+    def columns(self):
+        """ (output name, values() name, formatter) in NFTSerializer field order """
+        columns = []
+        for name, field in NFTSerializer().fields.items():
+            if self.fields is not None and name != 'id' and name not in self.fields:
+                continue
+            if name == 'nft_type':
+                columns.append((name, None, None))
+            else:
+                columns.append((name, field.source, field.to_representation))
+        return columns
+
+    @cached_property
+    def value_names(self):
+        names = [source for _, source, _ in self.columns if source is not None]
+        if any(source is None for _, source, _ in self.columns):
+            names += ['nft_type_id', 'nft_type__name']
+        return names
+
+    def select(self, fields):
+        """ Serializer of a subset of the fields, the recently used subsets are kept compiled """
+        if not fields:
+            return self
+        key = frozenset(fields)
+        unknown = key - set(self.field_names)
+        if unknown:
+            raise serializers.ValidationError({'fields': f'Unknown fields: {", ".join(sorted(unknown))}'})
+        return compiled_selection(key)
+
+    def queryset(self, queryset, extra=()):
+        """ values() of the serialized columns, `extra` adds columns the caller reads, like the ordering """
+        names = self.value_names + [name for name in extra if name not in self.value_names]
+        return queryset.values(*names)
+
+    def serialize(self, rows):
+        columns = self.columns
+        data = []
+        for row in rows:
+            item = {}
+            for name, source, formatter in columns:
+                if source is None:
+                    item[name] = {'id': row['nft_type_id'], 'name': row['nft_type__name']}
+                    continue
+                value = row[source]
+                item[name] = None if value is None else formatter(value)
+            data.append(item)
+        return data
+
+    def serialize_row(self, row):
+        return self.serialize((row,))[0]
+
+    def flat_header(self):
+        """ Column names of the flat csv export, the nft type split into id and name """
+        header = []
+        for name, source, _ in self.columns:
+            header.extend((name, 'nft_type_name') if source is None else (name,))
+        return header
+
+    def compact(self, rows):
+        """ Column names once and a list of values per row """
+        return {'columns': self.flat_header(), 'rows': [self.flat_row(row) for row in rows]}
+
+    def flat_row(self, row):
+        values = []
+        for name, source, formatter in self.columns:
+            if source is None:
+                values.extend((row['nft_type_id'], row['nft_type__name']))
+                continue
+            value = row[source]
+            values.append(None if value is None else formatter(value))
+        return values
+
+
+# distinct field subsets kept compiled per process, the least recently requested are dropped past this
+SELECTION_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=SELECTION_CACHE_SIZE)
+def compiled_selection(fields):
+    return NFTListReadSerializer(fields)
+
+
+nft_list_serializer = NFTListReadSerializer()
 
 
 class NFTListFilterSerializer(serializers.Serializer):
@@ -25,8 +128,11 @@ class NFTListFilterSerializer(serializers.Serializer):
     deals_number_gte = serializers.IntegerField(required=False)
     nft_type_ids = serializers.RegexField(r'^\d+(,\d+)*$', required=False)
 
+    # query params left out of the checks below
+    unchecked_params = ()
+
     def validate(self, data):
-        data = self.initial_data
+        data = {name: value for name, value in self.initial_data.items() if name not in self.unchecked_params}
         price_lte = data.get('price__lte')
         price_gte = data.get('price__gte')
         if price_lte and not price_lte.isdigit():
@@ -60,3 +166,9 @@ class NFTListFilterSerializer(serializers.Serializer):
         if data.get('limit') and not data.get('limit').isdigit():
             raise serializers.ValidationError('limit should be int type')
         return data
+
+
+class NFTFacetsFilterSerializer(NFTListFilterSerializer):
+    """ Filters of the facets, the ordering and paging params do not change them and are not checked """
+    ordering = None
+    unchecked_params = ('ordering', 'limit', 'offset')
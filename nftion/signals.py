@@ -0,0 +1,17 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .list_cache import bump_data_version, bump_types_version
+from .models import Nft, NftType
+
+
+@receiver([post_save, post_delete], sender=Nft)
+def nft_changed(sender, **kwargs):
+    # the parser writes in bulk and bumps the version itself, this covers admin edits and deletes
+    bump_data_version()
+
+
+@receiver([post_save, post_delete], sender=NftType)
+def nft_type_changed(sender, **kwargs):
+    bump_types_version()
+    bump_data_version()
@@ -1,12 +1,16 @@
-from datetime import datetime, timedelta
 from typing import List
 import requests
 from django.conf import settings
+from django.core.cache import cache
 from django.core.paginator import Paginator
 from django.http import JsonResponse
 from django.utils import timezone
-from .models import Collection, Nft
-from .parser_utils import get_links, delete_scam_parser, start_parser
+from django.utils.dateparse import parse_datetime
+from .models import Collection, Nft, RefreshShard
+from .parser_utils import get_links, delete_scam_parser, publish_changes, rebuild_free_tier_snapshot, start_parser
+from .refresh_priority import next_refresh_links
+from .time_metrics import refresh_monthly_roi
+from .refresh_scheduler import claim_shard, finish_shard, next_chunk, plan_shards, record_progress, unfinished_shards
 from celery import shared_task
 
 
@@ -45,7 +49,8 @@ def update_existing_nft(*args, **kwargs):
         for nft in nft_objects:
             checking_list.append(nft.get_opensea_link())
 
-    start_parser(checking_list)
+    # full_sync refetches the whole sale history instead of the events after the stored watermark
+    start_parser(checking_list, full_sync=kwargs.get('full_sync', False))
 
     return
 
@@ -123,22 +128,63 @@ def delete_scam(*args, **kwargs):
 
 @shared_task
 def update_old(*args, **kwargs):
-    nft_objs = Nft.objects.filter(update_time__lt=datetime.now() - timedelta(days=1))
-    objs_list = [link.get_opensea_link() for link in nft_objs]
-    print(objs_list)
-    start_parser(objs_list)
+    """
+    Refreshes the NFT_REFRESH_BUDGET nfts with the highest staleness weighted by activity. A run still
+    going when the next beat fires makes that beat a no-op instead of refetching the same nfts.
+    """
+    if not cache.add('nft_refresh_old', True, timeout=settings.NFT_REFRESH_OLD_LOCK_TIMEOUT):
+        print('update_old is already running')
+        return
+    try:
+        start_parser(next_refresh_links(kwargs.get('budget')))
+    finally:
+        cache.delete('nft_refresh_old')
 
 
 @shared_task
 def update_auto(*args, **kwargs):
-    third_part = round(Nft.objects.all().count() / 3)
+    """
+    Refresh cycle scheduler. Plans one keyset id range per worker when no cycle is running and otherwise
+    only requeues shards whose lease expired. The lease is taken here before queueing, so a shard already
+    waiting in the queue is not queued again by the next beat. The planning lock is released when the last
+    shard of a cycle finishes, so the next beat plans the next cycle once, an empty plan waits for a lease.
+    """
+    shards = list(unfinished_shards())
+    if not shards:
+        if not cache.add('nft_refresh_planning', True, timeout=settings.NFT_REFRESH_SHARD_LEASE):
+            return
+        RefreshShard.objects.all().delete()
+        shards = plan_shards(settings.NFT_REFRESH_WORKERS)
+
+    for shard in shards:
+        if leased_until := claim_shard(shard.id):
+            refresh_shard.apply_async(kwargs={'shard_id': shard.id, 'leased_until': leased_until.isoformat()})
 
-    update_existing_nft.apply_async(
-        kwargs={'position': 0, "closing_position": third_part}
-    )
-    update_existing_nft.apply_async(
-        kwargs={'position': third_part, "closing_position": third_part * 2}
-    )
-    update_existing_nft.apply_async(
-        kwargs={'position': third_part * 2}
-    )
+
+@shared_task
+def refresh_shard(shard_id, leased_until):
+    """ Refreshes a shard chunk by chunk while it still holds the lease taken by update_auto """
+    leased_until = parse_datetime(leased_until)
+    shard = RefreshShard.objects.get(id=shard_id)
+    while True:
+        chunk = next_chunk(shard, settings.OPENSEA_FETCH_BATCH_SIZE)
+        if not chunk:
+            break
+        start_parser([link for _, link in chunk])
+        leased_until = record_progress(shard, chunk, leased_until)
+        if leased_until is None:
+            print(f'lease of refresh shard {shard_id} expired, left to the worker holding it')
+            return
+    if finish_shard(shard, leased_until) and not unfinished_shards().exists():
+        cache.delete('nft_refresh_planning')
+    # the throttled rebuilds of the chunks may have skipped the last one
+    rebuild_free_tier_snapshot(force=True)
+
+
+@shared_task
+def refresh_time_metrics(*args, **kwargs):
+    """ Keeps monthly_roi current as time passes since the first sale, without fetching anything """
+    updated = refresh_monthly_roi()
+    print(f'refreshed monthly roi of {updated} nfts')
+    if updated:
+        publish_changes()
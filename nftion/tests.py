@@ -1,3 +1,557 @@
-from django.test import TestCase
+import datetime
+import json
 
-# Create your tests here.
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts import constants
+from accounts.models import User
+
+from . import list_cache, price_cache, tasks
+from .free_tier import build_free_tier_snapshot
+from .NFT_parser import NftParser
+from .event_columns import MAX_TRACKED_PURCHASES, SaleAggregates, SaleEventColumns, flip_profit_range
+from .management.commands.benchmark_flip_profit import quadratic_flip_profit_range, synthetic_sales
+from .models import OFFER_AVAILABLE, HistoryPrice, Nft, NftSaleEvent, NftSyncState, NftType, RefreshShard
+from .pagination import FREE_TIER_LIMIT
+from .opensea_fetcher import OpenSeaFetcher
+from .parser_utils import NftBatchWriter, load_sync_states, start_parser, write_stats
+from .refresh_priority import next_refresh_links
+from .time_metrics import refresh_monthly_roi
+from .refresh_scheduler import claim_shard, next_chunk, plan_shards, record_progress
+from .serializers import NFTListReadSerializer, NFTSerializer, nft_list_serializer
+from .views import NFTExportView, NFTFacetsView, NFTList, NftTypeListAPIView
+
+
+def sale_event(timestamp, total_price, seller, buyer, listing_time=None):
+    return {
+        'event_timestamp': timestamp,
+        'listing_time': listing_time,
+        'total_price': total_price,
+        'payment_token': {'symbol': 'ETH', 'decimals': 18},
+        'seller': {'address': seller},
+        'winner_account': {'address': buyer},
+        'asset': {'image_url': 'img', 'num_sales': 3, 'asset_contract': {'dev_seller_fee_basis_points': 250}},
+    }
+
+
+def create_nft(index, nft_type=None, **fields):
+    values = {
+        'name': f'nft {index}',
+        'img_link': f'https://img/{index}',
+        'price': 10 + index,
+        'nft_type': nft_type or NftType.objects.get_or_create(name='General')[0],
+        'offer': 'Buy now',
+        'total_profit': 5,
+        'opensea_link': f'https://opensea.io/assets/ethereum/0xabc/{index}',
+        'deals_number': 4,
+        'monthly_roi': 1,
+        'last_sale_date': datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc),
+        'max_profit_per_sale': 10,
+        'min_profit_sale': 1,
+        'royalty': 2.5,
+        'buy_link': f'https://opensea.io/assets/ethereum/0xabc/{index}',
+    }
+    values.update(fields)
+    return Nft.objects.create(**values)
+
+
+def test_flip_profit_range_matches_pairwise_matching():
+    for seed in range(20):
+        sales = synthetic_sales(300, 15, seed)
+        assert flip_profit_range(sales) == quadratic_flip_profit_range(sales)
+
+
+def test_flip_profit_range_without_resales():
+    sales = [(1, 2.0, 'a', 'b'), (2, 3.0, 'c', 'd')]
+    assert flip_profit_range(sales) is None
+
+
+def test_sale_event_columns():
+    columns = SaleEventColumns.from_events([
+        sale_event('2023-01-03T00:00:00', '3000000000000000000', 'b', 'c', '2023-01-02T00:00:00'),
+        sale_event('2023-01-02T00:00:00', '1500000000000000000', 'a', 'b'),
+        sale_event('2023-01-01T00:00:00', '0', '0x0', 'a'),
+    ])
+
+    assert list(columns.prices) == [3.0, 1.5, 0.0]
+    assert columns.addresses == ['b', 'c', 'a', '0x0']
+    assert columns.first_index == 1
+    assert flip_profit_range(columns.sales()) == (100.0, 100.0)
+
+
+def test_a_lone_free_mint_has_no_first_sale():
+    events = [sale_event('2023-01-01T00:00:00', '0', '0x0', 'a')]
+
+    assert SaleEventColumns.from_events(events).first_index is None
+    assert SaleAggregates.from_columns(SaleEventColumns.from_events(events)).first_price is None
+    assert NftParser('key', parsed_nft()['opensea_link'], session=None, events=events).get_metrics() is None
+
+
+def synthetic_events(count, seed):
+    """ Opensea-like events, newest first, one hour apart """
+    events = []
+    for index, (_, price, seller, buyer) in enumerate(synthetic_sales(count, 6, seed)):
+        timestamp = (datetime.datetime(2023, 1, 1) + datetime.timedelta(hours=index)).isoformat()
+        events.append(sale_event(timestamp, str(int(price * 10 ** 18)) if index else '0', seller, buyer))
+    return events[::-1]
+
+
+def test_sale_aggregates_merge_matches_full_history():
+    for seed in range(10):
+        events = synthetic_events(40, seed)
+        full = SaleAggregates.from_columns(SaleEventColumns.from_events(events))
+        incremental = SaleAggregates.from_columns(SaleEventColumns.from_events(events[25:]))
+        incremental.merge(SaleEventColumns.from_events(events[10:25]))
+        incremental = SaleAggregates.from_dict(incremental.to_dict())
+        incremental.merge(SaleEventColumns.from_events(events[:10]))
+
+        assert incremental.to_dict() == full.to_dict()
+        assert incremental.average_hold_duration() == full.average_hold_duration()
+        assert incremental.average_sale_duration() == full.average_sale_duration()
+
+
+def test_sale_aggregates_track_the_newest_purchases_only():
+    start = datetime.datetime(2023, 1, 1)
+    events = [
+        sale_event((start + datetime.timedelta(hours=index)).isoformat(), str(10 ** 18), f'0x{index}', f'0x{index + 1}')
+        for index in range(MAX_TRACKED_PURCHASES + 20)
+    ][::-1]
+
+    aggregates = SaleAggregates.from_columns(SaleEventColumns.from_events(events))
+
+    assert len(aggregates.purchases) == MAX_TRACKED_PURCHASES
+    assert f'0x{MAX_TRACKED_PURCHASES + 20}' in aggregates.purchases and '0x1' not in aggregates.purchases
+
+
+def test_sale_event_columns_round_trip_through_stored_rows():
+    events = synthetic_events(30, 3)
+    columns = SaleEventColumns.from_events(events)
+    stored = [
+        (
+            datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc),
+            datetime.datetime.fromtimestamp(listing_time, datetime.timezone.utc) if listing_time else None,
+            total_price, decimals, symbol, seller, buyer,
+        )
+        for timestamp, listing_time, total_price, decimals, symbol, seller, buyer in columns.rows()
+    ]
+    restored = SaleEventColumns.from_sale_events(stored)
+    restored.image_url, restored.num_sales, restored.royalty_bps = columns.image_url, columns.num_sales, 250
+
+    assert restored.last_sale_date == columns.last_sale_date
+    assert SaleAggregates.from_columns(restored).to_dict() == SaleAggregates.from_columns(columns).to_dict()
+
+
+def test_history_price_cache_fills_misses_with_one_range_per_ticker(monkeypatch):
+    requested = []
+
+    def fetch_daily_prices(ticker, first_day, last_day):
+        requested.append(ticker)
+        return {first_day + datetime.timedelta(days=day): 100.0 + day for day in range((last_day - first_day).days + 1)}
+
+    monkeypatch.setattr(price_cache, 'fetch_daily_prices', fetch_daily_prices)
+    first_day, last_day = datetime.date(2023, 1, 1), datetime.date(2023, 1, 5)
+
+    prices = price_cache.HistoryPriceCache(16).prefetch([('WETH', first_day), ('WETH', last_day), ('ETH', first_day)])
+
+    assert requested == ['ETH']
+    assert prices == {('ETH', first_day): 100.0, ('ETH', last_day): 104.0}
+    assert HistoryPrice.objects.count() == 5
+    assert price_cache.HistoryPriceCache(16).get('ETH', datetime.date(2023, 1, 3)) == 102.0
+    assert requested == ['ETH']
+
+
+def test_history_price_cache_returns_none_for_a_day_without_price(monkeypatch):
+    monkeypatch.setattr(price_cache, 'fetch_daily_prices', lambda ticker, first_day, last_day: {})
+
+    assert price_cache.HistoryPriceCache(16).get('ETH', datetime.date(2023, 1, 3)) is None
+
+
+def test_plan_shards_covers_the_table_in_keyset_ranges():
+    ids = [create_nft(index).id for index in range(10)]
+
+    shards = plan_shards(3)
+
+    assert [(shard.first_id, shard.last_id, shard.total) for shard in shards] == [
+        (ids[0], ids[3], 4), (ids[4], ids[7], 4), (ids[8], None, 2),
+    ]
+    leased_until = claim_shard(shards[0].id)
+    assert leased_until
+    assert claim_shard(shards[0].id) is None
+    assert [nft_id for nft_id, _ in next_chunk(shards[2], 5)] == ids[8:]
+
+    chunk = next_chunk(shards[0], 2)
+    assert record_progress(shards[0], chunk, leased_until - datetime.timedelta(seconds=1)) is None
+    assert record_progress(shards[0], chunk, leased_until) is not None
+    assert RefreshShard.objects.get(id=shards[0].id).last_processed_id == ids[1]
+
+
+def test_refresh_cycle_is_planned_again_once_its_last_shard_finishes(monkeypatch):
+    create_nft(0)
+    create_nft(1)
+    queued = []
+    monkeypatch.setattr(tasks.refresh_shard, 'apply_async', lambda kwargs: queued.append(kwargs))
+    monkeypatch.setattr(tasks, 'start_parser', lambda urls: True)
+    monkeypatch.setattr(tasks, 'rebuild_free_tier_snapshot', lambda force=False: None)
+
+    tasks.update_auto()
+    tasks.update_auto()
+    planned = set(RefreshShard.objects.values_list('id', flat=True))
+    tasks.refresh_shard(**queued[0])
+    tasks.update_auto()
+
+    assert len(queued) == len(planned) == 2
+    assert set(RefreshShard.objects.values_list('id', flat=True)) == planned
+    tasks.refresh_shard(**queued[1])
+    tasks.update_auto()
+    assert len(queued) == 4 and not planned & set(RefreshShard.objects.values_list('id', flat=True))
+
+
+def test_refresh_priority_weights_staleness_by_activity():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    hot = create_nft(0, deals_number=80, offer='Buy now', last_sale_date=now - datetime.timedelta(days=1))
+    dormant = create_nft(1, deals_number=2, offer='No offers')
+    fresh = create_nft(2, deals_number=80, offer='Buy now', last_sale_date=now)
+    Nft.objects.filter(id=hot.id).update(checked_time=now - datetime.timedelta(hours=2))
+    Nft.objects.filter(id=dormant.id).update(checked_time=now - datetime.timedelta(hours=10))
+    Nft.objects.filter(id=fresh.id).update(checked_time=now - datetime.timedelta(minutes=1))
+
+    assert next_refresh_links(5) == [hot.opensea_link, dormant.opensea_link]
+    assert next_refresh_links(1) == [hot.opensea_link]
+
+
+def test_refresh_priority_boosts_tokens_with_offers():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    unlisted = create_nft(0, offer='No offers')
+    listed = create_nft(1, offer=OFFER_AVAILABLE)
+    Nft.objects.update(checked_time=now - datetime.timedelta(hours=3))
+
+    assert next_refresh_links(2) == [listed.opensea_link, unlisted.opensea_link]
+
+
+def test_nfts_whose_refresh_fails_leave_the_next_batch(monkeypatch):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    failing = create_nft(0, deals_number=80, offer='Buy now')
+    healthy = create_nft(1)
+    Nft.objects.filter(id=failing.id).update(checked_time=now - datetime.timedelta(hours=10))
+    Nft.objects.filter(id=healthy.id).update(checked_time=now - datetime.timedelta(hours=2))
+    monkeypatch.setattr(OpenSeaFetcher, 'fetch_many',
+                        lambda fetcher, links, occurred_after=None: {link: ValueError('blocked') for link in links})
+
+    assert next_refresh_links(1) == [failing.opensea_link]
+    start_parser(next_refresh_links(1))
+
+    assert next_refresh_links(1) == [healthy.opensea_link]
+
+
+def create_subscriber(email='subscriber@example.com'):
+    return User.objects.create_user(
+        email=email, name='Subscriber', password='password',
+        subscription_end=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=30),
+    )
+
+
+def get_nft_list(user, url):
+    return request_view(NFTList, user, url).data
+
+
+def request_view(view, user, url, **headers):
+    request = APIRequestFactory().get(url, **headers)
+    force_authenticate(request, user=user)
+    return view.as_view()(request)
+
+
+def test_cursor_pagination_walks_ties_without_gaps():
+    nfts = [create_nft(index, price=index // 3) for index in range(10)]
+    user = create_subscriber()
+
+    pages = [get_nft_list(user, '/nft/?pagination=cursor&ordering=-price&limit=4')]
+    while pages[-1]['next']:
+        pages.append(get_nft_list(user, pages[-1]['next']))
+    walked = [row['id'] for page in pages for row in page['results']['data']]
+    previous = get_nft_list(user, pages[-1]['previous'])
+
+    assert walked == [nft.id for nft in sorted(nfts, key=lambda nft: (-nft.price, -nft.id))]
+    assert pages[0]['count'] == 10 and pages[0]['previous'] is None
+    assert [row['id'] for row in previous['results']['data']] == walked[4:8]
+
+    user.subscription_end = None
+    user.save()
+    assert len(get_nft_list(user, '/nft/?pagination=cursor&ordering=-price')['results']['data']) == FREE_TIER_LIMIT
+
+
+def test_cursor_pagination_walks_update_times_within_a_millisecond():
+    nfts = [create_nft(index) for index in range(10)]
+    written = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    for index, nft in enumerate(nfts):
+        # a batch write stamps its rows microseconds apart
+        Nft.objects.filter(id=nft.id).update(update_time=written + datetime.timedelta(microseconds=(index % 5) * 100))
+    user = create_subscriber()
+
+    pages = [get_nft_list(user, '/nft/?pagination=cursor&ordering=-update_time&limit=3')]
+    while pages[-1]['next']:
+        pages.append(get_nft_list(user, pages[-1]['next']))
+    walked = [row['id'] for page in pages for row in page['results']['data']]
+    previous = get_nft_list(user, pages[-1]['previous'])
+
+    ordered = sorted(Nft.objects.values_list('update_time', 'id'), reverse=True)
+    assert walked == [nft_id for _, nft_id in ordered]
+    assert [row['id'] for row in previous['results']['data']] == walked[6:9]
+
+
+def test_nft_list_reads_a_page_in_two_queries(django_assert_num_queries):
+    nft_types = [NftType.objects.create(name=f'Type {index}') for index in range(3)]
+    for index in range(6):
+        create_nft(index, nft_type=nft_types[index % 3], average_hold_duration=datetime.timedelta(hours=index))
+    user = create_subscriber()
+
+    with django_assert_num_queries(2):
+        data = get_nft_list(user, '/nft/?limit=50')['results']['data']
+
+    assert data == NFTSerializer(Nft.objects.order_by('-update_time'), many=True).data
+
+
+def test_nft_list_authenticates_tokens_from_the_cached_subscription(django_assert_num_queries):
+    create_nft(0)
+    user = create_subscriber()
+    headers = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(user)}'}
+
+    def get_list():
+        return NFTList.as_view()(APIRequestFactory().get('/nft/?limit=50', **headers))
+
+    subscribed = get_list()
+
+    with django_assert_num_queries(0):
+        cached = get_list()
+    user.subscription_end = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)
+    user.save()
+    lapsed = get_list()
+    user.is_active = False
+    user.save()
+
+    assert cached.data == subscribed.data and subscribed.data['results']['message'] == constants.NFT_MESSAGE
+    assert lapsed.data['results']['message'] == constants.NFT_LIMIT_MESSAGE
+    assert get_list().status_code == 401
+
+
+def test_nft_list_responses_are_cached_until_the_data_version_changes(django_assert_num_queries):
+    create_nft(0)
+    user = create_subscriber()
+    first = get_nft_list(user, '/nft/?nft_type_ids=2,1&ordering=-price')
+
+    with django_assert_num_queries(0):
+        cached = get_nft_list(user, '/nft/?ordering=-price&nft_type_ids=1,2,1')
+    list_cache.bump_data_version()
+    with django_assert_num_queries(2):
+        get_nft_list(user, '/nft/?ordering=-price&nft_type_ids=1,2')
+
+    assert cached == first
+    assert list_cache.cache_stats()['hits'] == 1 and list_cache.cache_stats()['misses'] == 2
+
+
+def test_free_tier_pages_are_served_from_the_snapshot(django_assert_num_queries):
+    nft_types = [NftType.objects.create(name=f'Type {index}') for index in range(2)]
+    for index in range(8):
+        create_nft(index, nft_type=nft_types[index % 2], offer=OFFER_AVAILABLE if index < 3 else 'Buy now')
+    user = User.objects.create_user(email='free@example.com', name='Free', password='password')
+    urls = ['/nft/', '/nft/?offer=true', '/nft/?offer=false&limit=50', f'/nft/?nft_type_ids={nft_types[1].id}',
+            '/nft/?pagination=cursor']
+    expected = [get_nft_list(user, url) for url in urls]
+    list_cache.bump_data_version()
+
+    build_free_tier_snapshot()
+    with django_assert_num_queries(0):
+        served = [get_nft_list(user, url) for url in urls]
+
+    assert served == expected
+    assert [page['count'] for page in served] == [8, 3, 5, 4, 8]
+    assert request_view(NFTList, user, '/nft/?limit=abc').status_code == 400
+
+
+def test_unchanged_lists_answer_conditional_gets_with_304(django_assert_num_queries):
+    create_nft(0)
+    user = create_subscriber()
+    response = request_view(NFTList, user, '/nft/?ordering=-price')
+    types_response = request_view(NftTypeListAPIView, user, '/nft-types/')
+
+    with django_assert_num_queries(0):
+        not_modified = request_view(NFTList, user, '/nft/?ordering=-price', HTTP_IF_NONE_MATCH=response['ETag'])
+        types_not_modified = request_view(NftTypeListAPIView, user, '/nft-types/',
+                                          HTTP_IF_NONE_MATCH=types_response['ETag'])
+    since_last_change = request_view(NFTList, user, '/nft/?ordering=-price',
+                                     HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+    NftType.objects.create(name='New type')
+    changed = request_view(NFTList, user, '/nft/?ordering=-price', HTTP_IF_NONE_MATCH=response['ETag'])
+
+    assert (not_modified.status_code, types_not_modified.status_code, since_last_change.status_code) == (304, 304, 304)
+    assert not_modified['ETag'] == response['ETag']
+    assert changed.status_code == 200 and changed['ETag'] != response['ETag']
+    assert response['Cache-Control'] == 'private, no-cache'
+    assert {'Authorization', 'Cookie'} <= set(response['Vary'].split(', '))
+
+
+def test_export_streams_the_filtered_list_for_subscribers():
+    for index in range(5):
+        create_nft(index, price=index)
+    user = create_subscriber()
+
+    ndjson = request_view(NFTExportView, user, '/nft/export/?price__gte=2&ordering=price')
+    csv_export = request_view(NFTExportView, user, '/nft/export/?export_format=csv&ordering=-price')
+    rows = [json.loads(line) for line in b''.join(ndjson.streaming_content).decode().splitlines()]
+    csv_lines = b''.join(csv_export.streaming_content).decode().splitlines()
+    empty_csv = request_view(NFTExportView, user, '/nft/export/?export_format=csv&price__gte=100')
+    empty_lines = b''.join(empty_csv.streaming_content).decode().splitlines()
+    user.subscription_end = None
+    user.save()
+
+    assert [row['price'] for row in rows] == ['2.00', '3.00', '4.00']
+    assert rows[0]['nft_type']['name'] == 'General'
+    assert csv_lines[0].startswith('id,nft_type,nft_type_name,name,')
+    assert len(csv_lines) == 6
+    assert empty_lines == csv_lines[:1]
+    assert request_view(NFTExportView, user, '/nft/export/').status_code == 403
+
+
+def test_sparse_fields_narrow_the_query_and_compact_rows(django_assert_num_queries):
+    nft = create_nft(0)
+    user = create_subscriber()
+
+    with django_assert_num_queries(2) as captured:
+        data = get_nft_list(user, '/nft/?fields=price,nft_type')['results']['data']
+    compact = get_nft_list(user, '/nft/?fields=price,nft_type&compact=true')['results']['data']
+
+    assert data == [{'id': nft.id, 'nft_type': {'id': nft.nft_type_id, 'name': 'General'}, 'price': '10.00'}]
+    assert 'opensea_link' not in captured.captured_queries[-1]['sql']
+    assert compact == {'columns': ['id', 'nft_type', 'nft_type_name', 'price'],
+                       'rows': [[nft.id, nft.nft_type_id, 'General', '10.00']]}
+    assert request_view(NFTList, user, '/nft/?fields=price,secret').status_code == 400
+    assert request_view(NFTList, user, '/nft/?fields=price,fingerprint').status_code == 400
+    hidden = {'fingerprint', 'checked_time', 'first_sale_date', 'first_price'}
+    assert not hidden & set(get_nft_list(user, '/nft/')['results']['data'][0])
+    assert NFTListReadSerializer().select(['nft_type', 'price']) is nft_list_serializer.select(['price', 'nft_type'])
+
+
+def test_facets_are_counted_in_one_query_and_cached(django_assert_num_queries):
+    for index, (price, deals_number) in enumerate([(5, 1), (20, 7), (20, 30)]):
+        create_nft(index, price=price, deals_number=deals_number, offer=OFFER_AVAILABLE if index % 2 else 'Buy now')
+    # an offer written the way the parser writes it
+    writer = NftBatchWriter()
+    writer.add(parsed_nft(opensea_link='https://opensea.io/assets/ethereum/0xabc/3', category='Rare', price=700,
+                          deals_number=120, type=OFFER_AVAILABLE))
+    writer.flush()
+    user = create_subscriber()
+
+    with django_assert_num_queries(1):
+        facets = request_view(NFTFacetsView, user, '/nft/facets/?price__gte=10&limit=5').data
+    with django_assert_num_queries(0):
+        cached = request_view(NFTFacetsView, user, '/nft/facets/?price__gte=10&ordering=-price').data
+
+    assert cached == facets
+    assert facets['total'] == 3
+    assert [(row['name'], row['count']) for row in facets['nft_types']] == [('General', 2), ('Rare', 1)]
+    assert [bucket['count'] for bucket in facets['price']] == [0, 2, 0, 0, 1, 0, 0]
+    assert [bucket['count'] for bucket in facets['deals_number']] == [0, 1, 0, 1, 0, 1]
+    assert facets['offer'] == {'true': 2, 'false': 1}
+    assert request_view(NFTFacetsView, user, '/nft/facets/?price__gte=abc').status_code == 400
+    assert request_view(NFTFacetsView, user, f'/nft/facets/?price__gte=10&ordering={"x" * 101}').status_code == 200
+    stats = list_cache.cache_stats()
+    assert (stats['hits'], stats['misses'], stats['facets_hits'], stats['facets_misses']) == (0, 0, 2, 1)
+
+
+def parsed_nft(**values):
+    got = {
+        'opensea_link': 'https://opensea.io/assets/ethereum/0xabc/1', 'name': 'parsed', 'type': 'Buy now',
+        'buy_link': 'https://opensea.io/assets/ethereum/0xabc/1', 'category': 'General', 'price': 12.5,
+        'img_link': 'https://img/1', 'total_profit': 3, 'monthly_roi': 1.25, 'deals_number': 4,
+        'last_sale_date': '2023-01-01T00:00:00', 'max_profit_per_sale': 10, 'min_profit_per_sale': 1,
+        'average_hold_duration': None, 'average_sale_duration': None, 'royalty': 2.5,
+        'first_price': 0.5, 'first_sale_date': datetime.datetime(2022, 6, 1),
+        'aggregates': None, 'sale_events': None,
+    }
+    got.update(values)
+    return got
+
+
+def test_batch_writer_skips_unchanged_nfts():
+    writer = NftBatchWriter()
+    writer.add(parsed_nft())
+    writer.flush()
+    written = Nft.objects.get()
+    version = list_cache.data_version()
+
+    writer.add(parsed_nft())
+    writer.flush()
+    unchanged = Nft.objects.get()
+    unchanged_version = list_cache.data_version()
+    writer.add(parsed_nft(price=13))
+    writer.flush()
+
+    assert unchanged.update_time == written.update_time
+    assert unchanged.checked_time > written.checked_time
+    assert unchanged_version == version
+    assert Nft.objects.get().price == 13
+    assert (writer.written, writer.unchanged) == (2, 1)
+    assert write_stats() == {'written': 2, 'unchanged': 1}
+
+
+def test_batch_writer_keeps_the_rows_of_a_chunk_that_fails(monkeypatch):
+    resolve_types = NftBatchWriter._resolve_types
+
+    def fail_on_broken(writer, names):
+        if 'Broken' in names:
+            raise ValueError('broken category')
+        return resolve_types(writer, names)
+
+    monkeypatch.setattr(NftBatchWriter, '_resolve_types', fail_on_broken)
+    writer = NftBatchWriter()
+    writer.add(parsed_nft())
+    writer.add(parsed_nft(opensea_link='https://opensea.io/assets/ethereum/0xabc/2', category='Broken'))
+    writer.flush()
+
+    assert list(Nft.objects.values_list('opensea_link', flat=True)) == [parsed_nft()['opensea_link']]
+    assert writer.written == 1
+
+
+def test_sync_states_written_before_full_history_are_refetched_once():
+    columns = SaleEventColumns.from_events(synthetic_events(6, 2))
+    aggregates = SaleAggregates.from_columns(columns)
+    writer = NftBatchWriter()
+    writer.add(parsed_nft(aggregates=aggregates, sale_events=columns))
+    writer.flush()
+    link = parsed_nft()['opensea_link']
+
+    synced = load_sync_states([link])
+    NftSyncState.objects.update(full_history=False)
+
+    assert set(synced) == {link} and NftSaleEvent.objects.count() == 6
+    assert load_sync_states([link]) == {}
+
+
+def test_unseen_sales_of_the_watermark_second_are_synced():
+    events = synthetic_events(6, 2)
+    columns = SaleEventColumns.from_events(events)
+    writer = NftBatchWriter()
+    writer.add(parsed_nft(aggregates=SaleAggregates.from_columns(columns), sale_events=columns))
+    writer.flush()
+    link = parsed_nft()['opensea_link']
+    newest = events[0]
+    unseen = sale_event(newest['event_timestamp'], str(2 * 10 ** 18), newest['winner_account']['address'], '0xnew')
+
+    synced = load_sync_states([link])[link]
+    nft_parser = NftParser('key', link, session=None, events=[unseen, newest], aggregates=synced)
+    nft_parser.write_all_events()
+
+    assert list(nft_parser.new_events.rows())[0][-1] == '0xnew' and len(nft_parser.new_events) == 1
+    assert nft_parser.aggregates.event_count == 7
+
+
+def test_monthly_roi_is_refreshed_in_one_update(django_assert_num_queries):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    stale = create_nft(0, total_profit=120, monthly_roi=120, first_sale_date=now - datetime.timedelta(days=95))
+    current = create_nft(1, total_profit=50, monthly_roi=25, first_sale_date=now - datetime.timedelta(days=40))
+    unknown = create_nft(2, monthly_roi=7)
+
+    with django_assert_num_queries(1):
+        assert refresh_monthly_roi() == 1
+
+    assert [Nft.objects.get(id=nft.id).monthly_roi for nft in (stale, current, unknown)] == [30, 25, 7]
@@ -0,0 +1,14 @@
+from django.db.models import F
+
+from .expressions import monthly_roi
+from .models import Nft
+
+
+def refresh_monthly_roi():
+    """
+    Recomputes monthly_roi of every nft with a known first sale in one UPDATE, as the months since the
+    first sale grow. Rows whose rounded value did not change are not written. Returns the rows updated.
+    """
+    return Nft.objects.filter(first_sale_date__isnull=False).annotate(
+        current_roi=monthly_roi(),
+    ).exclude(monthly_roi=F('current_roi')).update(monthly_roi=monthly_roi())
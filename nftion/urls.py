@@ -1,9 +1,11 @@
 from django.urls import path
 
-from .views import NFTCollectionsView, NFTList, NftTypeListAPIView
+from .views import NFTCollectionsView, NFTExportView, NFTFacetsView, NFTList, NftTypeListAPIView
 
 urlpatterns = [
     path('nft-collections/', NFTCollectionsView.as_view(), name='nft_collections'),
     path('nft/', NFTList.as_view(), name='nft-list'),
+    path('nft/export/', NFTExportView.as_view(), name='nft-export'),
+    path('nft/facets/', NFTFacetsView.as_view(), name='nft-facets'),
     path('nft-types/', NftTypeListAPIView.as_view(), name='nft-types'),
 ]
@@ -1,22 +1,34 @@
+import csv
+import io
+import json
+
 from django.core.paginator import Paginator
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views import View
 from django.conf import settings
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import generics, permissions, status
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.filters import OrderingFilter
 from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.response import Response
 
+from . import list_cache
+from .conditional import ConditionalGetMixin
+from .facets import nft_facets
+from .free_tier import free_tier_page
 from .tasks import get_nft_collections_from_block_daemon, start_parsing_collection_table, start_parsing_collection_file
-from .models import Collection, Nft, NftType
-from .serializers import NFTSerializer, NftTypeSerializer, NFTListFilterSerializer
+from .models import OFFER_AVAILABLE, Collection, Nft, NftType
+from .pagination import CURSOR_ORDERING_FIELDS, FREE_TIER_LIMIT, NFTListCursorPagination
+from .serializers import (
+    NFTSerializer, NftTypeSerializer, NFTFacetsFilterSerializer, NFTListFilterSerializer, nft_list_serializer,
+)
 from .parser_utils import get_links
 from django_filters import FilterSet, CharFilter
 
-from datetime import datetime, timedelta
-import pytz
 from accounts import constants
+from accounts.authentication import SubscriptionJWTAuthentication
+from accounts.subscription import is_active
 
 
 class NFTCollectionsView(View):
@@ -45,8 +57,8 @@ class NFTListLimitOffsetPagination(LimitOffsetPagination):
         self.offset = self.get_offset(request)
         self.request = request
 
-        if not request.user.subscription_end or request.user.subscription_end < datetime.utcnow().replace(tzinfo=pytz.utc):
-            self.limit = 5
+        if not view.is_subscribed(request):
+            self.limit = FREE_TIER_LIMIT
             self.offset = 0
 
         if self.limit is None:
@@ -62,25 +74,42 @@ class NFTListLimitOffsetPagination(LimitOffsetPagination):
 
         return list(queryset[self.offset:self.offset + self.limit])
 
+    def paginate_snapshot(self, count, request):
+        """ Pagination state of a free tier page served from the snapshot """
+        self.request = request
+        self.count = count
+        self.limit = FREE_TIER_LIMIT
+        self.offset = 0
+        if self.count > self.limit:
+            self.display_page_controls = True
 
-class NFTList(generics.ListAPIView):
-    permission_classes = [permissions.IsAuthenticated]
-    queryset = Nft.objects.all()
-    pagination_class = NFTListLimitOffsetPagination
-    serializer_class = NFTSerializer
-    filter_backends = [DjangoFilterBackend, OrderingFilter]
-    filterset_class = NFTFilter
+
+class NFTListFilterMixin:
+    """ Filters and orders nfts from the list query params, returns (queryset, message for the tier) """
     serializer_class_filter = NFTListFilterSerializer
 
+    authentication_classes = [SubscriptionJWTAuthentication]
+
+    def is_subscribed(self, request):
+        """ Subscription tier of the request user, computed once per request """
+        if not hasattr(request, 'subscribed'):
+            request.subscribed = is_active(request.user.subscription_end)
+        return request.subscribed
+
+    def validated_filters(self):
+        """ Validated list query params, raises a 400 on invalid ones """
+        if not hasattr(self, '_filter_data'):
+            filter_serializer = self.serializer_class_filter(data=self.request.query_params)
+            filter_serializer.is_valid(raise_exception=True)
+            self._filter_data = filter_serializer.validated_data
+        return self._filter_data
+
     def filter_queryset(self, queryset):
-        filter_serializer = self.serializer_class_filter(data=self.request.query_params)
-        filter_serializer.is_valid(raise_exception=True)
-        filter_data = filter_serializer.validated_data
+        filter_data = self.validated_filters()
 
-        user = self.request.user
         offer = self.request.query_params.get('offer', None)
 
-        if not user.subscription_end or user.subscription_end < datetime.utcnow().replace(tzinfo=pytz.utc):
+        if not self.is_subscribed(self.request):
             ordering = filter_data.get('ordering', '-id')
             final_msg = constants.NFT_LIMIT_MESSAGE
         else:
@@ -98,9 +127,9 @@ class NFTList(generics.ListAPIView):
             queryset = queryset.filter(nft_type_id__in=type_ids_list)
 
         if offer == 'true':
-            queryset = queryset.filter(offer='Offer Available')
+            queryset = queryset.filter(offer=OFFER_AVAILABLE)
         elif offer == 'false':
-            queryset = queryset.exclude(offer='Offer Available')
+            queryset = queryset.exclude(offer=OFFER_AVAILABLE)
 
         if price_min is not None and price_max is not None:
             queryset = queryset.filter(price__range=[price_min, price_max])
@@ -119,25 +148,145 @@ class NFTList(generics.ListAPIView):
         queryset = queryset.order_by(ordering)
         return queryset, final_msg
 
-    def list(self, request, *args, **kwargs):
 
+class NFTList(ConditionalGetMixin, NFTListFilterMixin, generics.ListAPIView):
+    permission_classes = [permissions.IsAuthenticated]
+    queryset = Nft.objects.select_related('nft_type')
+    pagination_class = NFTListLimitOffsetPagination
+    cursor_pagination_class = NFTListCursorPagination
+    serializer_class = NFTSerializer
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filterset_class = NFTFilter
+
+    @property
+    def paginator(self):
+        """ Limit/offset by default, keyset pages with ?pagination=cursor """
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if params.get('pagination') == 'cursor' or 'cursor' in params:
+                self._paginator = self.cursor_pagination_class()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def get_etag_source(self, request):
+        return list_cache.response_key(request, self.is_subscribed(request))
+
+    def get_last_modified(self, request):
+        return list_cache.last_modified()
+
+    def list(self, request, *args, **kwargs):
+        subscribed = self.is_subscribed(request)
+        if not subscribed:
+            # the snapshot answers the same params the query does, invalid ones are rejected first
+            self.validated_filters()
+            page = free_tier_page(request.query_params)
+            if page is not None:
+                count, data = page
+                self.paginator.paginate_snapshot(count, request)
+                return self.get_paginated_response({'message': constants.NFT_LIMIT_MESSAGE, 'data': data})
+
+        cache_key = list_cache.response_key(request, subscribed)
+        cached = list_cache.get_response(cache_key)
+        if cached is not None:
+            return Response(cached)
+
+        response = self.list_response()
+        list_cache.set_response(cache_key, response.data)
+        return response
+
+    def list_response(self):
         queryset, final_msg = self.filter_queryset(self.get_queryset())
+        params = self.request.query_params
+        serializer = nft_list_serializer.select([name for name in params.get('fields', '').split(',') if name])
+        ordering = queryset.query.order_by[0].lstrip('-')
+        # rows are read as joined values and formatted by the flat serializer, not model instances
+        queryset = serializer.queryset(queryset, extra=[ordering] if ordering in CURSOR_ORDERING_FIELDS else [])
+        serialize = serializer.compact if params.get('compact') == 'true' else serializer.serialize
 
         pagination = self.paginate_queryset(queryset)
         if pagination is not None:
-            serializer = self.get_serializer(pagination, many=True)
-
             context_data = {
                 'message': final_msg,
-                'data': serializer.data,
+                'data': serialize(pagination),
             }
             return self.get_paginated_response(context_data)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response({'message': final_msg, 'data': serializer})
+        return Response({'message': final_msg, 'data': serialize(queryset)})
 
 
-class NftTypeListAPIView(generics.ListAPIView):
+class NFTFacetsView(ConditionalGetMixin, NFTListFilterMixin, generics.ListAPIView):
+    """ Facet counts of the filtered nft list for the filter controls, cached per data version """
+    permission_classes = [permissions.IsAuthenticated]
+    queryset = Nft.objects.all()
+    serializer_class_filter = NFTFacetsFilterSerializer
+
+    def get_etag_source(self, request):
+        return list_cache.facets_key(request)
+
+    def get_last_modified(self, request):
+        return list_cache.last_modified()
+
+    def list(self, request, *args, **kwargs):
+        # validated before the cache, a hit and a miss answer invalid filters alike
+        self.validated_filters()
+        cache_key = list_cache.facets_key(request)
+        facets = list_cache.get_facets(cache_key)
+        if facets is None:
+            queryset, _ = self.filter_queryset(self.get_queryset())
+            facets = nft_facets(queryset)
+            list_cache.set_response(cache_key, facets)
+        return Response(facets)
+
+
+class NFTExportView(NFTListFilterMixin, generics.GenericAPIView):
+    """
+    Streams the whole filtered nft list as NDJSON or CSV (?export_format=csv) for subscribed users.
+    Rows are read through a server side cursor in chunks, so memory does not grow with the result.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    queryset = Nft.objects.all()
+    content_types = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+    def get(self, request, *args, **kwargs):
+        if not self.is_subscribed(request):
+            raise PermissionDenied(constants.NFT_ERROR_MESSAGE)
+        export_format = request.query_params.get('export_format', 'ndjson')
+        if export_format not in self.content_types:
+            raise ValidationError({'export_format': f'Supported formats: {", ".join(self.content_types)}'})
+
+        queryset, _ = self.filter_queryset(self.get_queryset())
+        rows = nft_list_serializer.queryset(queryset).iterator(chunk_size=settings.NFT_EXPORT_CHUNK_SIZE)
+        lines = self.csv_lines(rows) if export_format == 'csv' else self.ndjson_lines(rows)
+
+        response = StreamingHttpResponse(lines, content_type=self.content_types[export_format])
+        response['Content-Disposition'] = f'attachment; filename="nfts.{export_format}"'
+        return response
+
+    @staticmethod
+    def ndjson_lines(rows):
+        for row in rows:
+            yield json.dumps(nft_list_serializer.serialize_row(row)) + '\n'
+
+    @staticmethod
+    def csv_lines(rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(nft_list_serializer.flat_header())
+        # the header goes out on its own, an empty export still gets it
+        yield buffer.getvalue()
+        for row in rows:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(nft_list_serializer.flat_row(row))
+            yield buffer.getvalue()
+
+
+class NftTypeListAPIView(ConditionalGetMixin, generics.ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
     queryset = NftType.objects.all()
     serializer_class = NftTypeSerializer
+
+    def get_etag_source(self, request):
+        return f'nft_types:{list_cache.types_version()}:{request.get_full_path()}'
+